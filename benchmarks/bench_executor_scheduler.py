@@ -0,0 +1,35 @@
+"""
+Shows that the cost of an executor iteration scales with the nodes that received new entries,
+not with the size of the graph.
+
+    python benchmarks/bench_executor_scheduler.py
+"""
+import batchfactory as bf
+from batchfactory.op import *
+import time
+
+def build_graph(n_tail_nodes, rounds, n_entries):
+    g = bf.Graph()
+    g |= FromList([{"n": i} for i in range(n_entries)])
+    g |= SetField("acc", 0)
+    g |= Repeat(MapField(lambda acc, r: acc + r, ["acc", "rounds"], ["acc"]), rounds)
+    for _ in range(n_tail_nodes):
+        g |= MapField(lambda x: x + 1, "acc")
+    g |= ToList("acc")
+    return g
+
+def main():
+    rounds, n_entries = 50, 100
+    # each tail node is pumped about twice (initial pass + entries leaving the loop),
+    # while the loop rounds only pump the loop node and its body.
+    print(f"{'nodes':>6} {'pumps':>8} {'loop pumps':>11} {'seconds':>9}")
+    for n_tail_nodes in [10, 40, 160, 640]:
+        g = build_graph(n_tail_nodes, rounds, n_entries)
+        time_start = time.perf_counter()
+        g.execute(dispatch_brokers=False, mock=True)
+        elapsed = time.perf_counter() - time_start
+        n_pumps = g.executor.n_node_pumps
+        print(f"{len(g.nodes):>6} {n_pumps:>8} {n_pumps - 2*len(g.nodes):>11} {elapsed:>9.3f}")
+
+if __name__ == "__main__":
+    main()
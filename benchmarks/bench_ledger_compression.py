@@ -0,0 +1,68 @@
+"""
+Disk size and throughput of Ledger compression settings, on LLM responses, small similar records and base64 embeddings.
+
+    python benchmarks/bench_ledger_compression.py [n_records]
+"""
+from batchfactory.core.ledger import Ledger
+import numpy as np
+import tempfile
+import base64
+import random
+import time
+import sys
+import os
+
+SETTINGS = [(None, 256), ("zlib", 256), ("zlib_dict", 64)] # (compression, compress_threshold)
+WORDS = ("the of and to in is that for it as with was on be by this are from or an which have not but "
+         "model answer question response example step result value function data input output first "
+         "because therefore however number list table user assistant system").split()
+
+def make_llm_records(n, rng):
+    return {str(i): {"idx": str(i), "status": "done", "meta": {"model": "gpt-4o-mini", "entry_idx": f"q{i}"},
+                     "response": {"role": "assistant", "content": " ".join(rng.choice(WORDS) for _ in range(rng.randint(200, 400)))}}
+            for i in range(n)}
+
+def make_small_records(n, rng):
+    return {str(i): {"idx": str(i), "status": "done", "meta": {"model": "gpt-4o-mini", "entry_idx": f"q{i}", "entry_rev": 0},
+                     "response": {"role": "assistant", "content": f"{rng.choice(['Yes', 'No'])}, score {rng.randint(1, 10)}."}}
+            for i in range(n)}
+
+def make_embedding_records(n, rng):
+    vectors = np.random.default_rng(0).standard_normal((n, 1536)).astype(np.float32)
+    return {str(i): {"idx": str(i), "status": "done", "response": {"embedding_base64": base64.b64encode(vectors[i].tobytes()).decode()}}
+            for i in range(n)}
+
+def disk_size(path):
+    return sum(os.path.getsize(str(path) + suffix) for suffix in ["", "-wal", "-shm", ".zdict"] if os.path.exists(str(path) + suffix))
+
+def timed(fn, *args):
+    time_start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - time_start
+
+def bench(records, tmp_dir, compression, threshold):
+    path = os.path.join(tmp_dir, f"{compression}.sqlite")
+    ledger = Ledger(path, compression=compression, compress_threshold=threshold)
+    n = len(records)
+    write_rate = n / timed(ledger.update_many_sync, records)
+    ledger.compact()
+    size = disk_size(ledger.path)
+    get_all_rate = n / timed(ledger.get_all)
+    filter_rate = n / timed(ledger.filter_many, lambda record: record["status"] == "done")
+    ledger.close()
+    return size, write_rate, get_all_rate, filter_rate
+
+def main(n):
+    rng = random.Random(0)
+    datasets = {"llm": make_llm_records(n, rng), "small": make_small_records(n, rng), "embedding": make_embedding_records(n, rng)}
+    print(f"{'dataset':>10} {'compression':>12} {'disk MB':>9} {'ratio':>6} {'write/s':>9} {'get_all/s':>10} {'filter/s':>9}")
+    for name, records in datasets.items():
+        baseline = None
+        for compression, threshold in SETTINGS:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                size, write_rate, get_all_rate, filter_rate = bench(records, tmp_dir, compression, threshold)
+            baseline = baseline or size
+            print(f"{name:>10} {str(compression):>12} {size/1e6:>9.1f} {baseline/size:>5.1f}x {write_rate:>9,.0f} {get_all_rate:>10,.0f} {filter_rate:>9,.0f}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
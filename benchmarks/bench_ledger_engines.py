@@ -0,0 +1,66 @@
+"""
+Throughput of the Ledger storage engines: batched writes, single-record commits, lookups, full scans,
+overwrites, deletes, reopening, and the size left on disk after compact().
+
+    python benchmarks/bench_ledger_engines.py [n_records ...]
+"""
+from batchfactory.core.ledger import Ledger
+from batchfactory.core.ledger_engine import LEDGER_ENGINES
+import asyncio
+import tempfile
+import time
+import sys
+import os
+
+N_SINGLE = 2000 # records committed one by one
+
+def make_records(n, round=0):
+    return {f"entry_{i}": {"idx": f"entry_{i}", "rev": round, "status": "done",
+                           "data": {"text": "x" * 1000, "n": i}, "meta": {}} for i in range(n)}
+
+def disk_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return sum(os.path.getsize(str(path) + suffix) for suffix in ["", "-wal", "-shm"] if os.path.exists(str(path) + suffix))
+
+def timed(fn, *args):
+    time_start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - time_start
+
+async def commit_one_by_one(ledger:Ledger, records):
+    for record in records.values():
+        await ledger.update_one_async(record)
+
+def bench(engine, n, tmp_dir):
+    path = os.path.join(tmp_dir, engine)
+    ledger = Ledger(path, engine=engine)
+    records, idxs = make_records(n), [f"entry_{i}" for i in range(n)]
+    singles = {f"single_{i}": {"idx": f"single_{i}", "status": "done", "data": "x" * 1000} for i in range(N_SINGLE)}
+    results = {
+        "write": n / timed(ledger.update_many_sync, records),
+        "commit one": N_SINGLE / timed(asyncio.run, commit_one_by_one(ledger, singles)),
+        "get_many": n / timed(ledger.get_many, idxs),
+        "get_all": n / timed(ledger.get_all),
+        "overwrite": n / timed(ledger.update_many_sync, make_records(n, round=1)),
+        "delete": n // 2 / timed(ledger.remove_many, idxs[::2]),
+    }
+    ledger.compact()
+    if hasattr(ledger.engine, "wait_merge"): ledger.engine.wait_merge()
+    ledger.close()
+    results["disk MB"] = disk_size(ledger.path) / 1e6
+    results["reopen s"] = timed(lambda: Ledger(path, engine=engine).close())
+    return results
+
+def main(sizes):
+    engines = list(LEDGER_ENGINES)
+    for n in sizes:
+        print(f"{n} records of ~1KB, rows/s")
+        print(f"{'':>12}" + "".join(f"{engine:>14}" for engine in engines))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = {engine: bench(engine, n, tmp_dir) for engine in engines}
+        for key in results[engines[0]]:
+            print(f"{key:>12}" + "".join(f"{results[engine][key]:>14,.1f}" for engine in engines))
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10_000, 100_000])
@@ -0,0 +1,53 @@
+"""
+Trade-off of the Ledger profiles: opening the ledgers of a project, single-record commits, batched writes and reads.
+Run it on the disk the projects live on, a tmpfs hides the cost of fsync.
+
+    python benchmarks/bench_ledger_profiles.py [n_ledgers] [directory]
+"""
+from batchfactory.core.ledger import Ledger
+from batchfactory.core.ledger_engine import LEDGER_PROFILES
+import asyncio
+import tempfile
+import time
+import sys
+
+N_RECORDS = 10_000 # records of each ledger
+N_SINGLE = 500 # records committed one by one
+
+def make_records(n, prefix="entry"):
+    return {f"{prefix}_{i}": {"idx": f"{prefix}_{i}", "status": "done", "data": {"text": "x" * 500, "n": i}} for i in range(n)}
+
+def timed(fn, *args):
+    time_start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - time_start
+
+async def commit_one_by_one(ledger:Ledger, records):
+    for record in records.values():
+        await ledger.update_one_async(record)
+
+def bench(profile, n_ledgers, tmp_dir):
+    paths = [f"{tmp_dir}/{profile}_{i}.sqlite" for i in range(n_ledgers)]
+    results = {}
+    ledgers = []
+    results["create s"] = timed(lambda: ledgers.extend(Ledger(path, profile=profile) for path in paths))
+    ledger = ledgers[0]
+    results["write/s"] = N_RECORDS / timed(ledger.update_many_sync, make_records(N_RECORDS))
+    results["commit one/s"] = N_SINGLE / timed(asyncio.run, commit_one_by_one(ledger, make_records(N_SINGLE, "single")))
+    results["get_all/s"] = N_RECORDS / timed(ledger.get_all)
+    for other in ledgers[1:]:
+        other.update_many_sync(make_records(1000))
+    for other in ledgers: other.close()
+    results["reopen s"] = timed(lambda: [Ledger(path, profile=profile).close() for path in paths])
+    return results
+
+def main(n_ledgers, directory):
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_dir:
+        results = {profile: bench(profile, n_ledgers, tmp_dir) for profile in LEDGER_PROFILES}
+    print(f"{n_ledgers} ledgers")
+    print(f"{'':>14}" + "".join(f"{profile:>12}" for profile in LEDGER_PROFILES))
+    for key in results[LEDGER_PROFILES[0]]:
+        print(f"{key:>14}" + "".join(f"{results[profile][key]:>12,.3f}" for profile in LEDGER_PROFILES))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50, sys.argv[2] if len(sys.argv) > 2 else None)
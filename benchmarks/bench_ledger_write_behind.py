@@ -0,0 +1,56 @@
+"""
+Responses per second recorded by concurrent tasks through Ledger.update_one_async,
+with one commit per response compared with write-behind group commits.
+Also reports the longest event loop stall, i.e. how long the other tasks were kept waiting.
+
+    python benchmarks/bench_ledger_write_behind.py [n_responses ...]
+"""
+from batchfactory.core.ledger import Ledger
+import asyncio
+import tempfile
+import time
+import sys
+import os
+
+CONCURRENCY = 250
+
+async def watch_loop(stalls, stop:asyncio.Event, interval=0.001):
+    "records the largest delay of a periodic wake-up"
+    while not stop.is_set():
+        time_start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stalls.append(time.perf_counter() - time_start - interval)
+
+async def respond_all(ledger:Ledger, n:int):
+    queue = asyncio.Queue()
+    for i in range(n):
+        queue.put_nowait(i)
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            await asyncio.sleep(0) # the api call
+            await ledger.update_one_async({"idx": f"job_{i}", "status": "done", "response": {"text": "x" * 200}, "meta": {}})
+    stalls, stop = [], asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(stalls, stop))
+    time_start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(CONCURRENCY)])
+    ledger.flush()
+    elapsed = time.perf_counter() - time_start
+    stop.set(); await watcher
+    return n / elapsed, max(stalls, default=0.0)
+
+def main(sizes):
+    print(f"{'responses':>9} {'per-commit/s':>13} {'max stall':>10} {'write-behind/s':>15} {'max stall':>10} {'speedup':>8}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            direct = Ledger(os.path.join(tmp_dir, "direct.sqlite"))
+            grouped = Ledger(os.path.join(tmp_dir, "grouped.sqlite"))
+            grouped.enable_write_behind()
+            direct_rate, direct_stall = asyncio.run(respond_all(direct, n))
+            grouped_rate, grouped_stall = asyncio.run(respond_all(grouped, n))
+            assert grouped.count_by_status() == {"done": n}
+            print(f"{n:>9} {direct_rate:>13,.0f} {direct_stall*1000:>8.1f}ms {grouped_rate:>15,.0f} {grouped_stall*1000:>8.1f}ms {grouped_rate/direct_rate:>7.1f}x")
+            direct.close(); grouped.close()
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1_000, 10_000, 50_000])
@@ -0,0 +1,58 @@
+"""
+Rows per second of Ledger writes, deletes and lookups, compared with the previous one statement per row implementation.
+
+    python benchmarks/bench_ledger_writes.py [n_records ...]
+"""
+from batchfactory.core.ledger import Ledger
+import msgpack
+import tempfile
+import time
+import sys
+import os
+
+def legacy_update_many(ledger:Ledger, updates):
+    for idx, record in updates.items():
+        ledger.engine.conn.execute('INSERT OR REPLACE INTO entries (idx, data) VALUES (?, ?)', (idx, msgpack.packb(record, use_bin_type=True)))
+    ledger.engine.conn.commit()
+
+def legacy_remove_many(ledger:Ledger, idxs):
+    for idx in idxs:
+        ledger.engine.conn.execute('DELETE FROM entries WHERE idx = ?', (idx,))
+    ledger.engine.conn.commit()
+
+def legacy_get_many(ledger:Ledger, idxs):
+    return {idx: ledger.get_one(idx) for idx in idxs}
+
+def make_records(n):
+    return {f"entry_{i}": {"idx": f"entry_{i}", "rev": 0, "data": {"text": "x" * 200, "n": i}, "meta": {}} for i in range(n)}
+
+def rate(n, fn, *args, repeat=3, setup=None):
+    "best of repeat runs"
+    best = 0
+    for _ in range(repeat):
+        if setup is not None: setup()
+        time_start = time.perf_counter()
+        fn(*args)
+        best = max(best, n / (time.perf_counter() - time_start))
+    return best
+
+def main(sizes):
+    print(f"{'records':>9} {'op':>7} {'legacy rows/s':>14} {'batched rows/s':>15} {'speedup':>8}")
+    for n in sizes:
+        records = make_records(n)
+        idxs = list(records)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            legacy = Ledger(os.path.join(tmp_dir, "legacy.sqlite"))
+            batched = Ledger(os.path.join(tmp_dir, "batched.sqlite"))
+            results = [
+                ("write", rate(n, legacy_update_many, legacy, records), rate(n, batched.update_many_sync, records)),
+                ("read", rate(n, legacy_get_many, legacy, idxs), rate(n, batched.get_many, idxs)),
+                ("delete", rate(n, legacy_remove_many, legacy, idxs, setup=lambda: legacy_update_many(legacy, records)),
+                    rate(n, batched.remove_many, idxs, setup=lambda: batched.update_many_sync(records))),
+            ]
+            for op, legacy_rate, batched_rate in results:
+                print(f"{n:>9} {op:>7} {legacy_rate:>14,.0f} {batched_rate:>15,.0f} {batched_rate/legacy_rate:>7.1f}x")
+            legacy.close(); batched.close()
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
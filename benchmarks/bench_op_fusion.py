@@ -0,0 +1,32 @@
+"""
+Compares pumping a chain of ApplyOps node by node with pumping it as one FusedOp.
+
+    python benchmarks/bench_op_fusion.py
+"""
+import batchfactory as bf
+from batchfactory.op import *
+import time
+
+def build_graph(chain_length, n_entries):
+    g = bf.Graph()
+    g |= FromList([{"n": i, "text": "x" * 100} for i in range(n_entries)])
+    for _ in range(chain_length):
+        g |= MapField(lambda x: x + 1, "n")
+    g |= Filter(lambda data: data["n"] % 2 == 0, consume_rejected=True)
+    g |= ToList("n")
+    return g
+
+def main():
+    n_entries = 20000
+    print(f"{'chain':>6} {'unfused':>9} {'fused':>9} {'speedup':>8}")
+    for chain_length in [2, 5, 10, 20]:
+        times = []
+        for fuse_ops in [False, True]:
+            g = build_graph(chain_length, n_entries)
+            time_start = time.perf_counter()
+            g.execute(dispatch_brokers=False, mock=True, fuse_ops=fuse_ops)
+            times.append(time.perf_counter() - time_start)
+        print(f"{chain_length:>6} {times[0]:>9.3f} {times[1]:>9.3f} {times[0]/times[1]:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
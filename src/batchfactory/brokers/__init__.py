@@ -1,2 +1,3 @@
 from .llm_broker import *
-from .llm_embedding_broker import *
\ No newline at end of file
+from .llm_embedding_broker import *
+from .llm_batch_broker import *
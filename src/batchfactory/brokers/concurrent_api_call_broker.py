@@ -1,14 +1,17 @@
 from ..core.broker import ImmediateBroker, BrokerJobRequest, BrokerJobResponse, BrokerJobStatus
 from ..lib.llm_backend import *
+from .flow_control import AIMDConcurrency, TokenRateLimiter, RetryPolicy, classify_api_error
 from openai import OpenAI, AsyncOpenAI
 from openai.types.chat import ChatCompletion
 
-from typing import List,Iterable,Dict
+from typing import List,Iterable,Iterator,Dict,Mapping,Tuple,Callable
+from itertools import islice, chain
 from dataclasses import dataclass
 from pydantic import BaseModel
 import asyncio,aiofiles
+import time
 from aiolimiter import AsyncLimiter
-from asyncio import Semaphore, Lock
+from asyncio import Lock
 from tqdm.auto import tqdm
 
 from abc import ABC, abstractmethod
@@ -16,6 +19,20 @@ import traceback
 
 
 class ConcurrentAPICallBroker(ImmediateBroker, ABC):
+    """
+    Makes the API calls of the jobs concurrently, under a request rate limit of rate_limit per second.
+    - if adaptive_concurrency, the number of calls in flight is adjusted by AIMDConcurrency between
+        min_concurrency and concurrency_limit, backing off on throttling, server errors and timeouts.
+        otherwise it is fixed at concurrency_limit. either way Retry-After hints pause new calls.
+    - the current limit is shown on the progress bar, and given by get_metrics()
+    - tokens_per_minute limits the tokens sent per model, see TokenRateLimiter. subclasses
+        tell what a request is charged by _get_token_charge, and what it used by _get_token_usage
+    - throttles, server errors and timeouts are retried within the run with exponential backoff, see RetryPolicy.
+        the number of attempts and the last error are recorded in the meta of the job's response
+    - the jobs are processed in batches of max_number_per_batch. after each batch its responses are flushed to the ledger
+        and its statistics reported, then on_batch_end(batches done, jobs done) is called: it may block to pause,
+        or return False to stop the run. max_batches_per_run caps the batches of a run, the rest stays queued for the next one
+    """
     def __init__(self, 
                 cache_path: str,
                 request_cls: type,
@@ -23,21 +40,50 @@ class ConcurrentAPICallBroker(ImmediateBroker, ABC):
                 *,
                 concurrency_limit: int,
                 rate_limit: int,
-                max_number_per_batch: int = None
+                max_number_per_batch: int = None,
+                max_batches_per_run: int = None,
+                on_batch_end: Callable[[int,int],bool|None]|None = None,
+                adaptive_concurrency: bool = True,
+                min_concurrency: int = 1,
+                tokens_per_minute: int|Dict[str,int]|None = None,
+                max_retries: int = 4,
+                retry_budget: float = 0.2,
+                backoff_base: float = 1.0,
+                backoff_max: float = 60.0,
+                flush_every: int = 256,
+                flush_interval_ms: float = 50,
+                compression: str|None = None,
+                ledger_profile: str|None = None,
     ):
-        super().__init__(cache_path=cache_path,request_cls=request_cls,response_cls=response_cls)
+        super().__init__(cache_path=cache_path,request_cls=request_cls,response_cls=response_cls,compression=compression,
+                         ledger_profile=ledger_profile)
+        # responses are committed in groups by the ledger's writer thread, not one fsync per response on the event loop
+        self._ledger.enable_write_behind(flush_every=flush_every, flush_interval_ms=flush_interval_ms)
         self.concurrency_limit = concurrency_limit
         self.rate_limit = rate_limit
+        if max_number_per_batch is not None and max_number_per_batch <= 0:
+            raise ValueError(f"Expected max_number_per_batch > 0, got {max_number_per_batch}")
         self.max_number_per_batch = max_number_per_batch
+        self.max_batches_per_run = max_batches_per_run
+        self.on_batch_end = on_batch_end
         self.global_lock = Lock()
-        self.concurrency_semaphore = None
+        # kept across runs, so the next run starts from the limit learned by the last one
+        self.concurrency = AIMDConcurrency(concurrency_limit, min_limit=min(min_concurrency, concurrency_limit)) if adaptive_concurrency \
+            else AIMDConcurrency(concurrency_limit, min_limit=concurrency_limit)
+        self.token_limiter = TokenRateLimiter(tokens_per_minute, default_limit=self._get_default_tokens_per_minute)
+        self.retry_policy = RetryPolicy(max_retries, retry_budget=retry_budget, backoff_base=backoff_base, backoff_max=backoff_max)
         self.pbar = None
         self.rate_limiter = None
 
-    def process_jobs(self, jobs: Dict[str, BrokerJobRequest], mock: bool = False):
-        if len(jobs) == 0: return
-        print(f"{repr(self)}: processing {len(jobs)} jobs.")
-        asyncio.run(self._process_all_tasks_async(jobs, mock=mock))
+    def process_jobs(self, jobs: Dict[str, BrokerJobRequest]|Iterable[BrokerJobRequest], mock: bool = False, n_jobs: int = None):
+        if isinstance(jobs, Mapping):
+            jobs, n_jobs = jobs.values(), len(jobs)
+        if n_jobs == 0: return
+        print(f"{repr(self)}: processing {n_jobs if n_jobs is not None else 'all queued'} jobs.")
+        try:
+            asyncio.run(self._process_all_tasks_async(jobs, mock=mock, n_jobs=n_jobs))
+        finally: # also on KeyboardInterrupt
+            self._ledger.flush()
 
     @abstractmethod
     async def _call_api_async(self, request: BrokerJobRequest, mock: bool)-> BrokerJobResponse:
@@ -54,63 +100,138 @@ class ConcurrentAPICallBroker(ImmediateBroker, ABC):
     def _output_and_reset_statistics(self):
         pass
 
-    async def _task_async(self, request: BrokerJobRequest, mock: bool):
+    def _get_token_charge(self, request: BrokerJobRequest)->Tuple[str,int]|None:
+        "(model, estimated tokens) charged to the token-per-minute limit before the call, None if not limited"
+        return None
+
+    def _get_token_usage(self, response: BrokerJobResponse)->int|None:
+        "tokens actually used by the call, to settle its charge"
+        return None
+
+    def _get_default_tokens_per_minute(self, model: str)->int|None:
+        "the limit of a model not given by tokens_per_minute"
+        return None
+
+    def get_metrics(self)->Dict:
+        "current concurrency limit, calls in flight, number of backoffs, of throttled calls, of waits for tokens and of retries"
+        return {**self.concurrency.get_metrics(), **self.token_limiter.get_metrics(), **self.retry_policy.get_metrics()}
+
+    async def _attempt_async(self, request: BrokerJobRequest, mock: bool)->Tuple[BrokerJobResponse|None, Exception|None]:
+        "make one call under the token and rate limits. called holding a concurrency slot, that it releases"
+        started_at, response, error = None, None, None
         try:
-            response = await self._call_api_async(request, mock=mock)
-        except Exception as e:
-            print(f"Error processing request {request.job_idx}: {e}")
+            token_charge = self._get_token_charge(request)
+            if token_charge is not None: # before the rate limiter, so waiting for tokens does not hold its slots
+                await self.token_limiter.acquire(*token_charge)
+            try:
+                async with self.rate_limiter:
+                    call_started_at = time.monotonic()
+                    try:
+                        response = await self._call_api_async(request, mock=mock)
+                    except Exception as e:
+                        error = e
+                    started_at = call_started_at
+            finally: # also refunded if cancelled
+                if token_charge is not None:
+                    self.token_limiter.settle(*token_charge, self._get_token_usage(response) if response is not None else None)
+        finally: # the limit is only adjusted on calls that completed
+            self.concurrency.release(started_at, error)
+        return response, error
+
+    async def _task_async(self, request: BrokerJobRequest, mock: bool):
+        "make the calls of the job, retrying transient errors, and record the outcome. called holding a concurrency slot"
+        self.retry_policy.on_job_started()
+        attempt, last_error = 0, None
+        while True:
+            response, error = await self._attempt_async(request, mock=mock)
+            attempt += 1
+            if error is None: break
+            last_error = error
+            delay = self.retry_policy.get_retry_delay(error, attempt)
+            if delay is None: break
+            await asyncio.sleep(delay) # without a slot, so other jobs proceed meanwhile
+            await self.concurrency.acquire()
+        meta = {**(request.meta or {}), "attempts": attempt}
+        if last_error is not None:
+            meta["last_error"] = f"{type(last_error).__name__}: {last_error}"
+            meta["last_error_kind"] = classify_api_error(last_error)[0]
+        if error is not None:
+            print(f"Error processing request {request.job_idx} after {attempt} attempt(s): {error}")
             response = BrokerJobResponse(
                 job_idx=request.job_idx,
                 status=BrokerJobStatus.FAILED,
                 response_object=None,
-                meta={**(request.meta or {}), "error": str(e)}
+                meta={"error": str(error)}
             )
         await self._ledger.update_one_async({
             "idx": request.job_idx,
             "status": response.status.value,
             "response": response.response_object.model_dump() if response.response_object else None,
-            "meta": {**(request.meta or {}), **(response.meta or {})},
+            "meta": {**meta, **(response.meta or {})},
         })
         async with self.global_lock:
             await self._update_statistics(self.pbar, request, response)
 
-    async def _worker(self, queue: asyncio.Queue, mock: bool):
+    async def _worker(self, requests: Iterator[BrokerJobRequest], mock: bool):
+        # the workers share the iterator, so requests are only read from the ledger when a call can start
         while True:
-            request = await queue.get()
+            await self.concurrency.acquire()
             try:
-                async with self.concurrency_semaphore:
-                    async with self.rate_limiter:
-                        await self._task_async(request, mock=mock)
-            finally:
-                queue.task_done()
-
-    async def _process_all_tasks_async(self, requests: Dict[str, BrokerJobRequest], mock: bool):
-        requests = list(requests.values())
-        if len(requests[::self.max_number_per_batch]) == 0: return
-        self.pbar = tqdm(total=len(requests))
-        self.concurrency_semaphore = Semaphore(self.concurrency_limit)
-        self.rate_limiter = AsyncLimiter(self.rate_limit, 1)
-        queue = asyncio.Queue()
-        for request in requests[::self.max_number_per_batch]:
-            queue.put_nowait(request)
+                request = next(requests, None)
+            except BaseException:
+                self.concurrency.release(None)
+                raise
+            if request is None:
+                self.concurrency.release(None)
+                return
+            await self._task_async(request, mock=mock)
+
+    async def _process_batch_async(self, requests: Iterator[BrokerJobRequest], mock: bool):
+        workers = []
         try:
             workers = [
-                asyncio.create_task(self._worker(queue, mock)) for _ in range(self.concurrency_limit)
+                asyncio.create_task(self._worker(requests, mock)) for _ in range(self.concurrency_limit)
             ]
-            await queue.join()
-            for w in workers:
-                w.cancel()
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                if not task.done():
+                    task.cancel()
+
+    async def _process_all_tasks_async(self, requests: Iterable[BrokerJobRequest], mock: bool, n_jobs: int = None):
+        requests = iter(requests)
+        self.pbar = tqdm(total=n_jobs)
+        self.rate_limiter = AsyncLimiter(self.rate_limit, 1)
+        self.retry_policy.reset()
+        n_batches, reported = 0, True
+        try:
+            while True:
+                first = next(requests, None)
+                if first is None: break
+                rest = islice(requests, self.max_number_per_batch - 1) if self.max_number_per_batch is not None else requests
+                reported = False
+                await self._process_batch_async(chain([first], rest), mock)
+                n_batches += 1
+                # the batch is durable before the next one starts
+                self._ledger.flush()
+                await self._output_and_reset_statistics()
+                reported = True
+                if self.max_batches_per_run is not None and n_batches >= self.max_batches_per_run:
+                    print(f"[{type(self).__name__}] Stopped after {n_batches} batches (max_batches_per_run), the remaining jobs stay queued.")
+                    break
+                if self.on_batch_end is not None and self.on_batch_end(n_batches, self.pbar.n) is False:
+                    print(f"[{type(self).__name__}] Stopped by on_batch_end after {n_batches} batches, the remaining jobs stay queued.")
+                    break
         except asyncio.CancelledError:
             print("Processing was cancelled.")
         finally:
             self.pbar.close()
-            self.concurrency_semaphore = None
             self.rate_limiter = None
             self.pbar = None
-            for task in workers:
-                if not task.done():
-                    task.cancel()
-            await self._output_and_reset_statistics()
+            self._ledger.flush()
+            if not reported:
+                await self._output_and_reset_statistics()
+            await llm_client_hub.close_async_clients() # the next run has its own event loop
 
         
 
@@ -0,0 +1,255 @@
+from typing import Callable, Dict, Literal, Tuple
+import asyncio
+import random
+import time
+
+INITIAL_CONCURRENCY=8 # requests in flight when an adaptive broker starts, doubled every round trip until the first congestion
+LATENCY_TOLERANCE=2.0 # no increase while the recent latency is above this multiple of the long-run latency
+DECREASE_FACTOR=0.5
+MIN_RETRY_BUDGET=10 # retries always allowed in a run, on top of retry_budget times the jobs started
+
+ErrorKind = Literal["throttle", "server", "timeout", "client", "other"]
+
+def classify_api_error(e:BaseException)->Tuple[ErrorKind, float|None]:
+    """
+    (kind, retry_after seconds or None) of an exception raised by an API call.
+    - throttle: 429. server: 5xx. timeout: timeouts and dropped connections. client: other 4xx. other: the rest
+    - retry_after is read from the Retry-After / retry-after-ms headers of the response, if any
+    works on the exceptions of the openai client and of httpx, by duck typing so neither is required
+    """
+    status_code = getattr(e, "status_code", None)
+    response = getattr(e, "response", None)
+    if status_code is None and response is not None:
+        status_code = getattr(response, "status_code", None)
+    retry_after = None
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        try:
+            if headers.get("retry-after-ms") is not None:
+                retry_after = float(headers.get("retry-after-ms")) / 1000
+            elif headers.get("retry-after") is not None:
+                retry_after = float(headers.get("retry-after"))
+        except (TypeError, ValueError): # an HTTP date, rarely used by API providers
+            retry_after = None
+    if isinstance(status_code, int):
+        if status_code == 429: return "throttle", retry_after
+        if status_code == 408: return "timeout", retry_after
+        if status_code >= 500: return "server", retry_after
+        if status_code >= 400: return "client", retry_after
+    names = {cls.__name__ for cls in type(e).__mro__}
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError, ConnectionError)) or names & {"APITimeoutError", "APIConnectionError", "TimeoutException", "NetworkError"}:
+        return "timeout", retry_after
+    return "other", retry_after
+
+class AIMDConcurrency:
+    """
+    Adaptive limit of the requests in flight, additive increase and multiplicative decrease.
+    - starts at initial_limit and doubles every round trip (slow start), until the first congestion
+    - then grows by one request per round trip, while the recent latency stays below
+        latency_tolerance times the long-run latency
+    - a throttle, a server error or a timeout multiplies the limit by decrease_factor, at most once per round trip:
+        the errors of requests started before the last decrease are not counted again
+    - a Retry-After hint also pauses the start of new requests for that long
+    - min_limit == max_limit gives a fixed limit, that still honors Retry-After
+    use it as `await acquire()`, then `release(started_at, error)` with the time.monotonic() the call started at,
+    error being None on success. started_at is None if no call was made, or it was cancelled
+    """
+    def __init__(self, max_limit:int, *, min_limit:int=1, initial_limit:int|None=None,
+                 latency_tolerance:float=LATENCY_TOLERANCE, decrease_factor:float=DECREASE_FACTOR):
+        if not 1 <= min_limit <= max_limit: raise ValueError(f"Expected 1 <= min_limit <= max_limit, got {min_limit} and {max_limit}")
+        if initial_limit is None: initial_limit = min(max_limit, max(min_limit, INITIAL_CONCURRENCY))
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.slow_start_threshold = float(max_limit)
+        self.paused_until = 0.0
+        self.recent_latency:float|None = None # ewma over a few requests
+        self.long_latency:float|None = None # ewma over many requests
+        self.n_decreases = 0
+        self.n_throttled = 0
+        self._last_decrease = float("-inf")
+        self._released:asyncio.Event|None = None
+        self._loop:asyncio.AbstractEventLoop|None = None # each process_jobs runs its own event loop, the limit is kept
+    @property
+    def current_limit(self)->int:
+        return max(self.min_limit, int(self.limit))
+    async def acquire(self):
+        "wait for a free slot"
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._released = loop, asyncio.Event()
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if self.in_flight < self.current_limit:
+                self.in_flight += 1
+                return
+            self._released.clear()
+            await self._released.wait()
+    def release(self, started_at:float|None, error:BaseException|None=None):
+        "free the slot taken by acquire(), adjusting the limit on the outcome of the call"
+        self.in_flight -= 1
+        if self._released is not None: self._released.set()
+        if started_at is None: return
+        now = time.monotonic()
+        kind, retry_after = classify_api_error(error) if error is not None else (None, None)
+        if kind == "throttle":
+            self.n_throttled += 1
+        if retry_after is not None and kind in ("throttle", "server", "timeout"):
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if kind in ("throttle", "server", "timeout"):
+            if started_at >= self._last_decrease:
+                self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                self.slow_start_threshold = self.limit
+                self._last_decrease = now
+                self.n_decreases += 1
+        elif kind is None:
+            self._update_latency(now - started_at)
+            if self.limit < self.slow_start_threshold:
+                self.limit = min(self.limit + 1, self.slow_start_threshold, float(self.max_limit))
+            elif self._latency_is_healthy():
+                self.limit = min(self.limit + 1 / self.limit, float(self.max_limit))
+    def _update_latency(self, latency:float):
+        if self.recent_latency is None:
+            self.recent_latency = self.long_latency = latency
+        else:
+            self.recent_latency += 0.2 * (latency - self.recent_latency)
+            self.long_latency += 0.02 * (latency - self.long_latency)
+    def _latency_is_healthy(self)->bool:
+        return self.recent_latency is None or self.recent_latency <= self.latency_tolerance * self.long_latency
+    def get_summary_str(self)->str:
+        return f"{self.in_flight}/{self.current_limit} in flight"
+    def get_metrics(self)->Dict[str, float|int]:
+        return {
+            "concurrency_limit": self.current_limit,
+            "in_flight": self.in_flight,
+            "n_decreases": self.n_decreases,
+            "n_throttled": self.n_throttled,
+            "recent_latency": self.recent_latency,
+        }
+
+class TokenBucket:
+    """
+    Token-per-minute budget, refilled continuously at tokens_per_minute / 60 per second up to burst (default a minute's worth).
+    - acquire(n) waits until the budget covers n, first come first served, then charges it.
+        a request larger than burst waits for a full bucket and leaves the budget in debt
+    - settle(charged, actual) refunds an overestimated charge, or charges the underestimated remainder
+    """
+    def __init__(self, tokens_per_minute:int, *, burst:int|None=None):
+        if tokens_per_minute <= 0: raise ValueError(f"Expected tokens_per_minute > 0, got {tokens_per_minute}")
+        self.tokens_per_minute = tokens_per_minute
+        self.capacity = float(burst if burst is not None else tokens_per_minute)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.n_waits = 0
+        self._lock:asyncio.Lock|None = None
+        self._loop:asyncio.AbstractEventLoop|None = None
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.tokens_per_minute / 60)
+        self.updated_at = now
+    async def acquire(self, n:int):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._lock = loop, asyncio.Lock()
+        async with self._lock: # waiting in the lock keeps the order, a large request is not starved by small ones
+            needed = min(float(n), self.capacity)
+            self._refill()
+            if self.tokens < needed:
+                self.n_waits += 1
+            while self.tokens < needed:
+                await asyncio.sleep((needed - self.tokens) * 60 / self.tokens_per_minute)
+                self._refill()
+            self.tokens -= n
+    def settle(self, charged:int, actual:int):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + charged - actual)
+
+class TokenRateLimiter:
+    """
+    TokenBuckets keyed by model@provider, as providers enforce a token-per-minute limit per model.
+    - tokens_per_minute: one limit for every model, or {model: limit}. models not in it get default_limit(model), None for no limit
+    """
+    def __init__(self, tokens_per_minute:int|Dict[str,int]|None=None, *,
+                 default_limit:Callable[[str],int|None]|None=None):
+        self.tokens_per_minute = tokens_per_minute
+        self.default_limit = default_limit
+        self.buckets:Dict[str,TokenBucket|None] = {}
+    def get_bucket(self, key:str)->TokenBucket|None:
+        if key not in self.buckets:
+            if isinstance(self.tokens_per_minute, dict):
+                limit = self.tokens_per_minute.get(key)
+            else:
+                limit = self.tokens_per_minute
+            if limit is None and self.default_limit is not None:
+                limit = self.default_limit(key)
+            self.buckets[key] = TokenBucket(limit) if limit else None
+        return self.buckets[key]
+    async def acquire(self, key:str, n:int):
+        bucket = self.get_bucket(key)
+        if bucket is not None: await bucket.acquire(n)
+    def settle(self, key:str, charged:int, actual:int|None):
+        "actual is None if the call failed, then the charge is refunded"
+        bucket = self.get_bucket(key)
+        if bucket is not None: bucket.settle(charged, actual if actual is not None else 0)
+    def get_metrics(self)->Dict[str, float|int]:
+        buckets = {key: bucket for key, bucket in self.buckets.items() if bucket is not None}
+        return {
+            "n_token_waits": sum(bucket.n_waits for bucket in buckets.values()),
+            "tokens_available": {key: int(bucket.tokens) for key, bucket in buckets.items()},
+        }
+
+class RetryPolicy:
+    """
+    When to retry a failed API call, and after how long.
+    - throttles, server errors and timeouts are retried, up to max_retries times per job.
+        other errors, e.g. a 400 on an invalid request, fail at once
+    - exponential backoff with full jitter: a random delay up to backoff_base * 2**(attempt-1), at most backoff_max,
+        but no shorter than the Retry-After hint of the error
+    - retries of a run are capped at MIN_RETRY_BUDGET + retry_budget * the jobs started,
+        so an outage fails the jobs instead of multiplying the calls
+    """
+    retryable_kinds = ("throttle", "server", "timeout")
+    def __init__(self, max_retries:int=4, *, retry_budget:float=0.2, backoff_base:float=1.0, backoff_max:float=60.0):
+        if max_retries < 0: raise ValueError(f"Expected max_retries >= 0, got {max_retries}")
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.reset()
+    def reset(self):
+        "start the budget of a new run"
+        self.n_jobs = 0
+        self.n_retries = 0
+        self.budget_exhausted = False
+    def on_job_started(self):
+        self.n_jobs += 1
+    def get_retry_delay(self, error:BaseException, attempt:int)->float|None:
+        "seconds to wait before retrying the job that failed its attempt-th call with error, None to give up"
+        kind, retry_after = classify_api_error(error)
+        if kind not in self.retryable_kinds or attempt > self.max_retries:
+            return None
+        if self.n_retries >= MIN_RETRY_BUDGET + self.retry_budget * self.n_jobs:
+            self.budget_exhausted = True
+            return None
+        self.n_retries += 1
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        return max(delay, retry_after or 0.0)
+    def get_metrics(self)->Dict[str, float|int]:
+        return {
+            "n_retries": self.n_retries,
+            "retry_budget_exhausted": self.budget_exhausted,
+        }
+
+__all__ = [
+    "AIMDConcurrency",
+    "RetryPolicy",
+    "TokenBucket",
+    "TokenRateLimiter",
+    "classify_api_error",
+]
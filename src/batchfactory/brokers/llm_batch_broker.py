@@ -0,0 +1,203 @@
+from ..core.broker import DeferredBroker, BrokerJobRequest, BrokerJobResponse, BrokerJobStatus
+from ..lib.llm_backend import *
+from ..lib.llm_backend import compute_llm_cost, get_provider_name, get_model_name
+from ..lib.utils import _to_record
+
+from typing import List,Iterable,Dict,Mapping,Tuple
+from openai import OpenAI
+import json
+import time
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+MAX_REQUESTS_PER_BATCH = 50_000 # limits of the OpenAI Batch API
+MAX_BYTES_PER_BATCH = 190 << 20 # under the 200MB limit of an input file
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+class LLMBatchBroker(DeferredBroker):
+    """
+    Sends the LLM requests through the Batch API of OpenAI compatible providers, for half the price and no rate limits,
+    with results within the completion_window.
+    - dispatch_jobs packs the queued requests of each model into JSONL files of at most max_requests_per_batch,
+        uploads them and creates the batches. the jobs are then waiting, with their batch_id in the meta
+    - collect_jobs polls the batches of the waiting jobs once, and records the results of the finished ones.
+        the cost is computed at the batch price. requests a batch did not answer, e.g. once expired, fail
+    - wait_for_jobs polls until no job is waiting
+    """
+    def __init__(self,
+                    cache_path:str,
+                    *,
+                    completion_window:str="24h",
+                    max_requests_per_batch:int=MAX_REQUESTS_PER_BATCH,
+                    max_bytes_per_batch:int=MAX_BYTES_PER_BATCH,
+                    compression:str|None=None,
+                    ledger_profile:str|None=None,
+    ):
+        super().__init__(cache_path=cache_path, request_cls=LLMRequest, response_cls=LLMResponse,
+                         compression=compression, ledger_profile=ledger_profile)
+        self.completion_window = completion_window
+        self.max_requests_per_batch = max_requests_per_batch
+        self.max_bytes_per_batch = max_bytes_per_batch
+        self.token_counter = LLMTokenCounter()
+
+    def dispatch_jobs(self, jobs:Dict[str,BrokerJobRequest]|Iterable[BrokerJobRequest], mock:bool=False)->None:
+        if isinstance(jobs, Mapping): jobs = jobs.values()
+        if mock:
+            self._ledger.update_many_sync({job.job_idx: self._make_record(job, BrokerJobStatus.DONE,
+                                            response=_get_dummy_batch_response(job.request_object)) for job in jobs})
+            return
+        pending:Dict[str,Tuple[List[BrokerJobRequest],List[bytes],int]] = {} # {model: (jobs, lines, bytes)}
+        for job in jobs:
+            llm_request:LLMRequest = job.request_object
+            line = json.dumps(_to_batch_line(job.job_idx, llm_request), ensure_ascii=False).encode() + b"\n"
+            batch_jobs, lines, n_bytes = pending.get(llm_request.model, ([], [], 0))
+            if batch_jobs and (len(batch_jobs) >= self.max_requests_per_batch or n_bytes + len(line) > self.max_bytes_per_batch):
+                self._submit_batch(llm_request.model, batch_jobs, lines)
+                batch_jobs, lines, n_bytes = [], [], 0
+            batch_jobs.append(job)
+            lines.append(line)
+            pending[llm_request.model] = (batch_jobs, lines, n_bytes + len(line))
+        for model, (batch_jobs, lines, _) in pending.items():
+            self._submit_batch(model, batch_jobs, lines)
+
+    def _submit_batch(self, model:str, jobs:List[BrokerJobRequest], lines:List[bytes]):
+        client:OpenAI = llm_client_hub.get_client(get_provider_name(model), async_=False)
+        input_file = None
+        try:
+            input_file = client.files.create(file=(f"batch_{int(time.time())}.jsonl", b"".join(lines), "application/jsonl"),
+                                             purpose="batch")
+            batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                          completion_window=self.completion_window)
+        except Exception as e: # the jobs stay queued, and are submitted again by the next dispatch
+            print(f"[LLMBatchBroker] Failed to submit a batch of {len(jobs)} {model} requests: {e}")
+            if input_file is not None: # not left behind on the provider by every failed dispatch
+                try:
+                    client.files.delete(input_file.id)
+                except Exception as e:
+                    print(f"[LLMBatchBroker] Failed to delete the input file {input_file.id}: {e}")
+            return
+        # nothing records the batch until the write below. if the process dies in between, the jobs are still queued,
+        # and the next dispatch submits and pays for them again. the orphan batch can be found by its input_file_id
+        print(f"[LLMBatchBroker] Submitted batch {batch.id} of {len(jobs)} {model} requests.")
+        self._ledger.update_many_sync({job.job_idx: self._make_record(job, BrokerJobStatus.WAITING,
+                                        meta={"batch_id": batch.id, "input_file_id": input_file.id}) for job in jobs})
+
+    def collect_jobs(self)->None:
+        waiting:Dict[str,Dict[str,BrokerJobRequest]] = {} # {batch_id: {job_idx: job}}
+        for job in self.iter_job_requests(BrokerJobStatus.WAITING):
+            waiting.setdefault(job.meta["batch_id"], {})[job.job_idx] = job
+        for batch_id, jobs in waiting.items():
+            model = next(iter(jobs.values())).request_object.model
+            client:OpenAI = llm_client_hub.get_client(get_provider_name(model), async_=False)
+            try:
+                batch = client.batches.retrieve(batch_id)
+            except Exception as e:
+                print(f"[LLMBatchBroker] Failed to poll batch {batch_id}: {e}")
+                continue
+            if batch.status not in BATCH_TERMINAL_STATUSES:
+                counts = batch.request_counts
+                progress = f"{counts.completed + counts.failed}/{counts.total}" if counts is not None else ""
+                print(f"[LLMBatchBroker] Batch {batch_id} is {batch.status} {progress}")
+                continue
+            records = {}
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if file_id is None: continue
+                for line in client.files.content(file_id).text.splitlines():
+                    if not line.strip(): continue
+                    result = json.loads(line)
+                    job = jobs.get(result.get("custom_id"))
+                    if job is None: continue
+                    records[job.job_idx] = self._make_result_record(job, result)
+            for job_idx, job in jobs.items():
+                if job_idx not in records:
+                    records[job_idx] = self._make_record(job, BrokerJobStatus.FAILED, meta={"error": _get_batch_error(batch)})
+            self._ledger.update_many_sync(records)
+            n_failed = sum(record["status"] == BrokerJobStatus.FAILED.value for record in records.values())
+            print(f"[LLMBatchBroker] Batch {batch_id} is {batch.status}: {len(records) - n_failed} done, {n_failed} failed.")
+        if waiting:
+            print(f"Token usage: {self.token_counter.get_summary_str()}")
+            self.token_counter.reset()
+
+    def wait_for_jobs(self, poll_interval:float=60, timeout:float|None=None)->bool:
+        "collect_jobs until no job is waiting, returns False on timeout"
+        time_start = time.monotonic()
+        while True:
+            self.collect_jobs()
+            if self.count_job_requests(BrokerJobStatus.WAITING) == 0:
+                return True
+            if timeout is not None and time.monotonic() - time_start + poll_interval > timeout:
+                return False
+            time.sleep(poll_interval)
+
+    def _make_result_record(self, job:BrokerJobRequest, result:Dict)->Dict:
+        "ledger record of the job from a line of the output or error file of its batch"
+        response = result.get("response") or {}
+        body = response.get("body") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            error = result.get("error") or body.get("error") or {}
+            message = error.get("message", error) if isinstance(error, dict) else error
+            return self._make_record(job, BrokerJobStatus.FAILED,
+                                     meta={"error": f"{response.get('status_code')}: {message}"})
+        llm_response = _from_batch_body(job.request_object, body)
+        self.token_counter.update(input_tokens=llm_response.prompt_tokens, output_tokens=llm_response.completion_tokens,
+                                  cost=llm_response.cost)
+        return self._make_record(job, BrokerJobStatus.DONE, response=llm_response)
+
+    def _make_record(self, job:BrokerJobRequest, status:BrokerJobStatus, *, response:LLMResponse|None=None, meta:Dict|None=None)->Dict:
+        record = {
+            "idx": job.job_idx,
+            "status": status.value,
+            "response": response.model_dump() if response is not None else None,
+            "meta": {**(job.meta or {}), **(meta or {})},
+        }
+        if status != BrokerJobStatus.DONE: # a failed job may be dispatched again, see BrokerFailureBehavior.RETRY
+            record["request"] = _to_record(job.request_object)
+        return record
+
+def _to_batch_line(custom_id:str, llm_request:LLMRequest)->Dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": get_model_name(llm_request.model),
+            "messages": [message.model_dump() for message in llm_request.messages],
+            "max_completion_tokens": llm_request.max_completion_tokens,
+        },
+    }
+
+def _from_batch_body(llm_request:LLMRequest, body:Dict)->LLMResponse:
+    message = body["choices"][0]["message"]
+    usage = body["usage"]
+    return LLMResponse(
+        custom_id=llm_request.custom_id,
+        model=llm_request.model,
+        message=LLMMessage(role=message["role"], content=message["content"] or ""),
+        prompt_tokens=usage["prompt_tokens"],
+        completion_tokens=usage["completion_tokens"],
+        cost=compute_llm_cost(
+            prompt_tokens=usage["prompt_tokens"],
+            completion_tokens=usage["completion_tokens"],
+            model=llm_request.model,
+            is_batch=True
+        )
+    )
+
+def _get_batch_error(batch)->str:
+    errors = getattr(batch.errors, "data", None) if batch.errors is not None else None
+    if errors:
+        return f"batch {batch.status}: " + "; ".join(str(error.message) for error in errors)
+    return f"batch {batch.status} without a result for the request"
+
+def _get_dummy_batch_response(llm_request:LLMRequest)->LLMResponse:
+    return LLMResponse(
+        custom_id=llm_request.custom_id,
+        model=llm_request.model,
+        message=LLMMessage(role='assistant', content=f"Dummy response for {llm_request.custom_id}"),
+        prompt_tokens=1,
+        completion_tokens=1,
+        cost=compute_llm_cost(prompt_tokens=1, completion_tokens=1, model=llm_request.model, is_batch=True)
+    )
+
+__all__ = [
+    "LLMBatchBroker",
+]
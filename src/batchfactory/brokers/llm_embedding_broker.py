@@ -1,10 +1,11 @@
 from .concurrent_api_call_broker import ConcurrentAPICallBroker
 from ..core.broker import BrokerJobRequest, BrokerJobResponse, BrokerJobStatus
 from ..lib.llm_backend import *
+from ..lib.model_list import model_desc
 from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletion
 
-from typing import List,Iterable,Dict
+from typing import List,Iterable,Dict,Callable
 import asyncio
 from tqdm.auto import tqdm
 
@@ -14,14 +15,40 @@ class LLMEmbeddingBroker(ConcurrentAPICallBroker):
                 *,
                 concurrency_limit:int=256,
                 rate_limit:int=32,
-                max_number_per_batch:int=None
+                max_number_per_batch:int=None,
+                max_batches_per_run:int=None,
+                on_batch_end:Callable[[int,int],bool|None]|None=None,
+                adaptive_concurrency:bool=True,
+                min_concurrency:int=1,
+                tokens_per_minute:int|Dict[str,int]|None=None,
+                max_retries:int=4,
+                retry_budget:float=0.2,
+                backoff_base:float=1.0,
+                backoff_max:float=60.0,
+                flush_every:int=256,
+                flush_interval_ms:float=50,
+                compression:str|None=None,
+                ledger_profile:str|None=None,
     ):
         super().__init__(cache_path=cache_path,
                          request_cls=LLMEmbeddingRequest,
                          response_cls=LLMEmbeddingResponse,
                          concurrency_limit=concurrency_limit,
                          rate_limit=rate_limit,
-                         max_number_per_batch=max_number_per_batch
+                         max_number_per_batch=max_number_per_batch,
+                         max_batches_per_run=max_batches_per_run,
+                         on_batch_end=on_batch_end,
+                         adaptive_concurrency=adaptive_concurrency,
+                         min_concurrency=min_concurrency,
+                         tokens_per_minute=tokens_per_minute,
+                         max_retries=max_retries,
+                         retry_budget=retry_budget,
+                         backoff_base=backoff_base,
+                         backoff_max=backoff_max,
+                         flush_every=flush_every,
+                         flush_interval_ms=flush_interval_ms,
+                         compression=compression,
+                         ledger_profile=ledger_profile,
         )
         self.token_counter = LLMTokenCounter()
     async def _call_api_async(self, request: BrokerJobRequest, mock: bool) -> BrokerJobResponse:
@@ -32,6 +59,14 @@ class LLMEmbeddingBroker(ConcurrentAPICallBroker):
             status=BrokerJobStatus.DONE if embedding_response else BrokerJobStatus.FAILED,
             response_object=embedding_response,
         )
+    def _get_token_charge(self, request: BrokerJobRequest):
+        embedding_request: LLMEmbeddingRequest = request.request_object
+        return embedding_request.model, estimate_tokens(embedding_request.input_text)
+    def _get_token_usage(self, response: BrokerJobResponse):
+        embedding_response: LLMEmbeddingResponse = response.response_object
+        return embedding_response.prompt_tokens if embedding_response is not None else None
+    def _get_default_tokens_per_minute(self, model: str):
+        return model_desc.get(model, {}).get('tokens_per_minute', None)
     async def _update_statistics(self, pbar: tqdm | None,
                                  request: BrokerJobRequest, response: BrokerJobResponse):
         if response.response_object is not None:
@@ -42,7 +77,7 @@ class LLMEmbeddingBroker(ConcurrentAPICallBroker):
                 cost=embedding_response.cost,
             )
         if pbar:
-            pbar.set_postfix_str(self.token_counter.get_summary_str())
+            pbar.set_postfix_str(f"{self.token_counter.get_summary_str()} {self.concurrency.get_summary_str()}")
             pbar.update(1)
     async def _output_and_reset_statistics(self):
         print(f"Token usage: {self.token_counter.get_summary_str()}")
@@ -2,6 +2,9 @@ from .broker import *
 from .entry import *
 from .base_op import *
 from .ledger import *
+from .ledger_engine import *
 from .executor import *
+from .profiler import *
+from .op_fusion import *
 from .op_graph import *
 from .project_folder import *
\ No newline at end of file
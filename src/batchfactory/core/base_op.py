@@ -3,6 +3,7 @@ from abc import ABC, abstractmethod
 from typing import Union, List, Any, Tuple, Iterator, TYPE_CHECKING, Dict, NamedTuple, Set, Iterator
 from .entry import Entry
 from ..lib.utils import _make_list_of_list, ReprUtil
+from itertools import islice
 if TYPE_CHECKING:
     from .op_graph import Graph
 
@@ -16,8 +17,14 @@ class PumpOptions(NamedTuple):
     dispatch_brokers:bool=False
     mock:bool=False
     max_barrier_level:int|None=None
+    emit_budget:int|None=None # streaming mode: max number of entries a SourceOp may emit in this pump
 
 class BaseOp(ABC):
+    mutates_inputs:bool = True
+        # if False, the executor hands over the cached entries without copying them (copy-on-write).
+        # such ops must not modify the input entries in-place, but can emit them unchanged.
+    stateless:bool = False
+        # if True, pump() only depends on its inputs and the op's arguments, so the executor can pump it on a worker thread or process.
     def __init__(self,*,n_in_ports:int,n_out_ports:int,barrier_level:int):
         self.n_in_ports= n_in_ports
         self.n_out_ports = n_out_ports
@@ -29,6 +36,12 @@ class BaseOp(ABC):
     def compact(self):
         "Finalize and compress the cache"
         pass
+    def state_dict(self)->Dict[str,Any]:
+        "Run state not persisted elsewhere, saved in executor snapshots. Must be msgpack serializable."
+        return {}
+    def load_state_dict(self, state:Dict[str,Any])->None:
+        "Restore the run state from an executor snapshot, called after reset()"
+        pass
     @abstractmethod
     def pump(self,inputs:Dict[int,Dict[str,Entry]],options:PumpOptions) -> PumpOutput:
         """
@@ -55,6 +68,7 @@ class BaseOp(ABC):
 
 class ApplyOp(BaseOp, ABC):
     "Modifies entries in-place; maps each idx → same idx."
+    stateless = True
     def __init__(self):
         super().__init__(n_in_ports=1, n_out_ports=1, barrier_level=0)
     @abstractmethod
@@ -72,6 +86,8 @@ class ApplyOp(BaseOp, ABC):
 
 class FilterOp(BaseOp, ABC):
     "Drops some entries, keeps others unchanged."
+    stateless = True
+    mutates_inputs = False
     def __init__(self,*,consume_rejected:bool):
         super().__init__(n_in_ports=1, n_out_ports=1, barrier_level=0)
         self.consume_rejected = consume_rejected
@@ -91,6 +107,7 @@ class FilterOp(BaseOp, ABC):
     
 class RouterOp(BaseOp, ABC):
     "Merges entries of same idx from N ports, then duplicate or route them to M out ports."
+    stateless = True
     def __init__(self,*, n_in_ports: int, n_out_ports: int, wait_all:bool):
         super().__init__(n_in_ports=n_in_ports, n_out_ports=n_out_ports, barrier_level=0)
         self.wait_all = wait_all
@@ -144,11 +161,29 @@ class SourceOp(BaseOp, ABC):
     def __init__(self,*,fire_once:bool):
         super().__init__(n_in_ports=0, n_out_ports=1, barrier_level=0)
         self.fire_once = fire_once
+        self._stream:Iterator[Entry]|None = None # pending entries in streaming mode
+        self._n_emitted = 0 # number of entries taken from self._stream
+    def reset(self):
+        super().reset()
+        self._stream = None
+        self._n_emitted = 0
+    def state_dict(self):
+        return {"pending": self._stream is not None, "n_emitted": self._n_emitted}
+    def load_state_dict(self, state):
+        "generators cannot be saved, so a pending stream is restarted and fast-forwarded"
+        self._n_emitted = state.get("n_emitted", 0)
+        if state.get("pending"):
+            self._stream = islice(iter(self.generate_batch()), self._n_emitted, None)
     @abstractmethod
     def generate_batch(self)-> Iterator[Entry]:
         pass
+    def has_pending_entries(self)->bool:
+        "In streaming mode, whether generate_batch is not exhausted yet."
+        return self._stream is not None
     def pump(self, inputs, options: PumpOptions) -> PumpOutput:
         outputs, consumed, did_emit = {0:{}}, {0:set()}, False
+        if options.emit_budget is not None:
+            return self._pump_stream(options)
         if self.fire_once and not options.reload_inputs:
             return PumpOutput(outputs=outputs, consumed=consumed, did_emit=did_emit)
         for entry in self.generate_batch():
@@ -156,6 +191,24 @@ class SourceOp(BaseOp, ABC):
             consumed[0].add(entry.idx)
             did_emit = True
         return PumpOutput(outputs=outputs, consumed=consumed, did_emit=did_emit)
+    def _pump_stream(self, options: PumpOptions) -> PumpOutput:
+        "emit a micro-batch of at most options.emit_budget entries, resume from the same position in the next pump"
+        outputs, consumed, did_emit = {0:{}}, {0:set()}, False
+        if options.reload_inputs or (self._stream is None and not self.fire_once):
+            self._stream = iter(self.generate_batch())
+            self._n_emitted = 0
+        if self._stream is None or options.emit_budget <= 0:
+            return PumpOutput(outputs=outputs, consumed=consumed, did_emit=did_emit)
+        n_emitted = 0
+        for entry in islice(self._stream, options.emit_budget):
+            outputs[0][entry.idx] = entry
+            consumed[0].add(entry.idx)
+            n_emitted += 1
+            did_emit = True
+        self._n_emitted += n_emitted
+        if n_emitted < options.emit_budget:
+            self._stream = None
+        return PumpOutput(outputs=outputs, consumed=consumed, did_emit=did_emit)
     
 class BatchOp(BaseOp, ABC):
     "Batch-level shuffle/crosstalk, might drop or insert entries of different idxs."
@@ -182,6 +235,7 @@ class BatchOp(BaseOp, ABC):
     
 class OutputOp(BatchOp, ABC):
     "Outputs a batch to disk/console/etc, then sends it to the next node unmodified."
+    mutates_inputs = False
     def __init__(self,*,barrier_level=1):
         super().__init__(consume_all_batch=True, barrier_level=barrier_level)
     @abstractmethod
@@ -197,6 +251,7 @@ class OutputOp(BatchOp, ABC):
 
 class SpawnOp(BaseOp, ABC):
     "Create spawn entries on out_port 1, keep master entry unchanged."
+    stateless = True
     def __init__(self):
         super().__init__(n_in_ports=1, n_out_ports=2, barrier_level=0)
     @abstractmethod
@@ -215,6 +270,7 @@ class SpawnOp(BaseOp, ABC):
 
 class CollectAllOp(BaseOp, ABC):
     "Update master entry from spawn entries collected from in_port 1. Wait if spawn entries are not ready."
+    stateless = True
     def __init__(self,*,consume_spawns:bool):
         n_out_ports = 1 if consume_spawns else 2
         super().__init__(n_in_ports=2, n_out_ports=n_out_ports, barrier_level=0)
@@ -27,10 +27,11 @@ class BrokerJobResponse(NamedTuple):
     meta: Dict|None = None
 
 class Broker(ABC):
-    def __init__(self, cache_path: str, request_cls:type[BaseModel]=None, response_cls:type[BaseModel]=None):
+    def __init__(self, cache_path: str, request_cls:type[BaseModel]=None, response_cls:type[BaseModel]=None,
+                 compression:str|None=None, ledger_profile:str|None=None):
         self.request_cls = request_cls
         self.response_cls = response_cls
-        self._ledger = Ledger(cache_path)
+        self._ledger = Ledger(cache_path, compression=compression, profile=ledger_profile)
         self.verbose=0
     def compact(self):
         self._ledger.compact()
@@ -48,9 +49,8 @@ class Broker(ABC):
         self._ledger.remove_many(job_idxs)
 
     def get_job_responses(self)->Dict[str,BrokerJobResponse]:
-        return self._ledger.filter_many(
-            lambda x: BrokerJobStatus(x["status"]).is_terminal(),
-            filter_before_build=True,
+        return self._ledger.filter_by_status(
+            [status for status in BrokerJobStatus if status.is_terminal()],
             builder=lambda record: BrokerJobResponse(
                     job_idx=record["idx"],
                     status=BrokerJobStatus(record["status"]),
@@ -60,17 +60,26 @@ class Broker(ABC):
         )
     
     def get_job_requests(self, status:Iterable[BrokerJobStatus]|BrokerJobStatus)->Dict[str,BrokerJobRequest]:
+        return {request.job_idx: request for request in self.iter_job_requests(status)}
+
+    def iter_job_requests(self, status:Iterable[BrokerJobStatus]|BrokerJobStatus)->Iterator[BrokerJobRequest]:
+        "like get_job_requests, but reads the ledger page by page. jobs updated during the iteration are skipped"
         if isinstance(status,(BrokerJobStatus,str)): status = [status]
-        return self._ledger.filter_many(
-            lambda x: BrokerJobStatus(x["status"]) in status,
-            filter_before_build=True,
+        for _, request in self._ledger.iter_by_status(
+            [BrokerJobStatus(s) for s in status],
             builder=lambda record: BrokerJobRequest(
                 job_idx=record["idx"],
                 status=BrokerJobStatus(record["status"]),
                 request_object=_to_BaseModel(record["request"], self.request_cls, allow_None=False),
                 meta=record.get("meta", {}),
             )
-        )
+        ):
+            yield request
+
+    def count_job_requests(self, status:Iterable[BrokerJobStatus]|BrokerJobStatus)->int:
+        if isinstance(status,(BrokerJobStatus,str)): status = [status]
+        counts = self._ledger.count_by_status()
+        return sum(counts.get(BrokerJobStatus(s).value, 0) for s in status)
     
     def __repr__(self):
         return f"{self.__class__.__name__}({self._ledger.path})"
@@ -104,9 +113,10 @@ class DeferredBroker(Broker, ABC):
 
 class ImmediateBroker(Broker, ABC):
     @abstractmethod
-    def process_jobs(self, jobs:Dict[str,BrokerJobRequest], mock:bool=False)->None:
+    def process_jobs(self, jobs:Dict[str,BrokerJobRequest]|Iterable[BrokerJobRequest], mock:bool=False, n_jobs:int|None=None)->None:
         """
             Process the requests.
+            jobs might be an iterator such as iter_job_requests(), consumed lazily. n_jobs is then its length, if known.
             Example include
                 - spawning a thread pool for concurrency api calls
             This will block the main thread until all requests are processed.
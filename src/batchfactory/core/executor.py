@@ -1,98 +1,240 @@
-from .base_op import BaseOp, PumpOutput, PumpOptions
+from .base_op import BaseOp, PumpOutput, PumpOptions, SourceOp
 from .entry import Entry
-from .base_op import BaseOp
-from .op_graph import OpGraphEdge, Graph
+from .op_graph import OpGraphEdge, Graph, OpGraphPlan
+from .port_buffer import PortBuffer, estimate_entry_size
+from .profiler import ExecutorProfile
+from .op_fusion import FusedOp
+from .executor_snapshot import save_snapshot, load_snapshot
 
 from typing import List, Tuple, NamedTuple, Dict, Set
+from concurrent.futures import Executor, ProcessPoolExecutor
 from copy import deepcopy
 import time
-from collections import defaultdict
+import heapq
 import gc
+import tempfile
+import os
 
 
 
 class OpGraphExecutor:
     def __init__(self, graph:Graph):
         self.reset_graph(graph)
-        self.output_cache:Dict[Tuple[BaseOp,int],Dict[str,Entry]] = {}
+        self.output_cache:Dict[Tuple[BaseOp,int],PortBuffer] = {}
         self.output_revs:Dict[Tuple[BaseOp,int],Dict[str,int]] = {}  # used to reject entry with the same revision emitted twice in the same run
         self.verbose=0
-    def reset_graph(self, graph:Graph):
+        self.n_node_pumps = 0 # number of node pumps in the last execute(), for benchmarking the scheduler
+        self.max_inflight:int|None = None # streaming mode if not None
+        self.peak_inflight = 0 # max number of entries held in port buffers during the last execute()
+        self.pool:Executor|None = None # if not None, independent stateless nodes are pumped concurrently on it
+        self.profile = ExecutorProfile() # replaced by execute(profile=...)
+        self.memory_budget:int|None = None # bytes held by the port buffers before spilling them to disk
+        self.spill_dir:str|None = None
+        self._spill_tempdir:tempfile.TemporaryDirectory|None = None
+        self._build_schedule()
+    def reset_graph(self, graph:Graph, fuse_ops:bool=False):
         self.graph = graph
+        self.plan:OpGraphPlan = graph.compile(fuse_ops=fuse_ops)
+    def _build_schedule(self):
+        """
+        Worklist scheduler state.
+        - nodes are pumped in the order of self.nodes, but only if they are dirty
+        - a node is dirty if one of its input ports received new entries since its last pump
+        - entries emitted to a node earlier in the order (loop back edges) are pumped in the next pass
+        """
+        self._order:Dict[BaseOp,int] = self.plan.order
+        self._always_dirty:List[BaseOp] = [node for node in self.nodes if node.n_in_ports == 0 and not getattr(node, "fire_once", True)]
+        self._dirty:Set[BaseOp] = set(self.nodes)
+        self._worklist:List[int]|None = None
+        self._in_worklist:Set[int] = set()
+        self._cursor = -1
+        self._last_options_key = None
+        self._stream_sources:List[SourceOp] = [node for node in self.nodes if isinstance(node, SourceOp)]
+    def _mark_dirty(self, node:BaseOp):
+        i = self._order[node]
+        if self._worklist is not None and i > self._cursor:
+            if i not in self._in_worklist:
+                heapq.heappush(self._worklist, i)
+                self._in_worklist.add(i)
+        else:
+            self._dirty.add(node)
+    def n_inflight(self)->int:
+        "number of entries held in port buffers"
+        return sum(len(port_entries) for port_entries in self.output_cache.values())
+    def _has_pending_sources(self)->bool:
+        return any(node.has_pending_entries() for node in self._stream_sources)
+    def _has_pending_inputs(self, node:BaseOp)->bool:
+        return any(self.output_cache.get((edge.source, edge.source_port)) for edge in self.incoming_edges(node))
     @property
-    def nodes(self)->List[BaseOp]: return self.graph.nodes
+    def nodes(self)->List[BaseOp]: return self.plan.nodes
     @property
-    def edges(self)->List[OpGraphEdge]: return self.graph.edges
+    def edges(self)->List[OpGraphEdge]: return self.plan.edges
     @property
     def tail(self)->BaseOp: return self.graph.tail
     def _pump_node(self,node:BaseOp,options:PumpOptions)->bool:
         if options.max_barrier_level is not None and node.barrier_level > options.max_barrier_level:
             return False
+        if self.max_inflight is not None and node.n_in_ports == 0:
+            # backpressure: sources only refill the port buffers up to max_inflight entries
+            options = options._replace(emit_budget=max(self.max_inflight - self.n_inflight(), 0))
         _gc_toggled = False
+        self.profile.set_current(node)
         try:
             time_start = time.perf_counter()
-            inputs:Dict[int,Dict[str,Entry]] = self._collect_node_inputs(node, use_deepcopy=True)
-            self._time_prof[f"collect node inputs for {node}"] += time.perf_counter() - time_start
+            inputs:Dict[int,Dict[str,Entry]] = self._collect_node_inputs(node, use_deepcopy=node.mutates_inputs)
+            self._record_collect(node, inputs, time_start)
 
             # turn off gc if inputs is very large
             if gc.isenabled() and sum(len(batch) for batch in inputs.values()) > 10000:
                 gc.disable()
                 _gc_toggled = True
 
-            time_start = time.perf_counter()
-            pump_output:PumpOutput = node.pump(inputs=inputs, options=options)
-            self._time_prof[f"pump node {node}"] += time.perf_counter() - time_start
+            pump_output, time_start, duration = _timed_pump(node, inputs, options)
+            self._record_pump(node, pump_output, time_start, duration)
 
             time_start = time.perf_counter()
             self._update_node_outputs(node, pump_output.outputs)
-            self._time_prof[f"update outputs for {node}"] += time.perf_counter() - time_start
+            self.profile.record(node, "update", time_start, time.perf_counter() - time_start)
+            self._enforce_memory_budget()
 
             time_start = time.perf_counter()
             del inputs
-            self._consume_node_inputs(node, pump_output.consumed)
-            self._time_prof[f"consume inputs for {node}"] += time.perf_counter() - time_start
+            n_consumed = self._consume_node_inputs(node, pump_output.consumed)
+            self.profile.record(node, "consume", time_start, time.perf_counter() - time_start, entries_consumed=n_consumed)
+            if self.max_inflight is not None:
+                self.peak_inflight = max(self.peak_inflight, self.n_inflight())
 
         except Exception as e:
             print(f"Exception while pumping node {node}: {e}")
             raise e
         finally:
             if _gc_toggled:
-                time_start = time.perf_counter()
                 gc.enable()
-                gc.collect()
-                self._time_prof[f"gc collect after {node}"] += time.perf_counter() - time_start
+                gc.collect() # recorded by the gc callback of the profile
+            self.profile.set_current(None)
         return pump_output.did_emit
 
+    def _record_collect(self, node, inputs, time_start):
+        duration = time.perf_counter() - time_start
+        counts = {"entries_in": sum(len(batch) for batch in inputs.values())}
+        if self.memory_budget is not None:
+            counts["entries_unspilled"] = sum(self.output_cache[edge.source, edge.source_port].n_spilled
+                for edge in self.incoming_edges(node) if (edge.source, edge.source_port) in self.output_cache)
+        if self.profile.measure_bytes and node.mutates_inputs:
+            counts["bytes_copied"] = sum(estimate_entry_size(entry) for batch in inputs.values() for entry in batch.values())
+        self.profile.record(node, "collect", time_start, duration, **counts)
+    def _record_pump(self, node, pump_output:PumpOutput, time_start, duration, tid=0):
+        self.profile.record(node, "pump", time_start, duration, tid=tid,
+            entries_out=sum(len(batch) for batch in pump_output.outputs.values()))
+        if isinstance(node, FusedOp) and not isinstance(self.pool, ProcessPoolExecutor):
+            node.record_steps(self.profile, time_start, tid=tid) # the steps pumped in another process are not visible here
+
+    def _pump_wave(self,wave:List[BaseOp],options:PumpOptions)->List[bool]:
+        """
+        Pump independent nodes at the same time, stateless nodes on self.pool and the others inline.
+        The outputs are merged in topological order, so the results do not depend on which node finishes first.
+        """
+        pump_outputs:Dict[BaseOp,PumpOutput] = {}
+        try:
+            inputs = {}
+            for node in wave:
+                time_start = time.perf_counter()
+                inputs[node] = self._collect_node_inputs(node, use_deepcopy=node.mutates_inputs)
+                self._record_collect(node, inputs[node], time_start)
+
+            futures = {node: self.pool.submit(_timed_pump, node, inputs[node], options) for node in wave if node.stateless}
+            for node in wave:
+                if node not in futures:
+                    self.profile.set_current(node)
+                    pump_outputs[node], time_start, duration = _timed_pump(node, inputs[node], options)
+                    self._record_pump(node, pump_outputs[node], time_start, duration)
+            self.profile.set_current(None)
+            for tid, (node, future) in enumerate(futures.items(), start=1):
+                pump_outputs[node], time_start, duration = future.result()
+                self._record_pump(node, pump_outputs[node], time_start, duration, tid=tid)
+            del inputs
+
+            for node in wave:
+                self._cursor = self._order[node]
+                time_start = time.perf_counter()
+                self._update_node_outputs(node, pump_outputs[node].outputs)
+                self.profile.record(node, "update", time_start, time.perf_counter() - time_start)
+                self._enforce_memory_budget()
+                time_start = time.perf_counter()
+                n_consumed = self._consume_node_inputs(node, pump_outputs[node].consumed)
+                self.profile.record(node, "consume", time_start, time.perf_counter() - time_start, entries_consumed=n_consumed)
+        except Exception as e:
+            print(f"Exception while pumping nodes {wave}: {e}")
+            raise e
+        return [pump_outputs[node].did_emit for node in wave]
+
+    def _pop_wave(self,options:PumpOptions,deferred:List[BaseOp])->List[BaseOp]:
+        """
+        Pop the next dirty node, and if a pool is given, every later dirty node independent of it:
+        - not downstream of a node in the wave, so its inputs are ready
+        - not upstream of a skipped node, so the skipped node sees the same inputs as in sequential pumping
+        """
+        def pop():
+            i = heapq.heappop(self._worklist)
+            self._in_worklist.discard(i)
+            node = self.nodes[i]
+            if options.max_barrier_level is not None and node.barrier_level > options.max_barrier_level:
+                deferred.append(node) # keep it dirty until its barrier level is reached
+                return None
+            return node
+        node = pop()
+        if node is None: return []
+        if self.pool is None or node.n_in_ports == 0:
+            return [node]
+        wave, skipped = [node], []
+        blocked = self.plan.descendants[self._order[node]]
+        for _ in range(len(self._worklist)):
+            candidate = pop()
+            if candidate is None: continue
+            j = self._order[candidate]
+            if blocked >> j & 1 or candidate.n_in_ports == 0:
+                skipped.append(j)
+                blocked |= self.plan.ancestors[j]
+            else:
+                wave.append(candidate)
+                blocked |= self.plan.descendants[j]
+        for j in skipped:
+            heapq.heappush(self._worklist, j)
+            self._in_worklist.add(j)
+        return wave
+
     def incoming_edge(self,node,port)->OpGraphEdge:
-        for edge in self.edges:
-            if edge.target == node and edge.target_port == port:
-                return edge
-        return None
+        return self.plan.in_edges.get((node, port))
     def incoming_edges(self,node)->List[OpGraphEdge]:
-        return [edge for edge in self.edges if edge.target == node]
+        return self.plan.in_edges_by_node.get(node, [])
     def outgoing_edges(self,node)->List[OpGraphEdge]:
-        return [edge for edge in self.edges if edge.source == node]
+        return self.plan.out_edges_by_node.get(node, [])
 
     def _collect_node_inputs(self,node:BaseOp,use_deepcopy:bool)->Dict[int,Dict[str,Entry]]:
         inputs:Dict[int,Dict[str,Entry]] = {port:{} for port in range(node.n_in_ports)}
         for edge in self.incoming_edges(node):
-            port_inputs = self.output_cache.setdefault((edge.source, edge.source_port), {})
+            port_inputs = self.output_cache.get((edge.source, edge.source_port))
+            if not port_inputs: continue
             for idx, entry in port_inputs.items():
                 if use_deepcopy:
                     entry = deepcopy(entry)
                 inputs.setdefault(edge.target_port, {})[idx] = entry
         return inputs
     
-    def _consume_node_inputs(self,node,consumed:Dict[int,Set[str]|bool]):
+    def _consume_node_inputs(self,node,consumed:Dict[int,Set[str]|bool])->int:
+        "returns the number of consumed entries"
+        n_consumed = 0
         for port, idxs in consumed.items():
             edge = self.incoming_edge(node, port)
             if edge is None: continue
+            port_entries = self.output_cache.get((edge.source, edge.source_port))
+            if not port_entries: continue
             if idxs is True:
-                time_start = time.perf_counter()
-                self.output_cache[(edge.source, edge.source_port)].clear()
+                n_consumed += len(port_entries)
+                port_entries.clear()
             elif isinstance(idxs, set):
-                src_entries = self.output_cache.get((edge.source, edge.source_port), {})
-                self.output_cache[(edge.source, edge.source_port)] =  {idx: entry for idx, entry in src_entries.items() if idx not in idxs}
+                n_consumed += port_entries.pop_many(idxs)
+        return n_consumed
 
     def _update_node_outputs(self,node,outputs:Dict[int,Dict[str,Entry]]):
         for port,batch in outputs.items():
@@ -100,72 +242,196 @@ class OpGraphExecutor:
                 self._update_node_output(node, port, idx, entry)
     
     def _update_node_output(self,node,port,idx,entry):
-        port_entries = self.output_cache.setdefault((node, port), {})
+        edge = self.plan.out_edges.get((node, port))
+        if edge is None and self.max_inflight is not None:
+            return # in streaming mode, entries leaving the graph are not kept
+        port_entries = self.output_cache.get((node, port))
+        if port_entries is None:
+            port_entries = self.output_cache[(node, port)] = self._make_port_buffer(node, port)
         port_revs = self.output_revs.setdefault((node, port), {})
         if idx in port_revs and entry.rev <= port_revs[idx]:
             return
-        if idx not in port_entries or entry.rev >= port_entries[idx].rev:
-            port_entries[idx] = entry
+        if idx not in port_entries or entry.rev >= port_entries.rev_of(idx):
+            port_entries.put(entry)
             port_revs[idx] = entry.rev
-            self._has_update_flag = True
+            if edge is not None:
+                self._mark_dirty(edge.target)
 
     def pump(self, options:PumpOptions)->int:
         """ 
-        Pump the graph, processing each node in order.
+        Pump the dirty nodes of the graph in order.
         Returns the max barrier level of the node that emitted an update, or None if no updates were emitted.
         """
+        options_key = (options.dispatch_brokers, options.mock)
+        if options_key != self._last_options_key:
+            # nodes holding unconsumed inputs might behave differently under new options, e.g. BrokerOp dispatching
+            for barrier_level, group in self.plan.barrier_groups.items():
+                if options.max_barrier_level is None or barrier_level <= options.max_barrier_level:
+                    self._dirty.update(node for node in group if self._has_pending_inputs(node))
+            self._last_options_key = options_key
+        self._dirty.update(self._always_dirty)
+        if self.max_inflight is not None:
+            self._dirty.update(node for node in self._stream_sources if node.has_pending_entries())
+        self._worklist = sorted(self._order[node] for node in self._dirty)
+        self._in_worklist = set(self._worklist)
+        self._dirty = set()
+        deferred = []
         max_emitted_barrier_level = None
-        for node in self.nodes:
-            self.verbose>=2 and print(f"[OpGraphExecutor] Pumping node {node} with barrier level {node.barrier_level}")
-            # time_start = time.perf_counter()
-            # try:
-            if options.max_barrier_level is not None and node.barrier_level > options.max_barrier_level:
-                continue
-            did_emit = self._pump_node(node, options)
-            if did_emit:
-                max_emitted_barrier_level = max(max_emitted_barrier_level or float('-inf'), node.barrier_level)
-            # except Exception as e:
-            #     print(f"Exception while pumping node {node}: {e}")
-            #     raise e
-            # self._time_prof[repr(node)] += time.perf_counter() - time_start
+        try:
+            while self._worklist:
+                wave = self._pop_wave(options, deferred)
+                if not wave: continue
+                self.verbose>=2 and print(f"[OpGraphExecutor] Pumping nodes {wave} with barrier levels {[node.barrier_level for node in wave]}")
+                if len(wave) == 1:
+                    self._cursor = self._order[wave[0]]
+                    did_emits = [self._pump_node(wave[0], options)]
+                else:
+                    did_emits = self._pump_wave(wave, options)
+                for node, did_emit in zip(wave, did_emits):
+                    self.n_node_pumps += 1
+                    if did_emit:
+                        max_emitted_barrier_level = max(max_emitted_barrier_level or float('-inf'), node.barrier_level)
+        finally:
+            self._worklist = None
+            self._cursor = -1
+            self._dirty.update(deferred)
         return max_emitted_barrier_level
+    def _make_port_buffer(self, node:BaseOp, port:int)->PortBuffer:
+        if self.memory_budget is None:
+            return PortBuffer()
+        if self.spill_dir is None:
+            self._spill_tempdir = tempfile.TemporaryDirectory(prefix="batchfactory_spill_")
+            self.spill_dir = self._spill_tempdir.name
+        return PortBuffer(track_size=True, spill_path=os.path.join(self.spill_dir, f"port_{self._order[node]}_{port}.sqlite"))
+    def _enforce_memory_budget(self):
+        "spill the largest port buffers until the entries held in memory fit in the memory budget"
+        if self.memory_budget is None: return
+        buffers = [(key, port_entries) for key, port_entries in self.output_cache.items() if port_entries.nbytes > 0]
+        nbytes = sum(port_entries.nbytes for _, port_entries in buffers)
+        if nbytes <= self.memory_budget: return
+        for (node, port), port_entries in sorted(buffers, key=lambda item: item[1].nbytes, reverse=True):
+            time_start = time.perf_counter()
+            n_entries, n_bytes = port_entries.spill()
+            self.profile.record(node, "spill", time_start, time.perf_counter() - time_start,
+                entries_spilled=n_entries, bytes_spilled=n_bytes)
+            self.verbose>=2 and print(f"[OpGraphExecutor] Spilled {n_entries} entries ({n_bytes} bytes) of {node} port {port} to disk")
+            nbytes -= n_bytes
+            if nbytes <= self.memory_budget: break
+    def _save_snapshot(self, path, barrier_level):
+        time_start = time.perf_counter()
+        try:
+            nbytes = save_snapshot(self, path, barrier_level)
+        except TypeError as e:
+            print(f"[OpGraphExecutor] Failed to save snapshot to {path}, entries must be msgpack serializable: {e}")
+            return
+        self.profile.record(None, "snapshot", time_start, time.perf_counter() - time_start, bytes=nbytes)
+        self.verbose>=1 and print(f"[OpGraphExecutor] Saved snapshot ({nbytes} bytes) to {path}")
+    def _load_snapshot(self, path)->int|None:
+        time_start = time.perf_counter()
+        barrier_level = load_snapshot(self, path)
+        self.profile.record(None, "load snapshot", time_start, time.perf_counter() - time_start)
+        if barrier_level is not None:
+            print(f"[OpGraphExecutor] Resumed from snapshot {path} at barrier level {barrier_level}")
+        return barrier_level
     def clear_output_cache(self):
+        for port_entries in self.output_cache.values():
+            port_entries.close()
         self.output_revs.clear()
         self.output_cache.clear()
     def reset(self):
         self.clear_output_cache()
         for node in self.nodes:
             node.reset()
+        self._build_schedule()
     def get_barrier_levels(self):
-        return sorted(set(n.barrier_level for n in self.nodes))
+        return sorted(self.plan.barrier_groups)
 
-    def execute(self, dispatch_brokers=False, mock=False, max_iterations = 1000, max_barrier_level:int|None = None, verbose=0, compact_after_finished=True):
-        barrier_levels = sorted(barrier_level
-            for barrier_level in {n.barrier_level for n in self.nodes} | {1}
-            if max_barrier_level is None or barrier_level <= max_barrier_level
-        )
+    def execute(self, dispatch_brokers=False, mock=False, max_iterations = 1000, max_barrier_level:int|None = None, verbose=0, compact_after_finished=True,
+                stream=False, max_inflight:int=10000, pool:Executor|None=None, profile:ExecutorProfile|None=None, fuse_ops=False,
+                memory_budget:int|None=None, spill_dir:str|None=None, snapshot_path:str|None=None, snapshot_interval:float=60.0):
+        """
+        - snapshot_path: every snapshot_interval seconds, save the port buffers, output revs and op states between two passes.
+            If the file exists when execute() starts, the run resumes from it instead of reloading the sources,
+            so the ops between checkpoints are not replayed. The snapshot is deleted when the run finishes.
+        - memory_budget: max bytes of entries held in the port buffers (estimated by their msgpack size).
+            Above it, the largest buffers are spilled to sqlite+msgpack files in spill_dir (a temporary directory by default),
+            and read back when the downstream node is pumped.
+        - fuse_ops: pump linear chains of barrier-0 ApplyOps and FilterOps as a single FusedOp.
+            The profiler still reports each op of the chain. get_output() is only available for the last op of a chain.
+        - profile: an ExecutorProfile to record the run into, e.g. ExecutorProfile(measure_bytes=True).
+            The record of the last run is available as self.profile.
+        - pool: a concurrent.futures executor. Independent nodes of the same pass are pumped at the same time,
+            stateless ones (ApplyOp, FilterOp, RouterOp, SpawnOp, CollectAllOp) on the pool.
+            ThreadPoolExecutor suits I/O-bound ops. ProcessPoolExecutor suits CPU-bound ops, but the ops must be picklable (no lambdas).
+        - stream: SourceOps emit micro-batches, only when the port buffers hold less than max_inflight entries.
+            The whole pipeline runs once per micro-batch, and entries leaving the graph are not kept,
+            so the memory used by the entries is bounded by max_inflight rather than the dataset size.
+        """
+        if stream and max_inflight < 1:
+            raise ValueError(f"max_inflight must be positive, got {max_inflight}")
+        if self.plan.version != self.graph._version or self.plan.fuse_ops != fuse_ops:
+            self.reset_graph(self.graph, fuse_ops=fuse_ops)
+        barrier_levels = [barrier_level for barrier_level in self.plan.barrier_levels
+            if max_barrier_level is None or barrier_level <= max_barrier_level]
         self.verbose = verbose
         self.verbose>=2 and print(f"[OpGraphExecutor] executing with barrier levels: {barrier_levels}")
-        self._time_prof = defaultdict(float)
+        if memory_budget is not None and memory_budget < 0:
+            raise ValueError(f"memory_budget must be non-negative, got {memory_budget}")
+        self.clear_output_cache() # the buffers of the previous run might use another spill_dir
+        self.memory_budget = memory_budget
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.spill_dir = spill_dir
+        self.profile = profile if profile is not None else ExecutorProfile()
+        self.profile.start(self.nodes + [step for fused in self.plan.fused_ops for step in fused.steps])
+        try:
+            return self._execute(dispatch_brokers, mock, max_iterations, barrier_levels, compact_after_finished, stream, max_inflight, pool,
+                snapshot_path, snapshot_interval)
+        finally:
+            self.profile.stop()
+
+    def _execute(self, dispatch_brokers, mock, max_iterations, barrier_levels, compact_after_finished, stream, max_inflight, pool,
+                 snapshot_path, snapshot_interval):
+        self.n_node_pumps = 0
         time_start = time.perf_counter()
         self.reset()
-        self._time_prof["reset"] += time.perf_counter() - time_start
+        self.max_inflight = max_inflight if stream else None
+        self.peak_inflight = 0
+        self.pool = pool
+        self.profile.record(None, "reset", time_start, time.perf_counter() - time_start)
         first = True
         iterations = 0
         current_barrier_level_idx = 0
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            snapshot_level = self._load_snapshot(snapshot_path)
+            if snapshot_level is not None:
+                first = False # the sources were already loaded before the snapshot
+                current_barrier_level_idx = max(sum(1 for level in barrier_levels if level <= snapshot_level) - 1, 0)
+        last_snapshot_time = time.monotonic()
         while True:
             current_barrier_level = barrier_levels[current_barrier_level_idx]
+            if snapshot_path is not None and not first and time.monotonic() - last_snapshot_time >= snapshot_interval:
+                self._save_snapshot(snapshot_path, current_barrier_level)
+                last_snapshot_time = time.monotonic()
             emit_level = self.pump(PumpOptions(
                 dispatch_brokers=(current_barrier_level>0) and dispatch_brokers,
                 mock=mock,
                 reload_inputs=first,
                 max_barrier_level=current_barrier_level))
             iterations += 1
+            self.profile.iteration += 1
             first = False
             if emit_level is None:
                 if current_barrier_level_idx < len(barrier_levels) - 1:
                     current_barrier_level_idx += 1
                     continue
+                elif self.max_inflight is not None and self._has_pending_sources():
+                    if self.n_inflight() >= self.max_inflight:
+                        print(f"[OpGraphExecutor] Stopped streaming: {self.n_inflight()} entries are waiting in the port buffers, increase max_inflight.")
+                        break
+                    current_barrier_level_idx = 0 # next micro-batch
+                    iterations = 0 # max_iterations applies to each micro-batch
+                    continue
                 else:
                     break
             else:
@@ -173,13 +439,17 @@ class OpGraphExecutor:
             if iterations >= max_iterations:
                 break
         
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            os.remove(snapshot_path) # finished, the next run starts over
+
         time_start = time.perf_counter()
         if compact_after_finished:
             for node in self.nodes:
                 node.compact()
-        self._time_prof["compact"] += time.perf_counter() - time_start
+        self.profile.record(None, "compact", time_start, time.perf_counter() - time_start)
 
         if self.verbose >= 1:
+            self.profile.stop()
             self.show_node_times()
 
         # returns the output of output node
@@ -195,17 +465,14 @@ class OpGraphExecutor:
         else:
             return None
         
-    def show_node_times(self):
-        print("[OpGraphExecutor] Node times:")
-        average_time = sum(self._time_prof.values()) / len(self._time_prof) if self._time_prof else 0
-        for name, time in sorted(self._time_prof.items(), key=lambda x: x[1], reverse=True):
-            if time>0.1:
-                print(f"    {name}: {time:.4f} seconds")
+    def show_node_times(self, min_time:float=0.1):
+        print(self.profile.summary(min_time=min_time), end="")
 
     def get_node_output(self, node:BaseOp, port:int=None)->Dict[int,Dict[str,Entry]]|Dict[str,Entry]:
         if port is None:
             return {port: self.get_node_output(node, port) for port in range(node.n_out_ports)}
-        return self.output_cache.get((node, port), {})
+        port_entries = self.output_cache.get((self.plan.aliases.get(node, node), port))
+        return dict(port_entries.items()) if port_entries is not None else {}
 
 
     def get_cache_summary(self)->Dict["BaseOp",str]:
@@ -215,7 +482,12 @@ class OpGraphExecutor:
             info_str[node] = f"cache size: {cache_size}"
         return info_str
 
+def _timed_pump(node:BaseOp, inputs:Dict[int,Dict[str,Entry]], options:PumpOptions)->Tuple[PumpOutput,float,float]:
+    "module level so that it can be sent to a process pool"
+    time_start = time.perf_counter()
+    pump_output = node.pump(inputs=inputs, options=options)
+    return pump_output, time_start, time.perf_counter() - time_start
+
 __all__ = [
     "OpGraphExecutor",
 ]
-
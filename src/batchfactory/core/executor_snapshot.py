@@ -0,0 +1,72 @@
+from .entry import Entry
+from typing import Dict, List, Any, TYPE_CHECKING
+from pathlib import Path
+import msgpack
+import os
+if TYPE_CHECKING:
+    from .executor import OpGraphExecutor
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+def _graph_signature(executor:'OpGraphExecutor')->List[Any]:
+    "snapshots are only restored into a graph with the same nodes and edges"
+    plan = executor.plan
+    return [
+        [repr(node) for node in plan.nodes],
+        sorted([plan.order[edge.source], edge.source_port, plan.order[edge.target], edge.target_port] for edge in plan.edges),
+    ]
+
+def save_snapshot(executor:'OpGraphExecutor', path:str|Path, barrier_level:int)->int:
+    """
+    Save the port buffers, output revs and op states of the executor to path, between two passes.
+    The file is replaced atomically, so a crash while saving keeps the previous snapshot.
+    Returns the size of the snapshot in bytes.
+    """
+    order = executor.plan.order
+    payload = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "signature": _graph_signature(executor),
+        "barrier_level": barrier_level,
+        "buffers": [[order[node], port, [[entry.idx, entry.rev, entry.data, entry.meta] for entry in port_entries.values()]]
+            for (node, port), port_entries in executor.output_cache.items() if port_entries],
+        "output_revs": [[order[node], port, revs] for (node, port), revs in executor.output_revs.items()],
+        "node_states": [node.state_dict() for node in executor.plan.nodes],
+    }
+    blob = msgpack.packb(payload, use_bin_type=True)
+    path = Path(path)
+    os.makedirs(path.parent, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(blob)
+
+def load_snapshot(executor:'OpGraphExecutor', path:str|Path)->int|None:
+    """
+    Restore a snapshot into a freshly reset executor.
+    Returns the barrier level the snapshot was taken at, or None if the snapshot does not match the graph.
+    """
+    with open(path, "rb") as f:
+        payload = msgpack.unpackb(f.read(), raw=False, strict_map_key=False)
+    if payload.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        print(f"[OpGraphExecutor] Ignoring snapshot {path}: unsupported format version {payload.get('format_version')}")
+        return None
+    if payload["signature"] != _graph_signature(executor):
+        print(f"[OpGraphExecutor] Ignoring snapshot {path}: it was taken from a different graph")
+        return None
+    nodes = executor.plan.nodes
+    for node_idx, port, revs in payload["output_revs"]:
+        executor.output_revs[(nodes[node_idx], port)] = revs
+    for node_idx, port, records in payload["buffers"]:
+        node = nodes[node_idx]
+        port_entries = executor.output_cache[(node, port)] = executor._make_port_buffer(node, port)
+        for idx, rev, data, meta in records:
+            port_entries.put(Entry(idx=idx, rev=rev, data=data, meta=meta))
+    for node, state in zip(nodes, payload["node_states"]):
+        node.load_state_dict(state)
+    return payload["barrier_level"]
+
+__all__ = [
+]
@@ -1,93 +1,252 @@
-from typing import  List, Dict, Callable, Mapping, Iterable, Any, Set
+from typing import  List, Dict, Callable, Mapping, Iterable, Iterator, Tuple, Any, Set
 import os
 import jsonlines,json
 import aiofiles,asyncio
 from copy import deepcopy
 from pathlib import Path
-import sqlite3
 import msgpack
+from enum import Enum
+import threading, weakref, atexit, functools
+from .ledger_engine import LedgerEngine, LEDGER_ENGINES, LEDGER_PROFILES, DEFAULT_PROFILE, SegmentLogEngine
+from .ledger_codec import LedgerCodec
+from .project_folder import _current_project
 
 DELETE_NONE=True
 COMPACT_ON_INIT=True
+FLUSH_EVERY=256 # default write-behind group size
+FLUSH_INTERVAL_MS=50 # default write-behind window
+COMPRESS_THRESHOLD=256 # packed records shorter than this are not compressed
+PAGE_SIZE=1000 # records read per page by the iter_* methods
+
+_write_behind_ledgers:'weakref.WeakSet[Ledger]' = weakref.WeakSet()
+
+@atexit.register
+def _flush_write_behind_ledgers():
+    for ledger in list(_write_behind_ledgers):
+        ledger.flush()
+
+def _writer_loop(ledger_ref:'weakref.ref[Ledger]', wake:threading.Event):
+    "writer thread of a write-behind ledger, only holds a weak reference so the ledger can still be collected"
+    while True:
+        ledger = ledger_ref()
+        if ledger is None or ledger.engine is None: return
+        interval = ledger.flush_interval_ms / 1000
+        del ledger
+        wake.wait(interval)
+        wake.clear()
+        ledger = ledger_ref()
+        if ledger is None or ledger.engine is None: return
+        try:
+            ledger.flush()
+        except Exception as e:
+            print(f"[Ledger] Error in write-behind flush of {ledger.path}, will retry: {e}")
+        del ledger
+
+def _synchronized(method):
+    "run the method under the engine lock, after writing out the pending write-behind rows"
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._db_lock:
+            self._flush_pending()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def _index_columns(idx:str, record:Dict, keyed_by_rev:bool)->tuple:
+    "(status, rev, base_idx) of a record"
+    status, rev = record.get('status'), record.get('rev')
+    if isinstance(status, Enum): status = status.value
+    if not isinstance(rev, int) or isinstance(rev, bool): rev = None
+    base_idx = idx
+    if keyed_by_rev and rev is not None and idx.endswith(f"_{rev}"):
+        base_idx = idx[:-len(f"_{rev}")]
+    return status, rev, base_idx
+
+def _index_columns_of_blob(idx:str, data_blob:bytes, keyed_by_rev:bool)->tuple:
+    return _index_columns(idx, msgpack.unpackb(data_blob, raw=False), keyed_by_rev)
 
 class Ledger:
-    def __init__(self, path: str|Path):
+    """
+    msgpack records keyed by idx, stored by a LedgerEngine.
+    - status, rev, base idx and an insertion sequence number are also stored in indexed columns,
+        so status filtering and "latest rev of idx" lookups do not unpack every record
+    - engine is "sqlite" (default) or "segment_log", the latter being picked by default for a .seglog path
+    - profile is "durable", "balanced" or "throughput" (see SQLiteEngine), by default the ledger_profile of the current ProjectFolder,
+        or "balanced". the non-durable profiles also defer the compaction done when the ledger is opened
+    - compression is None, "zlib", or "zlib_dict" for many small similar records (see LedgerCodec).
+        records of any setting stay readable, so it can be changed on an existing ledger
+    - if keyed_by_rev, records are stored under f"{base_idx}_{rev}" (see CheckpointOp keep_all_rev)
+    - after enable_write_behind(), update_one_async only queues the record, and a writer thread commits
+        the queue in groups. every other method, close() and interpreter exit write the queue out first
+    """
+    def __init__(self, path: str|Path, *, keyed_by_rev:bool=False, engine:str|None=None, profile:str|None=None,
+                 compression:str|None=None, compress_threshold:int=COMPRESS_THRESHOLD):
         self.path = Path(path)
+        self.keyed_by_rev = keyed_by_rev
+        if engine is None:
+            engine = "segment_log" if self.path.suffix == SegmentLogEngine.suffix else "sqlite"
+        if engine not in LEDGER_ENGINES:
+            raise ValueError(f"Unknown ledger engine {engine}, expected one of {list(LEDGER_ENGINES)}")
+        if profile is None:
+            project = _current_project.get()
+            profile = project.ledger_profile if project is not None and project.ledger_profile is not None else DEFAULT_PROFILE
+        if profile not in LEDGER_PROFILES:
+            raise ValueError(f"Unknown ledger profile {profile}, expected one of {LEDGER_PROFILES}")
+        self.profile = profile
         if self.path.suffix == '.jsonl':
             print(f"[Ledger] Warning: Ledger is designed to use SQLite, not JSONL. Converting {self.path} to SQLite format.")
-        self.path = self.path.with_suffix('.sqlite')
+        self.path = self.path.with_suffix(LEDGER_ENGINES[engine].suffix)
         os.makedirs(self.path.parent, exist_ok=True)
-        self.conn = sqlite3.connect(self.path)
-        self.conn.execute("PRAGMA journal_mode=WAL;")
-        self.cursor = self.conn.cursor()
+        self._db_lock = threading.RLock() # the engine is shared with the write-behind thread
+        self._pending:List[tuple] = [] # rows queued by update_one_async in write-behind mode
+        self._pending_lock = threading.Lock()
+        self._wake:threading.Event|None = None
+        self.flush_every = FLUSH_EVERY
+        self.flush_interval_ms = FLUSH_INTERVAL_MS
         self._lock = asyncio.Lock()
-        self._create_table()
+        self.codec = LedgerCodec(compression, compress_threshold, self.path.with_name(self.path.name + ".zdict"))
+        self.engine:LedgerEngine = LEDGER_ENGINES[engine](self.path,
+            index_columns=functools.partial(_index_columns_of_blob, keyed_by_rev=keyed_by_rev), profile=profile)
         self._upgrade_from_old_format()
         if COMPACT_ON_INIT:
-            self.compact()
+            self.engine.compact_on_open()
     def __del__(self):
-        if self.conn:
-            self.conn.commit()
-            self.conn.close()
-    def _create_table(self):
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS entries (
-                idx TEXT PRIMARY KEY,
-                data BLOB
-            )
-        ''')
-        self.conn.commit()
+        self.close()
+    def close(self, delete:bool=False):
+        "write out the pending rows, close the engine, and delete the database files if delete is set"
+        if getattr(self, "engine", None):
+            with self._db_lock:
+                self._flush_pending()
+                self.engine.close(delete=delete)
+                self.engine = None
+            if delete:
+                self.codec.zdict_path.unlink(missing_ok=True)
+            _write_behind_ledgers.discard(self)
+            if self._wake is not None:
+                self._wake.set() # stops the writer thread
+    def _index_columns(self, idx:str, record:Dict)->tuple:
+        return _index_columns(idx, record, self.keyed_by_rev)
+    def _make_row(self, idx:str, record:Dict)->tuple:
+        "(idx, data, status, rev, base_idx) of a record, the engine assigns its sequence number when writing it"
+        return (idx, self.codec.encode(msgpack.packb(record, use_bin_type=True)), *self._index_columns(idx, record))
+    def _unpack(self, data_blob:bytes)->Dict:
+        return msgpack.unpackb(self.codec.decode(data_blob), raw=False)
+    def enable_write_behind(self, flush_every:int=FLUSH_EVERY, flush_interval_ms:float=FLUSH_INTERVAL_MS):
+        """
+        Group the commits of update_one_async: records are queued and committed by a writer thread
+        once flush_every of them are pending, or flush_interval_ms after the last flush.
+        A crash that skips close() and interpreter exit loses at most that window of records.
+        """
+        if flush_every < 1: raise ValueError(f"flush_every must be positive, got {flush_every}")
+        self.flush_every = flush_every
+        self.flush_interval_ms = flush_interval_ms
+        if self._wake is None:
+            self._wake = threading.Event()
+            threading.Thread(target=_writer_loop, args=(weakref.ref(self), self._wake),
+                             name=f"LedgerWriter({self.path.name})", daemon=True).start()
+            _write_behind_ledgers.add(self)
+    @property
+    def n_pending(self)->int:
+        "records queued by update_one_async and not committed yet"
+        return len(self._pending)
+    def flush(self):
+        "commit the records queued by update_one_async"
+        with self._db_lock:
+            self._flush_pending()
+    def _flush_pending(self):
+        if not self._pending or self.engine is None: return
+        with self._pending_lock:
+            rows, self._pending = self._pending, []
+        try:
+            self.engine.put_many(rows)
+        except BaseException:
+            with self._pending_lock: # keep them for the next flush
+                self._pending[:0] = rows
+            raise
+    @_synchronized
     def compact(self):
         # print(f"[Ledger] Compacting database at {self.path}...")
-        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
-        self.conn.commit()
+        self.engine.compact()
+    @_synchronized
+    def vacuum(self)->int:
+        "compact, and give the space of replaced and deleted records back to the file system. returns the bytes freed"
+        size_before = self.engine.disk_size()
+        self.engine.vacuum()
+        return max(size_before - self.engine.disk_size(), 0)
+    @_synchronized
+    def reclaimable_bytes(self)->int:
+        "bytes of replaced and deleted records that vacuum() would give back"
+        return self.engine.reclaimable_bytes()
+    @_synchronized
+    def disk_size(self)->int:
+        return self.engine.disk_size() + (self.codec.zdict_path.stat().st_size if self.codec.zdict_path.exists() else 0)
+    @_synchronized
     def update_many_sync(self,updates:Dict,serializer=None):
-        for idx, record in updates.items():
-            if serializer is not None:
-                record = serializer(record)
-            assert isinstance(record, dict), "Record must be a dictionary."
-            assert idx == record['idx'], "Index must match record['idx']."
-            data_blob = msgpack.packb(record, use_bin_type=True)
-            self.cursor.execute('''
-                INSERT OR REPLACE INTO entries (idx, data) VALUES (?, ?)
-            ''', (idx, data_blob))
-        self.conn.commit()
+        def rows():
+            for idx, record in updates.items():
+                if serializer is not None:
+                    record = serializer(record)
+                assert isinstance(record, dict), "Record must be a dictionary."
+                assert idx == record['idx'], "Index must match record['idx']."
+                yield self._make_row(idx, record)
+        self.engine.put_many(rows()) # atomic, nothing is stored if any record fails
     async def update_one_async(self, new_record:Dict, serializer=None):
         if serializer is not None:
             new_record = serializer(new_record)
         assert isinstance(new_record, dict), "Record must be a dictionary."
         idx = new_record['idx']
-        data_blob = msgpack.packb(new_record, use_bin_type=True)
+        if self._wake is not None:
+            row = self._make_row(idx, new_record)
+            with self._pending_lock:
+                self._pending.append(row)
+                n_pending = len(self._pending)
+            if n_pending >= self.flush_every:
+                self._wake.set()
+            return
         async with self._lock:
-            self.cursor.execute('''
-                INSERT OR REPLACE INTO entries (idx, data) VALUES (?, ?)
-            ''', (idx, data_blob))
-            self.conn.commit()
+            with self._db_lock:
+                self.engine.put_many([self._make_row(idx, new_record)])
+    @_synchronized
     def get_one(self, idx:str, builder=None, default=None) -> Dict|Any|None:
-        self.cursor.execute('SELECT data FROM entries WHERE idx = ?', (idx,))
-        row = self.cursor.fetchone()
-        if row is None:
+        data_blob = self.engine.get_one(idx)
+        if data_blob is None:
             return default
-        data_blob = row[0]
-        record = msgpack.unpackb(data_blob, raw=False)
+        record = self._unpack(data_blob)
         if builder is not None:
             record = builder(record)
         return record
-    def get_all(self, builder=None)->Dict[str, Any]:
-        self.cursor.execute('SELECT idx, data FROM entries')
+    @_synchronized
+    def get_many(self, idxs:Iterable[str], builder=None)->Dict[str, Any]:
+        "returns the records of the given idxs, missing idxs are skipped"
         records = {}
-        for idx, data_blob in self.cursor.fetchall():
-            record = msgpack.unpackb(data_blob, raw=False)
+        for idx, data_blob in self.engine.get_many(idxs):
+            record = self._unpack(data_blob)
             if builder is not None:
                 record = builder(record)
             records[idx] = record
         return records
-    def filter_many(self, criteria:Callable, builder:Callable=None, filter_before_build=False) -> Dict[str, Any]:
-        """returns a dict of records that satisfy criteria(record)==True"""
-        records = {}
-        self.cursor.execute('SELECT idx, data FROM entries')
-        for idx, data_blob in self.cursor.fetchall():
-            record = msgpack.unpackb(data_blob, raw=False)
+    def _iter_pages(self, statuses:List[str]|None, page_size:int)->Iterator[Tuple[str,bytes]]:
+        "(idx, data blob) page by page, the lock is only held while a page is read"
+        cursor = None
+        while True:
+            with self._db_lock:
+                self._flush_pending()
+                rows, cursor = self.engine.scan_page(cursor, page_size, statuses)
+            yield from rows
+            if cursor is None: return
+    def iter_all(self, builder=None, page_size:int=PAGE_SIZE)->Iterator[Tuple[str, Any]]:
+        """
+        yields (idx, record) of every record, reading page_size records at a time.
+        records written during the iteration are skipped, so updating the records being iterated is fine
+        """
+        for idx, data_blob in self._iter_pages(None, page_size):
+            record = self._unpack(data_blob)
+            if builder is not None:
+                record = builder(record)
+            yield idx, record
+    def iter_filter(self, criteria:Callable, builder:Callable=None, filter_before_build=False, page_size:int=PAGE_SIZE)->Iterator[Tuple[str, Any]]:
+        "yields (idx, record) of the records that satisfy criteria(record)==True, see iter_all"
+        for idx, data_blob in self._iter_pages(None, page_size):
+            record = self._unpack(data_blob)
             if filter_before_build and not criteria(record):
                 continue
             try:
@@ -98,26 +257,63 @@ class Ledger:
                 continue
             if not filter_before_build and not criteria(record):
                 continue
-            records[idx] = record
-        return records
+            yield idx, record
+    def iter_by_status(self, status:str|Enum|Iterable[str|Enum], builder=None, page_size:int=PAGE_SIZE)->Iterator[Tuple[str, Any]]:
+        "yields (idx, record) of the records whose status is one of the given statuses, using the status index, see iter_all"
+        if isinstance(status, (str, Enum)): status = [status]
+        statuses = [s.value if isinstance(s, Enum) else s for s in status]
+        if not statuses: return
+        for idx, data_blob in self._iter_pages(statuses, page_size):
+            record = self._unpack(data_blob)
+            try:
+                if builder is not None:
+                    record = builder(record)
+            except Exception as e:
+                print(f"[Ledger] Error in builder for record {idx}: {e}")
+                continue
+            yield idx, record
+    def get_all(self, builder=None)->Dict[str, Any]:
+        return dict(self.iter_all(builder))
+    def filter_many(self, criteria:Callable, builder:Callable=None, filter_before_build=False) -> Dict[str, Any]:
+        """returns a dict of records that satisfy criteria(record)==True"""
+        return dict(self.iter_filter(criteria, builder, filter_before_build))
+    def filter_by_status(self, status:str|Enum|Iterable[str|Enum], builder=None) -> Dict[str, Any]:
+        "returns the records whose status is one of the given statuses, using the status index"
+        return dict(self.iter_by_status(status, builder))
+    @_synchronized
+    def count_by_status(self)->Dict[str|None, int]:
+        return self.engine.count_by_status()
+    @_synchronized
+    def get_latest_rev(self, base_idx:str)->int|None:
+        "the largest rev stored for base_idx, or None"
+        revs = self.get_revs(base_idx)
+        return revs[-1] if revs else None
+    @_synchronized
+    def get_rev_index(self)->Dict[str, int|None]:
+        "{idx: rev} of every record, read from the rev column without unpacking the records"
+        return self.engine.rev_index()
+    @_synchronized
+    def get_revs(self, base_idx:str)->List[int]:
+        "the revs stored for base_idx, in increasing order"
+        return [rev for rev, _ in self.engine.revs_of(base_idx) if rev is not None]
+    @_synchronized
+    def get_latest(self, base_idx:str, builder=None, default=None)->Dict|Any|None:
+        "the record with the largest rev stored for base_idx"
+        revs = self.engine.revs_of(base_idx)
+        if not revs:
+            return default
+        return self.get_one(revs[-1][1], builder=builder, default=default)
+    @_synchronized
     def contains(self, idx:str) -> bool:
-        self.cursor.execute('SELECT 1 FROM entries WHERE idx = ?', (idx,))
-        return self.cursor.fetchone() is not None
+        return self.engine.contains(idx)
+    @_synchronized
     def remove_many(self, idxs:Set):
-        for idx in idxs:
-            self.cursor.execute('DELETE FROM entries WHERE idx = ?', (idx,))
-        self.conn.commit()
+        self.engine.delete_many(idxs)
     def _upgrade_from_old_format(self):
         if self.path.with_suffix('.jsonl').exists():
             print(f"[Ledger] Upgrading from old format at {self.path.with_suffix('.jsonl')}")
             with jsonlines.open(self.path.with_suffix('.jsonl'), 'r') as reader:
-                for record in reader:
-                    idx = record['idx']
-                    data_blob = msgpack.packb(record, use_bin_type=True)
-                    self.cursor.execute('''
-                        INSERT OR REPLACE INTO entries (idx, data) VALUES (?, ?)
-                    ''', (idx, data_blob))
-            self.conn.commit()
+                self.update_many_sync({record['idx']: record for record in reader})
             self.path.with_suffix('.jsonl').unlink()
 
 __all__ = [
@@ -0,0 +1,101 @@
+from typing import List, Dict
+from pathlib import Path
+import os
+import struct
+import threading
+import zlib
+import msgpack
+
+ZLIB_LEVEL=6
+ZDICT_SIZE=8192 # compresses about as well as the whole 32KB deflate window, and is much cheaper to load per blob
+ZDICT_SAMPLES=256 # records collected before training the dictionary
+
+_MARKER = b'\xc1' # "never used" in msgpack, so a packed record never starts with it
+_ZLIB, _ZLIB_DICT = b'\x01', b'\x02'
+_DICT_ID = struct.Struct('<I')
+
+def train_zdict(samples:List[bytes], size:int=ZDICT_SIZE)->bytes:
+    """
+    Preset dictionary for zlib: the last size bytes of the concatenated samples.
+    deflate prefers the closest match, so the most recent samples are placed at the end.
+    """
+    return b''.join(samples)[-size:]
+
+class LedgerCodec:
+    """
+    Compression of the packed records of a Ledger.
+    - compression is None, "zlib", or "zlib_dict" (zlib with a preset dictionary trained on the first records)
+    - blobs shorter than threshold, or which do not shrink, are stored as is
+    - a compressed blob starts with a marker byte and the codec id, so blobs written with any setting stay readable
+    - trained dictionaries are kept in the file at zdict_path, keyed by their adler32 id
+    """
+    def __init__(self, compression:str|None, threshold:int, zdict_path:str|Path):
+        if compression not in (None, "zlib", "zlib_dict"):
+            raise ValueError(f"Unknown compression {compression}, expected None, 'zlib' or 'zlib_dict'")
+        self.compression = compression
+        self.threshold = threshold
+        self.zdict_path = Path(zdict_path)
+        self._zdicts:Dict[int,bytes]|None = None # loaded on first use
+        self._active:tuple|None = None # (id, compressor with the dictionary loaded) new blobs are compressed with
+        self._samples:List[bytes] = []
+        self._lock = threading.Lock()
+        if compression == "zlib_dict":
+            zdicts = self._get_zdicts()
+            if zdicts: self._use_zdict(list(zdicts)[-1])
+    def _get_zdicts(self)->Dict[int,bytes]:
+        if self._zdicts is None:
+            self._zdicts = {}
+            if self.zdict_path.exists():
+                with open(self.zdict_path, 'rb') as f:
+                    self._zdicts = msgpack.unpackb(f.read(), raw=False, strict_map_key=False)
+        return self._zdicts
+    def _add_zdict(self, zdict:bytes)->int:
+        zdict_id = zlib.adler32(zdict)
+        zdicts = {**self._get_zdicts(), zdict_id: zdict}
+        tmp_path = self.zdict_path.with_name(self.zdict_path.name + ".tmp")
+        with open(tmp_path, 'wb') as f: # saved before any blob refers to it
+            f.write(msgpack.packb(zdicts, use_bin_type=True))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.zdict_path)
+        self._zdicts = zdicts
+        return zdict_id
+    def _use_zdict(self, zdict_id:int):
+        self._active = (zdict_id, zlib.compressobj(ZLIB_LEVEL, zdict=self._get_zdicts()[zdict_id]))
+    def train(self, samples:List[bytes]):
+        "train a new dictionary on samples, used for the blobs written from now on"
+        with self._lock:
+            self._use_zdict(self._add_zdict(train_zdict(samples)))
+            self._samples = []
+    def encode(self, blob:bytes)->bytes:
+        if self.compression is None or len(blob) < self.threshold:
+            return blob
+        if self.compression == "zlib_dict" and self._active is None:
+            with self._lock:
+                self._samples.append(blob)
+                ready = len(self._samples) >= ZDICT_SAMPLES
+            if ready:
+                self.train(self._samples)
+        active = self._active
+        if self.compression == "zlib_dict" and active is not None:
+            zdict_id, compressor = active[0], active[1].copy()
+            encoded = _MARKER + _ZLIB_DICT + _DICT_ID.pack(zdict_id) + compressor.compress(blob) + compressor.flush()
+        else:
+            encoded = _MARKER + _ZLIB + zlib.compress(blob, ZLIB_LEVEL)
+        return encoded if len(encoded) < len(blob) else blob
+    def decode(self, blob:bytes)->bytes:
+        if blob[:1] != _MARKER:
+            return blob
+        codec = blob[1:2]
+        if codec == _ZLIB:
+            return zlib.decompress(blob[2:])
+        if codec == _ZLIB_DICT:
+            zdict_id, = _DICT_ID.unpack_from(blob, 2)
+            zdict = self._get_zdicts().get(zdict_id)
+            if zdict is None: raise ValueError(f"Missing compression dictionary {zdict_id} in {self.zdict_path}")
+            decompressor = zlib.decompressobj(zdict=zdict)
+            return decompressor.decompress(blob[2 + _DICT_ID.size:]) + decompressor.flush()
+        raise ValueError(f"Unknown ledger codec {codec!r}")
+
+__all__ = [
+]
@@ -0,0 +1,632 @@
+from abc import ABC, abstractmethod
+from typing import List, Dict, Callable, Iterable, Iterator, Tuple, Set, Any
+from collections import Counter
+from pathlib import Path
+import os
+import mmap
+import shutil
+import sqlite3
+import struct
+import threading
+import itertools
+import bisect
+import zlib
+import msgpack
+
+WRITE_CHUNK_SIZE=10000 # rows serialized per executemany call, so a huge batch is never packed at once
+READ_CHUNK_SIZE=500 # idxs per IN (...) query, below SQLITE_MAX_VARIABLE_NUMBER of old sqlite builds
+SCHEMA_VERSION=3 # stored in PRAGMA user_version. 0: (idx, data) only. 1: indexed status, rev, base_idx, seq columns. 2: (status, seq) index. 3: (status, seq, idx) and (seq, idx) indexes
+LEDGER_PROFILES = ["durable", "balanced", "throughput"]
+DEFAULT_PROFILE = "balanced"
+SQLITE_PRAGMAS = { # cache_size in KiB when negative
+    "durable": {"synchronous": "FULL", "cache_size": -2000, "mmap_size": 0, "temp_store": "DEFAULT"},
+    "balanced": {"synchronous": "NORMAL", "cache_size": -16000, "mmap_size": 64<<20, "temp_store": "MEMORY"},
+    "throughput": {"synchronous": "OFF", "cache_size": -64000, "mmap_size": 256<<20, "temp_store": "MEMORY"},
+}
+LAZY_COMPACT_WAL_BYTES=16<<20 # a WAL larger than this is still checkpointed when a ledger of a lazy profile is opened
+
+def _chunked(iterable:Iterable, size:int)->Iterable[List]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class LedgerEngine(ABC):
+    """
+    Storage behind a Ledger. Rows are (idx, data, status, rev, base_idx) tuples, data being the packed record.
+    - the Ledger serializes its calls, engines only need to guard against their own background threads
+    - put_many gives each row the next insertion sequence number (seq) within its write, so other Ledgers on the same file
+        never reuse one
+    - put_many and delete_many are atomic: after a crash, either all or none of the rows are stored
+    """
+    suffix:str = None # of the database path
+    @abstractmethod
+    def put_many(self, rows:Iterable[tuple])->None:
+        "insert or replace the rows, assigning their seq"
+        pass
+    @abstractmethod
+    def delete_many(self, idxs:Iterable[str])->None:
+        pass
+    @abstractmethod
+    def get_many(self, idxs:Iterable[str])->Iterator[Tuple[str,bytes]]:
+        "(idx, data) of the given idxs, missing idxs are skipped"
+        pass
+    def get_one(self, idx:str)->bytes|None:
+        for _, data in self.get_many([idx]):
+            return data
+        return None
+    @abstractmethod
+    def contains(self, idx:str)->bool:
+        pass
+    @abstractmethod
+    def scan_page(self, cursor:Any, limit:int, statuses:List[str]|None=None)->Tuple[List[Tuple[str,bytes]],Any]:
+        """
+        Page through the rows, or the rows whose status is one of statuses, returns ([(idx, data)], next cursor).
+        - cursor is None for the first page, and the returned cursor is None after the last one
+        - rows are in (seq, idx) order (per status), and rows written after the first page are skipped
+        """
+        pass
+    @abstractmethod
+    def count_by_status(self)->Dict[str|None,int]:
+        pass
+    @abstractmethod
+    def rev_index(self)->Dict[str,int|None]:
+        "{idx: rev} of every row"
+        pass
+    @abstractmethod
+    def revs_of(self, base_idx:str)->List[Tuple[int|None,str]]:
+        "(rev, idx) of the rows of base_idx, sorted by rev"
+        pass
+    @abstractmethod
+    def max_seq(self)->int:
+        pass
+    def compact(self)->None:
+        "reclaim the space of replaced and deleted rows, called after each run"
+        pass
+    def compact_on_open(self)->None:
+        "called when the ledger is opened, engines may skip the compaction depending on the profile"
+        self.compact()
+    def vacuum(self)->None:
+        "like compact, but also rewrites the storage to give the free space back to the file system"
+        self.compact()
+    @abstractmethod
+    def disk_size(self)->int:
+        "bytes used by the files of the engine"
+        pass
+    @abstractmethod
+    def reclaimable_bytes(self)->int:
+        "bytes of replaced and deleted rows, that vacuum() would give back"
+        pass
+    @abstractmethod
+    def close(self, delete:bool=False)->None:
+        "release the storage, and delete its files if delete is set"
+        pass
+
+class SQLiteEngine(LedgerEngine):
+    """
+    Rows in a SQLite table in WAL mode, with indexes on (status, seq, idx), (base_idx, rev) and (seq, idx).
+    index_columns(idx, data) gives (status, rev, base_idx), used to upgrade files of schema version 0.
+    profile picks the SQLITE_PRAGMAS of the connection:
+    - durable: fsync on every commit, and the WAL is checkpointed when the ledger is opened
+    - balanced: fsync on checkpoints only. a commit survives a crash of the process, but not of the OS.
+        the WAL is only checkpointed on open if it is larger than LAZY_COMPACT_WAL_BYTES, and otherwise by compact()
+    - throughput: no fsync, larger page cache and mmap. for caches that can be rebuilt
+    """
+    suffix = '.sqlite'
+    def __init__(self, path:str|Path, index_columns:Callable[[str,bytes],tuple], profile:str=DEFAULT_PROFILE):
+        if profile not in SQLITE_PRAGMAS:
+            raise ValueError(f"Unknown ledger profile {profile}, expected one of {list(SQLITE_PRAGMAS)}")
+        self.path = Path(path)
+        self.profile = profile
+        self._index_columns = index_columns
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        for pragma, value in SQLITE_PRAGMAS[profile].items():
+            self.conn.execute(f"PRAGMA {pragma}={value};")
+        self._create_table()
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION: # a write transaction, so only when needed
+            self._upgrade_schema()
+            self._create_indexes()
+    def close(self, delete:bool=False):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+        if delete:
+            for suffix in ['.sqlite', '.sqlite-wal', '.sqlite-shm']:
+                self.path.with_suffix(suffix).unlink(missing_ok=True)
+    def _create_table(self):
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    idx TEXT PRIMARY KEY,
+                    data BLOB,
+                    status TEXT,
+                    rev INTEGER,
+                    base_idx TEXT,
+                    seq INTEGER
+                )
+            ''')
+    def _create_indexes(self):
+        with self.conn:
+            for old_index in ['entries_status', 'entries_status_seq', 'entries_seq']: # covered by the (..., seq, idx) indexes
+                self.conn.execute(f'DROP INDEX IF EXISTS {old_index}')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS entries_status_seq_idx ON entries (status, seq, idx)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS entries_base_idx_rev ON entries (base_idx, rev)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS entries_seq_idx ON entries (seq, idx)')
+            self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    def _upgrade_schema(self):
+        "add the indexed columns to .sqlite files of schema version 0, and fill them from the stored records"
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(entries)')}
+        missing = [column for column in ['status', 'rev', 'base_idx', 'seq'] if column not in columns]
+        if not missing: return
+        print(f"[Ledger] Upgrading schema of {self.path} to version {SCHEMA_VERSION}")
+        with self.conn:
+            for column in missing:
+                column_type = 'INTEGER' if column in ('rev', 'seq') else 'TEXT'
+                self.conn.execute(f'ALTER TABLE entries ADD COLUMN {column} {column_type}')
+            last_rowid = 0
+            while True: # page through the table by rowid, so the records are never all in memory
+                rows = self.conn.execute('SELECT rowid, idx, data FROM entries WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (last_rowid, WRITE_CHUNK_SIZE)).fetchall()
+                if not rows: break
+                updates = [(*self._index_columns(idx, data_blob), rowid, rowid) for rowid, idx, data_blob in rows]
+                self.conn.executemany('UPDATE entries SET status = ?, rev = ?, base_idx = ?, seq = ? WHERE rowid = ?', updates)
+                last_rowid = rows[-1][0]
+    def compact(self):
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        self.conn.commit()
+    def compact_on_open(self):
+        wal_path = Path(f"{self.path}-wal")
+        if self.profile == "durable" or (wal_path.exists() and wal_path.stat().st_size > LAZY_COMPACT_WAL_BYTES):
+            self.compact()
+    def vacuum(self):
+        self.conn.commit()
+        self.conn.execute('VACUUM;')
+        self.compact()
+    def disk_size(self):
+        return sum(os.path.getsize(f"{self.path}{suffix}") for suffix in ["", "-wal", "-shm"] if os.path.exists(f"{self.path}{suffix}"))
+    def reclaimable_bytes(self):
+        "free pages of the database file, deleted rows not reusing them yet"
+        return self.conn.execute('PRAGMA freelist_count').fetchone()[0] * self.conn.execute('PRAGMA page_size').fetchone()[0]
+    def put_many(self, rows):
+        with self.conn: # a single transaction, rolled back if any record fails
+            for chunk in _chunked(rows, WRITE_CHUNK_SIZE):
+                # seq is read inside the write transaction, which holds the database lock from the first insert
+                self.conn.executemany('''
+                    INSERT OR REPLACE INTO entries (idx, data, status, rev, base_idx, seq)
+                    VALUES (?, ?, ?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM entries))
+                ''', chunk)
+    def delete_many(self, idxs):
+        with self.conn:
+            for chunk in _chunked(((idx,) for idx in idxs), WRITE_CHUNK_SIZE):
+                self.conn.executemany('DELETE FROM entries WHERE idx = ?', chunk)
+    def get_one(self, idx):
+        row = self.conn.execute('SELECT data FROM entries WHERE idx = ?', (idx,)).fetchone()
+        return None if row is None else row[0]
+    def get_many(self, idxs):
+        for chunk in _chunked(idxs, READ_CHUNK_SIZE):
+            placeholders = ",".join("?" * len(chunk))
+            yield from self.conn.execute(f'SELECT idx, data FROM entries WHERE idx IN ({placeholders})', chunk).fetchall()
+    def contains(self, idx):
+        return self.conn.execute('SELECT 1 FROM entries WHERE idx = ?', (idx,)).fetchone() is not None
+    def scan_page(self, cursor, limit, statuses=None):
+        "keyset pagination on (seq, idx), unique even if seqs are tied, one status after another so each page is a range of an index"
+        statuses = [None] if statuses is None else list(statuses)
+        bound, position, last_key = cursor or (self.max_seq(), 0, (0, ''))
+        while position < len(statuses):
+            if statuses[position] is None:
+                rows = self.conn.execute('SELECT seq, idx, data FROM entries WHERE (seq, idx) > (?, ?) AND seq <= ? ORDER BY seq, idx LIMIT ?',
+                    (*last_key, bound, limit)).fetchall()
+            else:
+                rows = self.conn.execute('SELECT seq, idx, data FROM entries WHERE status = ? AND (seq, idx) > (?, ?) AND seq <= ? ORDER BY seq, idx LIMIT ?',
+                    (statuses[position], *last_key, bound, limit)).fetchall()
+            if len(rows) == limit:
+                return [(idx, data) for _, idx, data in rows], (bound, position, (rows[-1][0], rows[-1][1]))
+            position, last_key = position + 1, (0, '')
+            if rows:
+                return [(idx, data) for _, idx, data in rows], (bound, position, (0, '')) if position < len(statuses) else None
+        return [], None
+    def count_by_status(self):
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM entries GROUP BY status').fetchall())
+    def rev_index(self):
+        return dict(self.conn.execute('SELECT idx, rev FROM entries'))
+    def revs_of(self, base_idx):
+        return self.conn.execute('SELECT rev, idx FROM entries WHERE base_idx = ? ORDER BY rev', (base_idx,)).fetchall()
+    def max_seq(self):
+        return self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM entries').fetchone()[0]
+
+_FRAME_HEADER = struct.Struct('<cIII') # kind, crc32 of meta+data, meta length, data length
+_PUT, _DELETE, _COMMIT = b'P', b'D', b'C'
+_MANIFEST = "MANIFEST"
+_HINT = "index.hint"
+
+class SegmentLogEngine(LedgerEngine):
+    """
+    Append-only log of rows, split into segment files in the directory at path.
+    - every put_many / delete_many appends its frames and a commit frame, then fsyncs if sync is set,
+        which defaults to True for the durable profile only.
+        frames after the last commit frame are a torn write, and are truncated when the log is reopened
+    - a hash index {idx: location and columns} is kept in memory, and segments are read through mmap.
+        the index is saved to a hint file by close(), so a cleanly closed log is reopened without scanning it
+    - next to it, a list of the (seq, idx) keys in order is walked by scan_page. keys of replaced and deleted rows
+        are skipped, and dropped from the list once they outnumber the live ones
+    - the active segment is sealed once it reaches segment_size, or by compact() if it holds dead bytes.
+        when the sealed segments hold more than merge_ratio of dead bytes, or there are more than max_segments
+        of them, a background thread copies their live rows into a single segment
+    - MANIFEST lists the segments in replay order and is replaced atomically, so a crash during a merge
+        keeps either the old segments or the merged one
+    """
+    suffix = '.seglog'
+    def __init__(self, path:str|Path, index_columns:Callable[[str,bytes],tuple]=None, *,
+                 segment_size:int=64<<20, merge_ratio:float=0.5, merge_min_bytes:int=1<<20, max_segments:int=16,
+                 sync:bool|None=None, profile:str=DEFAULT_PROFILE):
+        if profile not in LEDGER_PROFILES:
+            raise ValueError(f"Unknown ledger profile {profile}, expected one of {LEDGER_PROFILES}")
+        if sync is None: sync = profile == "durable"
+        self.path = Path(path)
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.merge_ratio = merge_ratio
+        self.merge_min_bytes = merge_min_bytes
+        self.sync = sync
+        self._lock = threading.RLock() # guards the index and the segment list against the merge thread
+        self._index:Dict[str,tuple] = {} # idx: (segment, data offset, data length, frame length, status, rev, base_idx, seq)
+        self._by_base:Dict[str,Set[str]] = {}
+        self._dead:Dict[str,int] = {} # dead bytes of each segment
+        self._sizes:Dict[str,int] = {}
+        self._maps:Dict[str,mmap.mmap] = {}
+        self._max_seq = 0
+        self._order:List[Tuple[int,str]]|None = None # sorted (seq, idx) keys, some of them stale, built once the index is loaded
+        self._n_stale = 0
+        self._merge_thread:threading.Thread|None = None
+        self._closed = False
+        os.makedirs(self.path, exist_ok=True)
+        self._segments:List[str] = self._read_manifest()
+        self._remove_unlisted_files()
+        if not self._load_hint():
+            for segment in self._segments:
+                self._replay(segment, is_last=segment == self._segments[-1])
+        self._order = sorted((entry[7] or 0, idx) for idx, entry in self._index.items()) # merged segments are not in seq order
+        self._n_stale = 0
+        (self.path / _HINT).unlink(missing_ok=True) # stale as soon as we write
+        self._active = open(self.path / self._segments[-1], 'ab')
+    # ---- files ----
+    def _read_manifest(self)->List[str]:
+        manifest_path = self.path / _MANIFEST
+        if manifest_path.exists():
+            with open(manifest_path, 'rb') as f:
+                return msgpack.unpackb(f.read(), raw=False)
+        segments = [self._new_segment_name([])]
+        (self.path / segments[0]).touch()
+        self._write_manifest(segments)
+        return segments
+    def _write_manifest(self, segments:List[str]):
+        tmp_path = self.path / (_MANIFEST + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(msgpack.packb(segments, use_bin_type=True))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path / _MANIFEST)
+    def _new_segment_name(self, segments:List[str])->str:
+        existing = [int(name.split('.')[0]) for name in os.listdir(self.path) if name.endswith('.seg')]
+        return f"{max(existing, default=0) + 1:08d}.seg"
+    def _remove_unlisted_files(self):
+        "segments left over by a merge that crashed before or after replacing the manifest"
+        for name in os.listdir(self.path):
+            if (name.endswith('.seg') or name.endswith('.tmp')) and name not in self._segments:
+                (self.path / name).unlink()
+    def _read(self, segment:str, offset:int, length:int)->bytes:
+        buffer = self._maps.get(segment)
+        if buffer is None or offset + length > len(buffer):
+            if buffer is not None: buffer.close()
+            if segment == self._segments[-1]: self._active.flush()
+            with open(self.path / segment, 'rb') as f:
+                buffer = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return buffer[offset:offset + length]
+    # ---- index ----
+    def _replay(self, segment:str, is_last:bool):
+        "rebuild the index from a segment, applying the frames of each committed write"
+        pending, offset, committed_end = [], 0, 0
+        with open(self.path / segment, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            while offset + _FRAME_HEADER.size <= size:
+                kind, crc, meta_len, data_len = _FRAME_HEADER.unpack(f.read(_FRAME_HEADER.size))
+                frame_len = _FRAME_HEADER.size + meta_len + data_len
+                if kind not in (_PUT, _DELETE, _COMMIT) or offset + frame_len > size: break
+                meta = f.read(meta_len)
+                if kind == _PUT:
+                    data = f.read(data_len)
+                    if zlib.crc32(data, zlib.crc32(meta)) != crc: break
+                    pending.append((kind, meta, offset + _FRAME_HEADER.size + meta_len, data_len, frame_len))
+                else:
+                    f.seek(data_len, os.SEEK_CUR)
+                    if zlib.crc32(meta) != crc: break
+                    if kind == _COMMIT:
+                        for frame in pending:
+                            self._apply_frame(segment, *frame)
+                        pending = []
+                        committed_end = offset + frame_len
+                    else:
+                        pending.append((kind, meta, 0, 0, frame_len))
+                offset += frame_len
+        self._sizes[segment] = committed_end
+        self._dead[segment] = committed_end - sum(entry[3] for entry in self._index.values() if entry[0] == segment)
+        if committed_end < size:
+            if is_last:
+                print(f"[Ledger] Truncating {size - committed_end} bytes of uncommitted writes from {self.path / segment}")
+                os.truncate(self.path / segment, committed_end)
+            else:
+                print(f"[Ledger] Warning: ignoring {size - committed_end} corrupted bytes in {self.path / segment}")
+    def _apply_frame(self, segment:str, kind:bytes, meta:bytes, data_offset:int, data_len:int, frame_len:int):
+        if kind == _PUT:
+            idx, status, rev, base_idx, seq = msgpack.unpackb(meta, raw=False)
+            self._set_entry(idx, (segment, data_offset, data_len, frame_len, status, rev, base_idx, seq))
+        else:
+            for idx in msgpack.unpackb(meta, raw=False):
+                self._drop_entry(idx)
+    def _set_entry(self, idx:str, entry:tuple):
+        self._drop_entry(idx)
+        self._index[idx] = entry
+        self._by_base.setdefault(entry[6], set()).add(idx)
+        self._max_seq = max(self._max_seq, entry[7] or 0)
+        if self._order is not None:
+            key = (entry[7] or 0, idx)
+            if not self._order or key > self._order[-1]: # seqs are assigned in order, so almost always
+                self._order.append(key)
+            else:
+                position = bisect.bisect_left(self._order, key)
+                if position == len(self._order) or self._order[position] != key:
+                    self._order.insert(position, key)
+    def _drop_entry(self, idx:str):
+        old = self._index.pop(idx, None)
+        if old is None: return
+        self._dead[old[0]] = self._dead.get(old[0], 0) + old[3]
+        self._n_stale += 1
+        if self._order is not None and self._n_stale > len(self._index):
+            self._order = [key for key in self._order if self._is_live(key)]
+            self._n_stale = 0
+        same_base = self._by_base.get(old[6])
+        if same_base is not None:
+            same_base.discard(idx)
+            if not same_base: del self._by_base[old[6]]
+    def _is_live(self, key:Tuple[int,str])->bool:
+        entry = self._index.get(key[1])
+        return entry is not None and (entry[7] or 0) == key[0]
+    def _save_hint(self):
+        hint = {"segments": self._segments, "sizes": self._sizes, "dead": self._dead, "max_seq": self._max_seq,
+                "index": [[idx, *entry] for idx, entry in self._index.items()]}
+        tmp_path = self.path / (_HINT + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(msgpack.packb(hint, use_bin_type=True))
+        os.replace(tmp_path, self.path / _HINT)
+    def _load_hint(self)->bool:
+        "load the index saved by close(), if the segments did not change since"
+        hint_path = self.path / _HINT
+        if not hint_path.exists(): return False
+        with open(hint_path, 'rb') as f:
+            hint = msgpack.unpackb(f.read(), raw=False)
+        if hint["segments"] != self._segments: return False
+        if any(os.path.getsize(self.path / segment) != hint["sizes"].get(segment) for segment in self._segments): return False
+        for idx, *entry in hint["index"]:
+            self._set_entry(idx, tuple(entry))
+        self._sizes, self._dead, self._max_seq = hint["sizes"], hint["dead"], hint["max_seq"]
+        return True
+    # ---- writes ----
+    def _write_frames(self, frames:List[Tuple[bytes,bytes,bytes]])->List[Tuple[int,int]]:
+        "append frames to the active segment, returns (data offset, frame length) of each frame"
+        segment = self._segments[-1]
+        offset = self._sizes[segment]
+        chunks, locations = [], []
+        for kind, meta, data in frames:
+            header = _FRAME_HEADER.pack(kind, zlib.crc32(data, zlib.crc32(meta)), len(meta), len(data))
+            chunks += [header, meta, data]
+            locations.append((offset + len(header) + len(meta), len(header) + len(meta) + len(data)))
+            offset += locations[-1][1]
+        self._active.write(b''.join(chunks))
+        self._sizes[segment] = offset
+        return locations
+    def _write_atomic(self, write_frames:Callable[[],List[Callable]]):
+        "run write_frames, then commit its frames and apply the index updates it returned, or cut its frames off"
+        segment = self._segments[-1]
+        start = self._sizes[segment]
+        try:
+            updates = write_frames()
+            (_, commit_len), = self._write_frames([(_COMMIT, b'', b'')])
+            self._active.flush()
+            if self.sync: os.fsync(self._active.fileno())
+        except BaseException:
+            self._active.flush()
+            self._active.truncate(start)
+            self._sizes[segment] = start
+            raise
+        self._dead[segment] = self._dead.get(segment, 0) + commit_len
+        for update in updates:
+            update()
+        self._maybe_rotate()
+    def put_many(self, rows):
+        def write_frames():
+            updates, segment = [], self._segments[-1]
+            seqs = itertools.count(self._max_seq + 1) # under the lock, and _max_seq only advances once the write is committed
+            for chunk in _chunked(rows, WRITE_CHUNK_SIZE):
+                chunk = [(*row, next(seqs)) for row in chunk]
+                frames = [(_PUT, msgpack.packb([idx, status, rev, base_idx, seq], use_bin_type=True), data)
+                          for idx, data, status, rev, base_idx, seq in chunk]
+                for (idx, data, status, rev, base_idx, seq), (data_offset, frame_len) in zip(chunk, self._write_frames(frames)):
+                    entry = (segment, data_offset, len(data), frame_len, status, rev, base_idx, seq)
+                    updates.append(lambda idx=idx, entry=entry: self._set_entry(idx, entry))
+            return updates
+        with self._lock:
+            self._write_atomic(write_frames)
+    def delete_many(self, idxs):
+        def write_frames():
+            updates, segment = [], self._segments[-1]
+            for chunk in _chunked((idx for idx in idxs if idx in self._index), WRITE_CHUNK_SIZE):
+                (_, frame_len), = self._write_frames([(_DELETE, msgpack.packb(chunk, use_bin_type=True), b'')])
+                self._dead[segment] = self._dead.get(segment, 0) + frame_len
+                updates += [lambda idx=idx: self._drop_entry(idx) for idx in chunk]
+            return updates
+        with self._lock:
+            self._write_atomic(write_frames)
+    def _maybe_rotate(self, force:bool=False):
+        "seal the active segment once it is full, and start a merge if the sealed segments hold enough dead bytes"
+        active = self._segments[-1]
+        if self._sizes[active] >= self.segment_size or (force and self._dead.get(active, 0) > 0):
+            self._active.close()
+            new_segment = self._new_segment_name(self._segments)
+            (self.path / new_segment).touch()
+            self._sizes[new_segment] = 0
+            self._segments = self._segments + [new_segment]
+            self._write_manifest(self._segments)
+            self._active = open(self.path / new_segment, 'ab')
+        sealed = self._segments[:-1]
+        dead = sum(self._dead.get(segment, 0) for segment in sealed)
+        total = sum(self._sizes[segment] for segment in sealed)
+        if dead > 0 and (len(sealed) > self.max_segments or dead >= max(self.merge_min_bytes, self.merge_ratio * total)):
+            if self._merge_thread is None or not self._merge_thread.is_alive():
+                self._merge_thread = threading.Thread(target=self._merge, args=(sealed,), daemon=True,
+                                                      name=f"LedgerMerge({self.path.name})")
+                self._merge_thread.start()
+    def _merge(self, sealed:List[str]):
+        "copy the live rows of the sealed segments into one segment, then swap it in"
+        try:
+            with self._lock:
+                live = [(idx, entry) for idx, entry in self._index.items() if entry[0] in sealed]
+                merged = self._new_segment_name(self._segments)
+                (self.path / merged).touch()
+            moved, offset = [], 0
+            files = {segment: open(self.path / segment, 'rb') for segment in sealed}
+            try:
+                with open(self.path / merged, 'wb') as out:
+                    for chunk in _chunked(live, WRITE_CHUNK_SIZE):
+                        chunks = []
+                        for idx, entry in chunk:
+                            segment, data_offset, data_len, _, status, rev, base_idx, seq = entry
+                            files[segment].seek(data_offset)
+                            data = files[segment].read(data_len)
+                            meta = msgpack.packb([idx, status, rev, base_idx, seq], use_bin_type=True)
+                            header = _FRAME_HEADER.pack(_PUT, zlib.crc32(data, zlib.crc32(meta)), len(meta), len(data))
+                            chunks += [header, meta, data]
+                            frame_len = len(header) + len(meta) + len(data)
+                            moved.append((idx, entry, (merged, offset + len(header) + len(meta), data_len, frame_len, status, rev, base_idx, seq)))
+                            offset += frame_len
+                        out.write(b''.join(chunks))
+                    out.write(_FRAME_HEADER.pack(_COMMIT, zlib.crc32(b''), 0, 0))
+                    offset += _FRAME_HEADER.size
+                    out.flush()
+                    os.fsync(out.fileno())
+            finally:
+                for f in files.values(): f.close()
+            with self._lock:
+                if self._closed: return
+                self._sizes[merged], self._dead[merged] = offset, _FRAME_HEADER.size
+                for idx, old_entry, new_entry in moved:
+                    if self._index.get(idx) is old_entry:
+                        self._index[idx] = new_entry
+                    else: # replaced or deleted while merging
+                        self._dead[merged] += new_entry[3]
+                self._segments = [merged] + [segment for segment in self._segments if segment not in sealed]
+                self._write_manifest(self._segments)
+                for segment in sealed:
+                    buffer = self._maps.pop(segment, None)
+                    if buffer is not None: buffer.close()
+                    self._sizes.pop(segment, None)
+                    self._dead.pop(segment, None)
+                    (self.path / segment).unlink()
+        except Exception as e:
+            print(f"[Ledger] Error while merging segments of {self.path}: {e}")
+    def wait_merge(self):
+        "block until the running background merge, if any, is finished"
+        thread = self._merge_thread
+        if thread is not None: thread.join()
+    def compact(self):
+        with self._lock:
+            self._maybe_rotate(force=True)
+    def vacuum(self):
+        "seal the active segment, and merge every sealed segment holding dead bytes before returning"
+        self.wait_merge()
+        with self._lock:
+            self._maybe_rotate(force=True)
+        self.wait_merge()
+        with self._lock:
+            sealed = self._segments[:-1]
+            if not any(self._dead.get(segment, 0) > 0 for segment in sealed): return
+        self._merge(sealed)
+    def disk_size(self):
+        with self._lock:
+            return sum(os.path.getsize(self.path / name) for name in os.listdir(self.path))
+    def reclaimable_bytes(self):
+        with self._lock:
+            return sum(self._dead.values())
+    # ---- reads ----
+    def get_one(self, idx):
+        with self._lock:
+            entry = self._index.get(idx)
+            return None if entry is None else self._read(entry[0], entry[1], entry[2])
+    def get_many(self, idxs):
+        with self._lock:
+            rows = []
+            for idx in idxs:
+                entry = self._index.get(idx)
+                if entry is not None:
+                    rows.append((idx, self._read(entry[0], entry[1], entry[2])))
+        return iter(rows)
+    def contains(self, idx):
+        return idx in self._index
+    def scan_page(self, cursor, limit, statuses=None):
+        "walks the (seq, idx) keys kept in order next to the index, the cursor is the bound and the last key visited"
+        with self._lock:
+            if statuses is not None: statuses = set(statuses) - {None} # like status IN (...) in SQL
+            bound, last_key = cursor or (self._max_seq, (0, ''))
+            order, rows = self._order, []
+            position = bisect.bisect_right(order, last_key)
+            while position < len(order) and order[position][0] <= bound and len(rows) < limit:
+                last_key = order[position]
+                position += 1
+                if not self._is_live(last_key): continue # deleted or rewritten since the first page
+                entry = self._index[last_key[1]]
+                if statuses is None or entry[4] in statuses:
+                    rows.append((last_key[1], self._read(entry[0], entry[1], entry[2])))
+            if position == len(order) or order[position][0] > bound:
+                return rows, None
+            return rows, (bound, last_key)
+    def count_by_status(self):
+        with self._lock:
+            return dict(Counter(entry[4] for entry in self._index.values()))
+    def rev_index(self):
+        with self._lock:
+            return {idx: entry[5] for idx, entry in self._index.items()}
+    def revs_of(self, base_idx):
+        with self._lock:
+            revs = [(self._index[idx][5], idx) for idx in self._by_base.get(base_idx, ())]
+        return sorted(revs, key=lambda rev_idx: (rev_idx[0] is not None, rev_idx[0] or 0))
+    def max_seq(self):
+        return self._max_seq
+    def close(self, delete:bool=False):
+        if not self._closed:
+            self.wait_merge()
+            with self._lock:
+                self._closed = True
+                self._active.close()
+                for buffer in self._maps.values():
+                    buffer.close()
+                self._maps.clear()
+                if not delete:
+                    self._save_hint()
+        if delete:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+LEDGER_ENGINES = {
+    "sqlite": SQLiteEngine,
+    "segment_log": SegmentLogEngine,
+}
+
+__all__ = [
+    "LedgerEngine",
+    "SQLiteEngine",
+    "SegmentLogEngine",
+]
@@ -0,0 +1,119 @@
+from .base_op import BaseOp, ApplyOp, FilterOp, PumpOptions, PumpOutput
+from .entry import Entry
+from typing import List, Dict, Tuple, TYPE_CHECKING
+import time
+if TYPE_CHECKING:
+    from .op_graph import OpGraphEdge
+    from .profiler import ExecutorProfile
+
+class FusedOp(BaseOp):
+    """
+    A linear chain of barrier-0 ApplyOps and FilterOps, pumped as one node.
+    - each entry runs through all steps in a single loop, so the executor collects, copies and updates it once
+    - only the first step may be a FilterOp that keeps rejected entries, the later filters must consume them
+    - created by fuse_chains() when compiling the graph, the original ops are kept as steps
+    """
+    stateless = True
+    def __init__(self, steps:List[BaseOp]):
+        super().__init__(n_in_ports=1, n_out_ports=1, barrier_level=0)
+        self.steps = steps
+        self.mutates_inputs = any(step.mutates_inputs for step in steps)
+        self._is_filter = [isinstance(step, FilterOp) for step in steps]
+        self.step_stats:List[List[float]] = [] # [seconds, entries in, entries out] of each step in the last pump
+    def _args_repr(self):
+        return "|".join(repr(step) for step in self.steps)
+    def reset(self):
+        for step in self.steps:
+            step.reset()
+    def compact(self):
+        for step in self.steps:
+            step.compact()
+    def state_dict(self):
+        return {"steps": [step.state_dict() for step in self.steps]}
+    def load_state_dict(self, state):
+        for step, step_state in zip(self.steps, state.get("steps", [])):
+            step.load_state_dict(step_state)
+    def pump(self, inputs, options: PumpOptions) -> PumpOutput:
+        outputs, consumed, did_emit = {0:{}}, {0:set()}, False
+        steps = list(zip(self.steps, self._is_filter, [[0.0, 0, 0] for _ in self.steps]))
+        perf_counter = time.perf_counter
+        for entry in inputs.get(0,{}).values():
+            keep = True
+            for step, is_filter, stats in steps:
+                time_start = perf_counter()
+                if is_filter:
+                    keep = step.criteria(entry)
+                else:
+                    step.update(entry)
+                stats[0] += perf_counter() - time_start
+                stats[1] += 1
+                if not keep: break
+                stats[2] += 1
+            if keep:
+                outputs[0][entry.idx] = entry
+                consumed[0].add(entry.idx)
+                did_emit = True
+            elif step.consume_rejected:
+                consumed[0].add(entry.idx)
+        self.step_stats = [stats for _, _, stats in steps]
+        return PumpOutput(outputs=outputs, consumed=consumed, did_emit=did_emit)
+    def record_steps(self, profile:'ExecutorProfile', time_start:float, tid:int=0):
+        "report the steps of the last pump to the profiler, laid out one after another inside the pump span"
+        for step, (seconds, n_in, n_out) in zip(self.steps, self.step_stats):
+            profile.record(step, "pump", time_start, seconds, tid=tid, entries_in=n_in, entries_out=n_out)
+            time_start += seconds
+
+def _is_fusable(node:BaseOp)->bool:
+    if node.barrier_level != 0: return False
+    if isinstance(node, ApplyOp): return type(node).pump is ApplyOp.pump
+    if isinstance(node, FilterOp): return type(node).pump is FilterOp.pump
+    return False
+
+def _can_follow(node:BaseOp)->bool:
+    "a filter that keeps rejected entries waiting can only start a chain"
+    return _is_fusable(node) and not (isinstance(node, FilterOp) and not node.consume_rejected)
+
+def fuse_chains(nodes:List[BaseOp], edges:List['OpGraphEdge'])->Tuple[List[BaseOp],List['OpGraphEdge'],Dict[BaseOp,BaseOp]]:
+    """
+    Replace maximal linear runs of fusable ops by FusedOps.
+    Returns the new nodes, the new edges, and {tail of each chain: fused op}, whose output ports are the same.
+    """
+    from .op_graph import OpGraphEdge
+    next_step:Dict[BaseOp,BaseOp] = {}
+    has_prev = set()
+    for edge in edges:
+        if _is_fusable(edge.source) and _can_follow(edge.target):
+            next_step[edge.source] = edge.target
+            has_prev.add(edge.target)
+    fused_of:Dict[BaseOp,FusedOp] = {}
+    for node in nodes:
+        if node not in next_step or node in has_prev: continue
+        chain, visited = [node], {node}
+        while chain[-1] in next_step and next_step[chain[-1]] not in visited:
+            chain.append(next_step[chain[-1]])
+            visited.add(chain[-1])
+        fused = FusedOp(chain)
+        for step in chain:
+            fused_of[step] = fused
+    if not fused_of:
+        return list(nodes), list(edges), {}
+    new_nodes, seen = [], set()
+    for node in nodes:
+        node = fused_of.get(node, node)
+        if node not in seen:
+            new_nodes.append(node)
+            seen.add(node)
+    new_edges = []
+    for edge in edges:
+        source, target = fused_of.get(edge.source), fused_of.get(edge.target)
+        if source is not None and source is target: continue # inside a chain
+        new_edges.append(OpGraphEdge(
+            source if source is not None else edge.source,
+            target if target is not None else edge.target,
+            edge.source_port, edge.target_port))
+    aliases = {fused.steps[-1]: fused for fused in fused_of.values()}
+    return new_nodes, new_edges, aliases
+
+__all__ = [
+    "FusedOp",
+]
@@ -1,11 +1,15 @@
 
 from .base_op import *
 from .entry import Entry
-from typing import List, Dict, Tuple, TYPE_CHECKING
+from .op_fusion import FusedOp, fuse_chains
+from typing import List, Dict, Tuple, Set, TYPE_CHECKING
 from ..lib.utils import _number_to_label
 from typing import NamedTuple
+import heapq
 if TYPE_CHECKING:
     from .executor import OpGraphExecutor
+    from concurrent.futures import Executor
+    from .profiler import ExecutorProfile
 
 class OpGraphEdge(NamedTuple):
     source: BaseOp
@@ -20,6 +24,11 @@ class Graph:
         self.head:BaseOp = None
         self.tail:BaseOp = None
         self.executor: 'OpGraphExecutor' = None
+        # adjacency indices, maintained by OpGraphConnector
+        self._node_set:Set[BaseOp] = set()
+        self._in_edges:Dict[Tuple[BaseOp,int],OpGraphEdge] = {}
+        self._out_edges:Dict[Tuple[BaseOp,int],OpGraphEdge] = {}
+        self._version = 0 # bumped on every modification, used to invalidate the compiled plan
     def to_graph(self):
         return self
     def __or__(self,other:'Graph|BaseOp')->'Graph':
@@ -31,9 +40,13 @@ class Graph:
     def wire(self,source:'str|BaseOp|Graph',target,source_port=0,target_port=0)->None:
         OpGraphConnector.wire(self, source, target, source_port, target_port)
     def is_in_port_abaliable(self,node:BaseOp,port:int)->bool:
-        return not any(e for e in self.edges if e.target == node and e.target_port == port)
+        return (node, port) not in self._in_edges
     def is_out_port_abaliable(self,node:BaseOp,port:int)->bool:
-        return not any(e for e in self.edges if e.source == node and e.source_port == port)
+        return (node, port) not in self._out_edges
+    def incoming_edge(self,node:BaseOp,port:int)->OpGraphEdge|None:
+        return self._in_edges.get((node, port))
+    def outgoing_edge(self,node:BaseOp,port:int)->OpGraphEdge|None:
+        return self._out_edges.get((node, port))
     def is_chain(self):
         return OpGraphConnector.is_chain(self)
     def get_node_by_tag(self, tag:str)->BaseOp:
@@ -44,7 +57,11 @@ class Graph:
         if self.executor is None:
             from .executor import OpGraphExecutor
             self.executor = OpGraphExecutor(self)
+        elif self.executor.graph is not self or self.executor.plan.version != self._version:
+            self.executor.reset_graph(self, fuse_ops=self.executor.plan.fuse_ops)
         return self.executor
+    def compile(self, fuse_ops:bool=False)->'OpGraphPlan':
+        return OpGraphPlan(self, fuse_ops=fuse_ops)
     def __repr__(self):
         node_info = None
         if self.executor is not None:
@@ -56,7 +73,16 @@ class Graph:
                 max_iterations = 1000, 
                 max_barrier_level:int|None = None,
                 verbose:int=0,
-                compact_after_finished:bool = True
+                compact_after_finished:bool = True,
+                stream:bool = False,
+                max_inflight:int = 10000,
+                pool:'Executor|None' = None,
+                profile:'ExecutorProfile|None' = None,
+                fuse_ops:bool = False,
+                memory_budget:int|None = None,
+                spill_dir:str|None = None,
+                snapshot_path:str|None = None,
+                snapshot_interval:float = 60.0,
                 ):
         executor = self.get_executor()
         return executor.execute(
@@ -65,9 +91,95 @@ class Graph:
             max_iterations=max_iterations, 
             max_barrier_level=max_barrier_level,
             verbose=verbose,
-            compact_after_finished=compact_after_finished
+            compact_after_finished=compact_after_finished,
+            stream=stream,
+            max_inflight=max_inflight,
+            pool=pool,
+            profile=profile,
+            fuse_ops=fuse_ops,
+            memory_budget=memory_budget,
+            spill_dir=spill_dir,
+            snapshot_path=snapshot_path,
+            snapshot_interval=snapshot_interval,
         )
 
+class OpGraphPlan:
+    """
+    Frozen view of a Graph used by the executor.
+    - nodes in topological order. loops are broken at the node added to the graph first (the loop node)
+    - adjacency maps keyed by (node, port)
+    - barrier levels and the nodes of each barrier level
+    - ancestors and descendants of each node as bitmasks over the topological order, used for parallel pumping
+    - if fuse_ops, linear chains of ApplyOps and FilterOps are replaced by FusedOps.
+        aliases maps the last op of each chain to its FusedOp, the outputs of the other ops of the chain are not kept.
+    """
+    def __init__(self, graph:Graph, fuse_ops:bool=False):
+        self.version = graph._version
+        self.fuse_ops = fuse_ops
+        nodes, self.edges = list(graph.nodes), list(graph.edges)
+        self.aliases:Dict[BaseOp,BaseOp] = {}
+        if fuse_ops:
+            nodes, self.edges, self.aliases = fuse_chains(nodes, self.edges)
+        self.fused_ops:List[FusedOp] = [node for node in nodes if isinstance(node, FusedOp)]
+        self.nodes:List[BaseOp] = _topological_order(nodes, self.edges)
+        self.order:Dict[BaseOp,int] = {node: i for i, node in enumerate(self.nodes)}
+        self.in_edges:Dict[Tuple[BaseOp,int],OpGraphEdge] = {(edge.target, edge.target_port): edge for edge in self.edges}
+        self.out_edges:Dict[Tuple[BaseOp,int],OpGraphEdge] = {(edge.source, edge.source_port): edge for edge in self.edges}
+        self.in_edges_by_node:Dict[BaseOp,List[OpGraphEdge]] = {node: [] for node in self.nodes}
+        self.out_edges_by_node:Dict[BaseOp,List[OpGraphEdge]] = {node: [] for node in self.nodes}
+        for edge in self.edges:
+            self.in_edges_by_node[edge.target].append(edge)
+            self.out_edges_by_node[edge.source].append(edge)
+        self.barrier_groups:Dict[int,List[BaseOp]] = {}
+        for node in self.nodes:
+            self.barrier_groups.setdefault(node.barrier_level, []).append(node)
+        self.barrier_levels:List[int] = sorted(set(self.barrier_groups) | {1})
+        self.descendants:List[int] = _reachability_masks(self.nodes, self.order, self.out_edges_by_node, lambda edge: edge.target)
+        self.ancestors:List[int] = _reachability_masks(self.nodes, self.order, self.in_edges_by_node, lambda edge: edge.source)
+
+def _reachability_masks(nodes, order, edges_by_node, neighbor)->List[int]:
+    "bit j of masks[i] is set if nodes[j] is reachable from nodes[i] (loops included)"
+    masks = []
+    for node in nodes:
+        mask, stack = 0, [node]
+        while stack:
+            for edge in edges_by_node[stack.pop()]:
+                j = order[neighbor(edge)]
+                if not mask >> j & 1:
+                    mask |= 1 << j
+                    stack.append(neighbor(edge))
+        masks.append(mask)
+    return masks
+
+def _topological_order(nodes:List[BaseOp], edges:List[OpGraphEdge])->List[BaseOp]:
+    "Kahn's algorithm, ties and cycles are resolved by the order nodes were added to the graph."
+    index = {node: i for i, node in enumerate(nodes)}
+    in_degree = [0] * len(nodes)
+    targets:List[List[int]] = [[] for _ in nodes]
+    for edge in edges:
+        in_degree[index[edge.target]] += 1
+        targets[index[edge.source]].append(index[edge.target])
+    ready = [i for i in range(len(nodes)) if in_degree[i] == 0]
+    heapq.heapify(ready)
+    done = [False] * len(nodes)
+    order = []
+    next_unvisited = 0
+    while len(order) < len(nodes):
+        if not ready:
+            # every remaining node waits on a loop, start from the earliest one
+            while done[next_unvisited]:
+                next_unvisited += 1
+            ready.append(next_unvisited)
+        i = heapq.heappop(ready)
+        if done[i]: continue
+        done[i] = True
+        order.append(nodes[i])
+        for j in targets[i]:
+            in_degree[j] -= 1
+            if in_degree[j] == 0 and not done[j]:
+                heapq.heappush(ready, j)
+    return order
+
 def summary_graph(title,graph,node_info=None):
     nodes, edges = graph.nodes, graph.edges
     # if graph.is_chain() and node_info is None:
@@ -104,22 +216,28 @@ class OpGraphConnector:
         if len(self.nodes) == 0:
             self.nodes = other.nodes.copy()
             self.edges = other.edges.copy()
+            self._node_set = other._node_set.copy()
+            self._in_edges = other._in_edges.copy()
+            self._out_edges = other._out_edges.copy()
+            self._version += 1
             self.head = other.head
             self.tail = other.tail
             self.executor = other.executor
             return self
         else:
             if self.executor is not None and other.executor is not None: raise ValueError("Cannot merge two OpGraphs with executors.")
-            if set(self.nodes) & set(other.nodes): raise ValueError(f"Segments {self} and {other} have overlapping nodes.")
+            if any(node in self._node_set for node in other.nodes): raise ValueError(f"Segments {self} and {other} have overlapping nodes.")
             if chain:
                 if self.tail is None: raise ValueError(f"Segment {self} has no tail node.")
                 if not self.is_out_port_abaliable(self.tail, 0): raise ValueError(f"Port 0 of tail node {self.tail} is already used.")
                 if other.head is None: raise ValueError(f"Segment {other} has no head node.")
                 if not other.is_in_port_abaliable(other.head, 0): raise ValueError(f"Port 0 of head node {other.head} is already used.")
-                self.edges.append(OpGraphEdge(self.tail, other.head, 0, 0))
+                OpGraphConnector.add_edge(self, OpGraphEdge(self.tail, other.head, 0, 0))
                 self.tail = other.tail
-            self.nodes.extend(other.nodes)
-            self.edges.extend(other.edges)
+            for node in other.nodes:
+                OpGraphConnector.add_node(self, node)
+            for edge in other.edges:
+                OpGraphConnector.add_edge(self, edge)
             if self.executor is None and other.executor is not None:
                 self.executor = other.executor
             other.executor = None
@@ -128,7 +246,7 @@ class OpGraphConnector:
     def wire(graph,source,target,source_port=0,target_port=0):
         ### Check Rejection before doing modifications
         def detect_relationship(other:Graph)->str:
-            intersection_size = len(set(graph.nodes) & set(other.nodes))
+            intersection_size = sum(1 for node in other.nodes if node in graph._node_set)
             if intersection_size == 0: return "disjoint"
             elif intersection_size == len(other.nodes): return "subgraph"
             else: return "illegal"
@@ -140,8 +258,8 @@ class OpGraphConnector:
             target = graph.get_unique_node_by_tag(target)
             if target is None:
                 raise ValueError(f"Node with tag {target} not found in the current graph.")
-        contains_source = source in graph.nodes
-        contains_target = target in graph.nodes
+        contains_source = source in graph._node_set
+        contains_target = target in graph._node_set
         if not contains_source and not contains_target:
             raise ValueError("At least one of source or target must be a node in the current graph.")
         if contains_source and not graph.is_out_port_abaliable(source, source_port):
@@ -173,14 +291,25 @@ class OpGraphConnector:
             if target_relationship == "disjoint":
                 graph.merge(target)
             target = target.head
-        graph.edges.append(OpGraphEdge(source, target, source_port, target_port))
+        OpGraphConnector.add_edge(graph, OpGraphEdge(source, target, source_port, target_port))
+    @staticmethod
+    def add_node(graph:Graph, node:BaseOp):
+        graph.nodes.append(node)
+        graph._node_set.add(node)
+        graph._version += 1
+    @staticmethod
+    def add_edge(graph:Graph, edge:OpGraphEdge):
+        graph.edges.append(edge)
+        graph._in_edges[(edge.target, edge.target_port)] = edge
+        graph._out_edges[(edge.source, edge.source_port)] = edge
+        graph._version += 1
     @staticmethod
     def make_graph(source:Graph|BaseOp)->Graph:
         if isinstance(source, Graph): 
             return source
         elif isinstance(source, BaseOp):
             node, graph= source, Graph()
-            graph.nodes.append(node)
+            OpGraphConnector.add_node(graph, node)
             graph.head = node
             graph.tail = node
             return graph
@@ -191,7 +320,7 @@ class OpGraphConnector:
         if len(graph.edges)!= len(graph.nodes) - 1:
             return False
         for i in range(len(graph.nodes) - 1):
-            if OpGraphEdge(graph.nodes[i], graph.nodes[i + 1]) not in graph.edges:
+            if graph._out_edges.get((graph.nodes[i], 0)) != OpGraphEdge(graph.nodes[i], graph.nodes[i + 1]):
                 return False
         return True
     @staticmethod
@@ -0,0 +1,110 @@
+from .entry import Entry
+from .ledger import Ledger
+from typing import Dict, Iterable, Iterator, Tuple, Set
+from dataclasses import asdict
+from pathlib import Path
+import msgpack
+
+def estimate_entry_size(entry:Entry)->int:
+    "Approximate memory footprint of an entry, measured by its msgpack size."
+    return len(msgpack.packb([entry.idx, entry.rev, entry.data, entry.meta], use_bin_type=True, default=str))
+
+class PortBuffer:
+    """
+    Entries emitted on an output port, waiting to be consumed by the downstream node.
+    - consumption pops entries in-place, so it costs O(consumed) rather than O(backlog)
+    - if track_size is set, keeps an estimate of the memory held by the buffer in nbytes
+    - spill() moves the entries held in memory to a Ledger at spill_path. only their revs stay in memory,
+        and they are read back when iterating the buffer, i.e. when the downstream node collects its inputs
+    """
+    def __init__(self, track_size:bool=False, spill_path:str|Path|None=None):
+        self.entries:Dict[str,Entry] = {} # entries held in memory
+        self.track_size = track_size
+        self.nbytes = 0 # memory held by self.entries, not including the spilled entries
+        self._sizes:Dict[str,int] = {}
+        self.spill_path = spill_path
+        self._spill_ledger:Ledger|None = None
+        self._spilled_revs:Dict[str,int] = {}
+    def __len__(self): return len(self.entries) + len(self._spilled_revs)
+    def __bool__(self): return len(self) > 0
+    def __contains__(self, idx:str): return idx in self.entries or idx in self._spilled_revs
+    def __getitem__(self, idx:str)->Entry:
+        entry = self.get(idx)
+        if entry is None: raise KeyError(idx)
+        return entry
+    def get(self, idx:str, default=None)->Entry|None:
+        if idx in self.entries:
+            return self.entries[idx]
+        if idx in self._spilled_revs:
+            return self._spill_ledger.get_one(idx, builder=lambda record: Entry(**record))
+        return default
+    def rev_of(self, idx:str)->int|None:
+        "rev of the entry, without reading a spilled entry back"
+        if idx in self.entries:
+            return self.entries[idx].rev
+        return self._spilled_revs.get(idx)
+    @property
+    def n_spilled(self)->int:
+        return len(self._spilled_revs)
+    def items(self)->Iterator[Tuple[str,Entry]]:
+        yield from self.entries.items()
+        if self._spilled_revs:
+            yield from self._spill_ledger.get_all(builder=lambda record: Entry(**record)).items()
+    def values(self)->Iterator[Entry]:
+        for _, entry in self.items():
+            yield entry
+    def put(self, entry:Entry):
+        if entry.idx in self._spilled_revs:
+            self._remove_spilled({entry.idx})
+        self.entries[entry.idx] = entry
+        if self.track_size:
+            size = estimate_entry_size(entry)
+            self.nbytes += size - self._sizes.get(entry.idx, 0)
+            self._sizes[entry.idx] = size
+    def pop_many(self, idxs:Iterable[str])->int:
+        "Remove the given idxs, returns the number of entries removed."
+        n_popped = 0
+        spilled = set()
+        for idx in idxs:
+            if self.entries.pop(idx, None) is not None:
+                n_popped += 1
+                if self.track_size:
+                    self.nbytes -= self._sizes.pop(idx, 0)
+            elif idx in self._spilled_revs:
+                spilled.add(idx)
+        if spilled:
+            self._remove_spilled(spilled)
+            n_popped += len(spilled)
+        return n_popped
+    def clear(self):
+        self.entries.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+        if self._spilled_revs:
+            self._remove_spilled(set(self._spilled_revs))
+    def spill(self)->Tuple[int,int]:
+        "Move the entries held in memory to disk. Returns the number of entries and the bytes spilled."
+        if self.spill_path is None: raise ValueError("PortBuffer has no spill_path")
+        if not self.entries: return 0, 0
+        if self._spill_ledger is None:
+            self._spill_ledger = Ledger(self.spill_path, profile="throughput") # deleted by close(), no need to fsync
+        self._spill_ledger.update_many_sync(self.entries, serializer=asdict)
+        n_entries, nbytes = len(self.entries), self.nbytes
+        self._spilled_revs.update((idx, entry.rev) for idx, entry in self.entries.items())
+        self.entries.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+        return n_entries, nbytes
+    def close(self):
+        "drop the spilled entries and delete the spill file"
+        self._spilled_revs.clear()
+        if self._spill_ledger is not None:
+            self._spill_ledger.close(delete=True)
+            self._spill_ledger = None
+    def _remove_spilled(self, idxs:Set[str]):
+        self._spill_ledger.remove_many(idxs)
+        for idx in idxs:
+            del self._spilled_revs[idx]
+
+__all__ = [
+]
@@ -0,0 +1,147 @@
+from typing import Dict, List, Any
+from dataclasses import dataclass, asdict
+import threading
+import time
+import json
+import gc
+import os
+
+@dataclass
+class NodeStats:
+    "Totals of one node over a run. times are in seconds."
+    name:str
+    n_pumps:int = 0
+    wall_time:float = 0.0 # collect + pump + update + consume
+    pump_time:float = 0.0
+    max_pump_time:float = 0.0
+    entries_in:int = 0
+    entries_out:int = 0
+    entries_consumed:int = 0
+    bytes_copied:int = 0 # only measured if ExecutorProfile.measure_bytes
+    gc_time:float = 0.0
+    gc_count:int = 0
+    entries_spilled:int = 0 # entries of the output buffers of the node spilled to disk
+    bytes_spilled:int = 0
+    entries_unspilled:int = 0 # entries read back from disk when collecting the inputs of the node
+
+class ExecutorProfile:
+    """
+    Per node and per iteration instrumentation of an OpGraphExecutor run, available as `graph.executor.profile`.
+    - `profile.nodes[name]` gives the NodeStats of a node, `profile.names[node]` gives the name of a node
+    - `profile.events` are the raw spans, exported by `to_json` and `to_chrome_trace` (open it in Perfetto or chrome://tracing)
+    - gc pauses are recorded with gc.callbacks and attributed to the node being pumped
+    """
+    def __init__(self, measure_bytes:bool=False):
+        self.measure_bytes = measure_bytes # estimating the size of copied entries costs an extra serialization
+        self.names:Dict[Any,str] = {}
+        self.nodes:Dict[str,NodeStats] = {}
+        self.events:List[Dict[str,Any]] = []
+        self.iteration = 0
+        self.total_time = 0.0
+        self._current = "executor"
+        self._gc_start = None
+        self._time_origin = time.perf_counter()
+        self._run_start = None
+    def start(self, nodes:List[Any]):
+        "register the nodes and start recording"
+        self.names, self.nodes, self.events = {}, {}, []
+        self.iteration, self.total_time = 0, 0.0
+        counts:Dict[str,int] = {}
+        for node in nodes:
+            counts[repr(node)] = counts.get(repr(node), 0) + 1
+        seen:Dict[str,int] = {}
+        for node in nodes:
+            name = repr(node)
+            if counts[name] > 1:
+                seen[name] = seen.get(name, 0) + 1
+                name = f"{name}#{seen[name]}"
+            self.names[node] = name
+            self.nodes[name] = NodeStats(name)
+        self._time_origin = self._run_start = time.perf_counter()
+        if self._on_gc not in gc.callbacks:
+            gc.callbacks.append(self._on_gc)
+    def stop(self):
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        if self._run_start is not None:
+            self.total_time = time.perf_counter() - self._run_start
+            self._run_start = None
+    def set_current(self, node):
+        "attribute the following gc pauses to node"
+        self._current = self.names.get(node, "executor") if node is not None else "executor"
+    def record(self, node, phase:str, start:float, duration:float, tid:int=0, **counts):
+        """
+        Record a span of node. phase is one of collect, pump, update, consume, gc, or an executor phase.
+        counts are added to the NodeStats fields of the same name.
+        """
+        name = self.names.get(node, "executor") if node is not None and not isinstance(node, str) else (node or "executor")
+        self.events.append({"name": name, "phase": phase, "iteration": self.iteration,
+            "start": start - self._time_origin, "duration": duration, "tid": tid, **counts})
+        stats = self.nodes.get(name)
+        if stats is None: return
+        if phase in ("collect", "pump", "update", "consume"):
+            stats.wall_time += duration
+        if phase == "pump":
+            stats.n_pumps += 1
+            stats.pump_time += duration
+            stats.max_pump_time = max(stats.max_pump_time, duration)
+        for key, value in counts.items():
+            setattr(stats, key, getattr(stats, key) + value)
+    def _on_gc(self, phase, info):
+        if threading.current_thread() is not threading.main_thread(): return
+        if phase == "start":
+            self._gc_start = time.perf_counter()
+        elif phase == "stop" and self._gc_start is not None:
+            duration = time.perf_counter() - self._gc_start
+            self.record(self._current, "gc", self._gc_start, duration, gc_time=duration, gc_count=1)
+            self.events[-1]["generation"] = info.get("generation")
+            self._gc_start = None
+    def slowest(self, n:int=10)->List[NodeStats]:
+        return sorted(self.nodes.values(), key=lambda stats: stats.wall_time, reverse=True)[:n]
+    def to_dict(self)->Dict[str,Any]:
+        return {
+            "total_time": self.total_time,
+            "iterations": self.iteration,
+            "nodes": [asdict(stats) for stats in self.nodes.values()],
+            "events": self.events,
+        }
+    def to_json(self, path:str|None=None)->str:
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            _write_text(path, text)
+        return text
+    def to_chrome_trace(self, path:str|None=None)->Dict[str,Any]:
+        "Chrome trace_event format, with one complete event per span"
+        trace_events = []
+        for event in self.events:
+            args = {k: v for k, v in event.items() if k not in ("name", "phase", "start", "duration", "tid")}
+            trace_events.append({"name": event["name"], "cat": event["phase"], "ph": "X",
+                "ts": event["start"] * 1e6, "dur": event["duration"] * 1e6,
+                "pid": 0, "tid": event["tid"], "args": args})
+        trace = {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+        if path is not None:
+            _write_text(path, json.dumps(trace))
+        return trace
+    def summary(self, min_time:float=0.0)->str:
+        text = f"[ExecutorProfile] {self.iteration} iterations, {self.total_time:.4f} seconds\n"
+        for stats in self.slowest(len(self.nodes)):
+            if stats.wall_time < min_time: continue
+            text += (f"    {stats.name}: {stats.wall_time:.4f}s (pump {stats.pump_time:.4f}s, gc {stats.gc_time:.4f}s), "
+                f"{stats.n_pumps} pumps, in {stats.entries_in}, out {stats.entries_out}, consumed {stats.entries_consumed}")
+            if self.measure_bytes:
+                text += f", copied {stats.bytes_copied} bytes"
+            if stats.bytes_spilled:
+                text += f", spilled {stats.entries_spilled} entries ({stats.bytes_spilled} bytes)"
+            text += "\n"
+        return text
+
+def _write_text(path, text):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+__all__ = [
+    "ExecutorProfile",
+    "NodeStats",
+]
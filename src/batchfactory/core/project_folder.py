@@ -6,8 +6,12 @@ from typing import Dict, Any
 _current_project: ContextVar["ProjectFolder"] = ContextVar("current_project", default=None)
 
 class ProjectFolder:
-    "Manage a versioned project folder under a common data directory."
-    def __init__(self,project_name:str,version=0,minor_version=0,patch_version=0,*,data_dir:str|Path='./data/projects'):
+    """
+    Manage a versioned project folder under a common data directory.
+    - ledger_profile is the default profile of the ledgers created in the project ("durable", "balanced" or "throughput")
+    """
+    def __init__(self,project_name:str,version=0,minor_version=0,patch_version=0,*,data_dir:str|Path='./data/projects',
+                 ledger_profile:str|None=None):
         if not isinstance(project_name, str):
             raise ValueError("Project name must be a string, not a Path object.")
         self.project_name = project_name
@@ -16,6 +20,7 @@ class ProjectFolder:
         self.root_folder.mkdir(parents=True, exist_ok=True)
         self.default_brokers:Dict[type, Any] = {}
         self.op_name_count:Dict[str, int] = {}
+        self.ledger_profile = ledger_profile
     @property
     def root_folder(self)->Path:
         version_str = '.'.join(map(str, [self.version, self.minor_version, self.patch_version]))
@@ -12,6 +12,7 @@ from asyncio import Lock
 import numpy as np
 from .base64_utils import encode_ndarray
 from enum import Enum
+import re
 
 def get_provider_name(model:str) -> str:
     return model.split('@', 1)[-1]
@@ -23,6 +24,7 @@ def get_model_provider_str(model,provider):
 class LLMClientHub:
     def __init__(self):
         self.clients = {}
+        self.client_loops = {} # {provider: event loop its AsyncOpenAI client is bound to}
         self.lock = Lock()
     def _create_client(self, provider:str, async_:bool=False) -> Union[OpenAI, AsyncOpenAI]:
         if provider not in client_desc:
@@ -33,14 +35,32 @@ class LLMClientHub:
         api_key = os.getenv(client_info['api_key_environ'])
         if not api_key:
             raise ValueError(f"API key for {provider} is not set in environment variables.")
-        return factory(api_key=api_key, base_url=base_url)
+        # the brokers retry by themselves, the async client should not hide throttling from their flow control
+        kwargs = {'max_retries': client_info.get('max_retries', 0 if async_ else 2)}
+        return factory(api_key=api_key, base_url=base_url, **kwargs)
     def get_client(self, provider:str, async_:bool=False) -> Union[OpenAI, AsyncOpenAI]:
         if (provider,async_) not in self.clients:
             self.clients[(provider, async_)] = self._create_client(provider, async_)
         return self.clients[(provider, async_)]
     async def get_client_async(self, provider:str, async_client:bool=True) -> Union[OpenAI, AsyncOpenAI]:
         async with self.lock:
+            if async_client: # the connection pool of an AsyncOpenAI cannot be used from another event loop
+                loop = asyncio.get_running_loop()
+                if self.client_loops.get(provider) is not loop:
+                    old_client = self.clients.pop((provider, True), None)
+                    self.client_loops[provider] = loop
+                    if old_client is not None:
+                        await _close_async_client(old_client)
             return self.get_client(provider, async_=async_client)
+    async def close_async_clients(self):
+        "close the AsyncOpenAI clients bound to the running event loop, before the loop ends"
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            for provider in [provider for provider, client_loop in self.client_loops.items() if client_loop is loop]:
+                del self.client_loops[provider]
+                client = self.clients.pop((provider, True), None)
+                if client is not None:
+                    await _close_async_client(client)
     def get_price_M(self, model:str, is_batch=False):
         if model not in model_desc:
             raise ValueError(f"Model {model} is not supported.")
@@ -69,6 +89,13 @@ class LLMClientHub:
             models.append(model)
         return models
 
+async def _close_async_client(client:AsyncOpenAI):
+    "close the connection pool of a client, whose connections are bound to the event loop it was used in"
+    try:
+        await client.close()
+    except RuntimeError: # that loop is already closed, LLMClientHub.close_async_clients was not called before it ended
+        pass
+
 llm_client_hub = LLMClientHub()
 
 def list_all_models(*,endpoint:str=None, provider:str=None) -> List[str]:
@@ -98,6 +125,28 @@ class LLMTokenCounter:
         self.output_tokens += output_tokens
         self.total_price += cost
 
+_CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+TOKENS_PER_MESSAGE = 4 # role and separators of each chat message
+TOKENS_PER_REPLY = 3 # priming of the assistant reply
+
+def estimate_tokens(text:str) -> int:
+    """
+    Fast local estimate of the number of tokens of a text, without a tokenizer.
+    about 4 characters per token for latin scripts, 1 token per CJK character.
+    typically within 20% of the tiktoken count, good enough for rate limiting, not for billing
+    """
+    if not text: return 0
+    n_cjk = len(_CJK_PATTERN.findall(text))
+    return n_cjk + (len(text) - n_cjk + 3) // 4
+
+def estimate_prompt_tokens(messages:Iterable) -> int:
+    "estimate_tokens of the chat messages, LLMMessage or dict, with the per message overhead"
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        content = message["content"] if isinstance(message, dict) else message.content
+        total += TOKENS_PER_MESSAGE + estimate_tokens(content)
+    return total
+
 class LLMMessage(BaseModel):
     role: str
     content: str
@@ -251,6 +300,8 @@ __all__ = [
     "LLMEmbeddingRequest",
     "LLMEmbeddingResponse",
     "LLMTokenCounter",
+    "estimate_tokens",
+    "estimate_prompt_tokens",
     "llm_client_hub",
     "list_all_models",
     "get_llm_response_async",
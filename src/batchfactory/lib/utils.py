@@ -106,6 +106,49 @@ def _pivot_cascaded_dict(dict):
             new_dict.setdefault(key2, {})[key1] = value2
     return new_dict
 
+def _json_equal(a, b)->bool:
+    "== that also tells 1, 1.0 and True apart, in nested dicts and lists too, so a patch round-trips the types"
+    if type(a) is not type(b): return False
+    if isinstance(a, dict):
+        return len(a) == len(b) and all(key in b and _json_equal(value, b[key]) for key, value in a.items())
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(_json_equal(x, y) for x, y in zip(a, b))
+    return a == b
+
+def _diff_json(old:Dict, new:Dict)->Dict:
+    """
+    Patch turning the dict old into new, applied by _patch_json.
+    {"s": set keys, "a": lists and strings extended by a suffix, "p": patches of nested dicts, "d": deleted keys}
+    """
+    patch = {}
+    for key, value in new.items():
+        if key not in old:
+            patch.setdefault("s", {})[key] = value
+            continue
+        old_value = old[key]
+        if _json_equal(old_value, value):
+            continue
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            patch.setdefault("p", {})[key] = _diff_json(old_value, value)
+        elif (isinstance(value, list) and isinstance(old_value, list) or isinstance(value, str) and isinstance(old_value, str)) \
+                and len(value) > len(old_value) and _json_equal(value[:len(old_value)], old_value):
+            patch.setdefault("a", {})[key] = value[len(old_value):]
+        else:
+            patch.setdefault("s", {})[key] = value
+    deleted = [key for key in old if key not in new]
+    if deleted: patch["d"] = deleted
+    return patch
+
+def _patch_json(old:Dict, patch:Dict)->Dict:
+    "apply a patch of _diff_json, old is not modified, but unchanged values are shared with the result"
+    new = {key: value for key, value in old.items() if key not in patch.get("d", ())}
+    new.update(patch.get("s", {}))
+    for key, suffix in patch.get("a", {}).items():
+        new[key] = old[key] + suffix
+    for key, sub_patch in patch.get("p", {}).items():
+        new[key] = _patch_json(old[key], sub_patch)
+    return new
+
 class CollectionsUtil:
     @staticmethod
     def pivot_cascaded_dict(dict_:Dict[Any,Dict]):
@@ -1,10 +1,10 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Tuple, Set
+from typing import Dict, Tuple, Set, Literal
 from enum import Enum
 from copy import deepcopy
 from ..core.entry import Entry
 from ..core.base_op import PumpOptions
-from .checkpoint_op import CheckpointOp
+from .checkpoint_op import CheckpointOp, KEYFRAME_EVERY
 from ..core.broker import Broker, BrokerJobStatus, BrokerJobRequest, BrokerJobResponse
 
 class BrokerFailureBehavior(str,Enum):
@@ -30,9 +30,14 @@ class BrokerOp(CheckpointOp,ABC):
                     job_idx_key: str = "job_idx",
                     keep_all_rev: bool = True,
                     failure_behavior:BrokerFailureBehavior = BrokerFailureBehavior.STAY,
-                    barrier_level: int = 1
+                    barrier_level: int = 1,
+                    rev_retention: int|Literal["in_flight"]|None = None,
+                    rev_storage: Literal["full","delta"] = "full",
+                    keyframe_every: int = KEYFRAME_EVERY,
+                    ledger_profile: str|None = None,
                     ):
-            super().__init__(cache_path, keep_all_rev=keep_all_rev, barrier_level=barrier_level)
+            super().__init__(cache_path, keep_all_rev=keep_all_rev, barrier_level=barrier_level, rev_retention=rev_retention,
+                             rev_storage=rev_storage, keyframe_every=keyframe_every, ledger_profile=ledger_profile)
             self.broker = broker
             self.input_key = input_key
             self.output_key = output_key
@@ -105,6 +110,7 @@ class BrokerOp(CheckpointOp,ABC):
         """
         batch = {}
         consumed_job_idxs = set()
+        responses = []
         for response in self.broker.get_job_responses().values():
             # note that entry_idx is not job_idx
             entry_idx = response.meta.get("entry_idx", None)
@@ -115,7 +121,13 @@ class BrokerOp(CheckpointOp,ABC):
             if not self._contains(entry_idx, rev=rev):
                 print(f"Response {response.job_idx} has no matching entry in the ledger, skipping.")
                 continue
-            entry:Entry = self._get_entry(entry_idx, rev=rev)
+            responses.append((response, self._record_idx(entry_idx, rev)))
+        cached_entries = self._get_entries({record_idx for _, record_idx in responses})
+        for response, record_idx in responses:
+            entry:Entry = cached_entries.get(record_idx)
+            if entry is None:
+                print(f"Response {response.job_idx} has no matching entry in the ledger, skipping.")
+                continue
             if entry.data[self.job_idx_key] != response.job_idx:
                 # this is a common situation when the same entry_idx on different parallel routes enters the same broker
                 continue
@@ -1,39 +1,123 @@
 from dataclasses import dataclass, field, asdict
 from abc import ABC, abstractmethod
-from typing import Union, List, Any, Tuple, Iterator, Dict, Set, Literal
+from typing import Union, List, Any, Tuple, Iterator, Dict, Set, Literal, Iterable
+from copy import deepcopy
 import os
 
 from ..core.entry import Entry
 from ..core.project_folder import ProjectFolder
 from ..core.ledger import Ledger
 from ..core.base_op import BaseOp, PumpOptions, PumpOutput
-from ..lib.utils import ReprUtil
+from ..lib.utils import ReprUtil, _diff_json, _patch_json
 from ._registery import show_in_op_list
 
+KEYFRAME_EVERY=32 # with rev_storage="delta", at most this many revisions are chained to a full one
+DELTA_BASES_MAX_IDXS=4096 # with rev_storage="delta", idxs whose last revisions are kept in memory to patch against. an evicted idx gets a keyframe next
+VACUUM_FREE_FRACTION=0.25 # compact() only rewrites the cache file when nothing was pruned if this much of it is free
 
 class CheckpointOp(BaseOp, ABC):
     """
     - constantly save its output to a cache
     - consume all inputs, including the one being invalidated by the newer version in the cache
+    - the rev of every cached record is indexed in memory, so a pump reads and writes the cache in bulk
+    - with keep_all_rev, rev_retention limits the revisions kept in the cache when compact() or vacuum() is called:
+        - None keeps all of them, so a rerun of a loop finds every round in the cache
+        - an int K keeps the K newest revisions of each idx
+        - "in_flight" keeps the revisions at or after the one each idx last entered this op with in the current run,
+            and the newest revision of the other idxs
+    - with keep_all_rev and rev_storage="delta", a revision is stored as a patch against the previous revision written by this op,
+        with a full keyframe every keyframe_every revisions, and whenever the previous revision is not in memory (e.g. after a restart).
+        revisions are rebuilt transparently when read, whatever rev_storage is
     """
-    def __init__(self,cache_path:str|None,*,keep_all_rev:bool,barrier_level:int):
+    def __init__(self,cache_path:str|None,*,keep_all_rev:bool,barrier_level:int,rev_retention:int|Literal["in_flight"]|None=None,
+                 rev_storage:Literal["full","delta"]="full",keyframe_every:int=KEYFRAME_EVERY,ledger_profile:str|None=None):
         if cache_path is None:
             cache_path = ProjectFolder.get_current().generate_op_path(self)
         if barrier_level < 1: raise ValueError("barrier_level of CheckpointOp must be at least 1")
+        if rev_retention is not None and not keep_all_rev:
+            raise ValueError("rev_retention of CheckpointOp requires keep_all_rev")
+        if not (rev_retention is None or rev_retention == "in_flight" or (isinstance(rev_retention, int) and rev_retention >= 1)):
+            raise ValueError(f"rev_retention must be None, a positive int or 'in_flight', got {rev_retention}")
+        if rev_storage not in ("full", "delta"):
+            raise ValueError(f"rev_storage must be 'full' or 'delta', got {rev_storage}")
+        if rev_storage == "delta" and not keep_all_rev:
+            raise ValueError("rev_storage='delta' of CheckpointOp requires keep_all_rev")
+        if keyframe_every < 1: raise ValueError(f"keyframe_every must be positive, got {keyframe_every}")
         super().__init__(n_in_ports=1, n_out_ports=1, barrier_level=barrier_level)
-        self._ledger = Ledger(cache_path)
+        self._ledger = Ledger(cache_path, keyed_by_rev=keep_all_rev, profile=ledger_profile)
         self.keep_all_rev = keep_all_rev
+        self.rev_retention = rev_retention
+        self.rev_storage = rev_storage
+        self.keyframe_every = keyframe_every
         self.emitted_revs = {} # prevent the same entry being emitted twice
+        self.input_revs = {} # newest rev of each idx deposited in this run, for rev_retention="in_flight"
+        self._cached_revs:Dict[str,int]|None = None # {ledger idx: rev} of the cache, loaded once per run
+        self._newest_revs:Dict[str,int]|None = None # {idx: newest cached rev}, for rev_storage="delta"
+        self._delta_bases:Dict[str,Dict[int,tuple]] = {} # {idx: {rev: (record without idx and rev, chain depth)}} of the last revisions written, least recently written idx first
 
     def _args_repr(self): return ReprUtil.repr_path(self._ledger.path)
 
     def reset(self):
         super().reset()
         self.emitted_revs.clear()
+        self.input_revs.clear()
+        self._cached_revs = None
+        self._newest_revs = None
+        self._delta_bases.clear()
+
+    def state_dict(self):
+        return {"emitted_revs": self.emitted_revs, "input_revs": self.input_revs}
+
+    def load_state_dict(self, state):
+        self.emitted_revs.update(state.get("emitted_revs", {}))
+        self.input_revs.update(state.get("input_revs", {}))
 
     def compact(self):
         super().compact()
-        self._ledger.compact()
+        if self.rev_retention is not None:
+            self.vacuum()
+        else:
+            self._ledger.compact()
+
+    def vacuum(self)->int:
+        """
+        remove the revisions outside rev_retention from the cache, and reclaim their space. returns the bytes freed.
+        the storage is only rewritten if revisions were removed, or more than VACUUM_FREE_FRACTION of it is reclaimable
+        """
+        size_before = self._ledger.disk_size()
+        stale, oldest_kept = self._get_stale_record_idxs()
+        if stale:
+            self._rewrite_as_keyframes(oldest_kept) # their base revisions are removed
+            self._ledger.remove_many(stale)
+            cached_revs = self._get_cached_revs()
+            for record_idx in stale:
+                rev = cached_revs.pop(record_idx, None)
+                self._delta_bases.get(self._split_record_idx(record_idx, rev), {}).pop(rev, None)
+        if stale or self._ledger.reclaimable_bytes() > VACUUM_FREE_FRACTION * size_before:
+            self._ledger.vacuum()
+        else:
+            self._ledger.compact()
+        return max(size_before - self._ledger.disk_size(), 0)
+
+    def _get_stale_record_idxs(self)->Tuple[List[str],List[str]]:
+        "record idxs of the revisions outside rev_retention, and of the oldest revision kept of each idx having some"
+        if self.rev_retention is None: return [], []
+        revs_of_idx:Dict[str,List[int]] = {}
+        for record_idx, rev in self._get_cached_revs().items():
+            idx = self._split_record_idx(record_idx, rev)
+            if idx is not None:
+                revs_of_idx.setdefault(idx, []).append(rev)
+        stale, oldest_kept = [], []
+        for idx, revs in revs_of_idx.items():
+            revs.sort(reverse=True)
+            if self.rev_retention == "in_flight":
+                n_kept = sum(rev >= min(self.input_revs.get(idx, revs[0]), revs[0]) for rev in revs)
+            else:
+                n_kept = self.rev_retention
+            if len(revs) > n_kept:
+                stale.extend(self._record_idx(idx, rev) for rev in revs[n_kept:])
+                oldest_kept.append(self._record_idx(idx, revs[n_kept - 1]))
+        return stale, oldest_kept
 
 
     @abstractmethod
@@ -51,37 +135,134 @@ class CheckpointOp(BaseOp, ABC):
         "check if the entry is being processed and ready for output"
         pass
 
-    def _deposit_batch(self, batch:Dict[str,Entry]):
-        """
-        - Queue entries and save to the cache
-        - rejects entries with same idx, unless rev is larger
-        """
-        submit_records = {}
+    def _get_cached_revs(self)->Dict[str,int]:
+        if self._cached_revs is None:
+            self._cached_revs = self._ledger.get_rev_index()
+        return self._cached_revs
+
+    def _get_newest_revs(self)->Dict[str,int]:
+        if self._newest_revs is None:
+            self._newest_revs = {}
+            for record_idx, rev in self._get_cached_revs().items():
+                idx = self._split_record_idx(record_idx, rev)
+                if idx is not None and rev > self._newest_revs.get(idx, -1):
+                    self._newest_revs[idx] = rev
+        return self._newest_revs
+
+    def _write_newer(self, batch:Dict[str,Entry], allow_same_rev:bool):
+        "save the entries whose rev is larger than the cached one, or equal if allow_same_rev"
+        cached_revs = self._get_cached_revs()
+        submit_records, overwritten, new_bases = {}, [], {}
         for entry in batch.values():
-            record = self._serialize_entry(entry)
-            record_idx = record['idx']
-            old_record = self._ledger.get_one(record_idx, default=None)
-            if old_record is not None and record['rev'] <= old_record['rev']:
+            record_idx = self._record_idx(entry.idx, entry.rev)
+            old_rev = cached_revs.get(record_idx)
+            if old_rev is not None and (entry.rev < old_rev or (entry.rev == old_rev and not allow_same_rev)):
                 continue
+            record = self._serialize_entry(entry)
+            if self.rev_storage == "delta":
+                if old_rev is not None: overwritten.append((entry.idx, entry.rev))
+                record, new_bases[entry.idx] = self._encode_delta(entry.idx, record)
             submit_records[record_idx] = record
         if len(submit_records) > 0:
+            if overwritten:
+                self._rewrite_dependents(overwritten)
             self._ledger.update_many_sync(submit_records)
+            cached_revs.update((record_idx, record['rev']) for record_idx, record in submit_records.items())
+            for idx, (rev, base) in new_bases.items(): # only remembered once written
+                bases = self._delta_bases.pop(idx, {}) # reinserted as the most recently written
+                self._delta_bases[idx] = bases
+                bases[rev] = base
+                for old_rev in sorted(bases)[:-2]: # the revision written last and its base
+                    del bases[old_rev]
+                if len(self._delta_bases) > DELTA_BASES_MAX_IDXS:
+                    del self._delta_bases[next(iter(self._delta_bases))]
+                if self._newest_revs is not None and rev > self._newest_revs.get(idx, -1):
+                    self._newest_revs[idx] = rev
+
+    def _encode_delta(self, idx:str, record:Dict)->Tuple[Dict, Tuple[int, tuple]]:
+        "the record to store, as a patch against the previous revision in memory if any, and (rev, new base)"
+        body = {key: value for key, value in record.items() if key not in ("idx", "rev")}
+        bases = self._delta_bases.get(idx, {})
+        base_rev = max((rev for rev in bases if rev < record['rev']), default=None)
+        if base_rev is None or bases[base_rev][1] + 1 >= self.keyframe_every:
+            return record, (record['rev'], (body, 0))
+        base_body, base_depth = bases[base_rev]
+        delta_record = {"idx": record['idx'], "rev": record['rev'], "base_rev": base_rev, "delta": _diff_json(base_body, body)}
+        return delta_record, (record['rev'], (body, base_depth + 1))
+
+    def _rewrite_dependents(self, idx_revs:List[Tuple[str,int]]):
+        "before revisions are overwritten, store the newer revisions patched against them as keyframes"
+        newest_revs = self._get_newest_revs()
+        overwritten = {self._record_idx(idx, rev) for idx, rev in idx_revs if newest_revs.get(idx, -1) > rev}
+        if not overwritten: return
+        newer = [self._record_idx(idx, newer_rev) for idx, rev in idx_revs if self._record_idx(idx, rev) in overwritten
+                 for newer_rev in self._ledger.get_revs(idx) if newer_rev > rev]
+        self._rewrite_as_keyframes(record_idx for record_idx, record in self._ledger.get_many(newer).items()
+                                   if "delta" in record and self._base_record_idx(record) in overwritten)
+
+    def _rewrite_as_keyframes(self, record_idxs:Iterable[str]):
+        "store the revisions saved as patches in full"
+        records = self._ledger.get_many(record_idxs)
+        keyframes = self._resolve_records({record_idx: record for record_idx, record in records.items() if "delta" in record})
+        if not keyframes: return
+        self._ledger.update_many_sync(keyframes)
+        for record in keyframes.values():
+            idx = self._split_record_idx(record['idx'], record['rev'])
+            bases = self._delta_bases.get(idx, {})
+            if record['rev'] in bases:
+                bases[record['rev']] = (bases[record['rev']][0], 0)
+
+    def _base_record_idx(self, record:Dict)->str:
+        return self._record_idx(self._split_record_idx(record['idx'], record['rev']), record['base_rev'])
+
+    def _resolve_records(self, records:Dict[str,Dict])->Dict[str,Dict]:
+        "rebuild the revisions stored as patches, reading their base revisions in bulk"
+        known = dict(records)
+        while True:
+            wanted = {self._base_record_idx(record) for record in known.values() if "delta" in record} - known.keys()
+            if not wanted: break
+            fetched = self._ledger.get_many(wanted)
+            if len(fetched) < len(wanted):
+                raise ValueError(f"Missing base revisions {sorted(wanted - fetched.keys())[:5]} in {self._ledger.path}")
+            known.update(fetched)
+        resolved, used_as_base = {}, set()
+        for record_idx in records:
+            chain = []
+            while record_idx not in resolved and "delta" in known[record_idx]:
+                chain.append(record_idx)
+                record_idx = self._base_record_idx(known[record_idx])
+            if chain:
+                used_as_base.add(record_idx)
+                used_as_base.update(chain[1:])
+            record = resolved.get(record_idx, known[record_idx])
+            for delta_idx in reversed(chain):
+                delta_record = known[delta_idx]
+                body = _patch_json({key: value for key, value in record.items() if key not in ("idx", "rev")}, delta_record["delta"])
+                record = resolved[delta_idx] = {"idx": delta_record["idx"], "rev": delta_record["rev"], **body}
+        # a record the others are rebuilt from shares its unchanged values with them
+        return {record_idx: deepcopy(record) if record_idx in used_as_base else record
+                for record_idx, record in ((record_idx, resolved.get(record_idx, known[record_idx])) for record_idx in records)}
+
+    def _get_entries(self, record_idxs:Iterable[str])->Dict[str,Entry]:
+        "{record idx: entry} of the cached revisions"
+        records = self._ledger.get_many(record_idxs)
+        if any("delta" in record for record in records.values()):
+            records = self._resolve_records(records)
+        return {record_idx: self._build_entry(record) for record_idx, record in records.items()}
+
+    def _deposit_batch(self, batch:Dict[str,Entry]):
+        """
+        - Queue entries and save to the cache
+        - rejects entries with same idx, unless rev is larger
+        """
+        self._write_newer(batch, allow_same_rev=False)
 
     def update_batch(self, batch:Dict[str,Entry]):
         """
         - Update the cache with the batch
         - accepts entries with same idx, unless rev is smaller
         """
-        submit_records = {}
-        for entry in batch.values():
-            record = self._serialize_entry(entry)
-            record_idx = record['idx']
-            old_record = self._ledger.get_one(record_idx, default=None)
-            if old_record is not None and record['rev'] < old_record['rev']:
-                continue
-            submit_records[record_idx] = record
-        if len(submit_records) > 0:
-            self._ledger.update_many_sync(submit_records)
+        self._write_newer(batch, allow_same_rev=True)
     
     def _get_up_to_date_batch(self,input_batch:Dict[str,Entry])->Dict[str, Entry]:
         """
@@ -90,23 +271,24 @@ class CheckpointOp(BaseOp, ABC):
         2. have the latest revision in the cache, and its rev >= input_batch[idx].rev
         3. sorted in the order given by input_batch
         """
-        newest_entries = {}
-        for idx,input_entry in input_batch.items():
-            if not self._contains(idx, input_batch[idx].rev):
-                continue
-            cached_entry = self._get_entry(idx, input_batch[idx].rev)
-            if cached_entry.rev < input_entry.rev:
-                continue
-            if idx in newest_entries and cached_entry.rev < newest_entries[idx].rev:
+        cached_revs = self._get_cached_revs()
+        record_idxs = {}
+        for idx, input_entry in input_batch.items():
+            record_idx = self._record_idx(idx, input_entry.rev)
+            cached_rev = cached_revs.get(record_idx)
+            if cached_rev is None or cached_rev < input_entry.rev:
                 continue
-            newest_entries[idx] = cached_entry
-        return newest_entries
+            record_idxs[idx] = record_idx
+        cached_entries = self._get_entries(record_idxs.values())
+        return {idx: cached_entries[record_idx] for idx, record_idx in record_idxs.items() if record_idx in cached_entries}
     
     def pump(self, inputs: Dict[int, Dict[str, Entry]], options: PumpOptions) -> PumpOutput:
         input_batch = inputs.get(0, {})
         if input_batch:
             for entry in input_batch.values():
                 self.prepare_input(entry)
+                if entry.rev > self.input_revs.get(entry.idx, -1):
+                    self.input_revs[entry.idx] = entry.rev
             self._deposit_batch(input_batch)
 
         cached_batch = self._get_up_to_date_batch(input_batch)
@@ -125,17 +307,20 @@ class CheckpointOp(BaseOp, ABC):
             self.emitted_revs[idx] = entry.rev
         return PumpOutput(outputs, consumed, did_emit)
     
+    def _record_idx(self, idx: str, rev: int)->str:
+        "idx of the entry in the ledger"
+        return f"{idx}_{rev}" if self.keep_all_rev else idx
+
+    def _split_record_idx(self, record_idx:str, rev:int|None)->str|None:
+        "idx of a record idx, None if it is not keyed by rev"
+        if not self.keep_all_rev or rev is None or not record_idx.endswith(f"_{rev}"): return None
+        return record_idx[:-len(f"_{rev}")]
+
     def _get_entry(self, idx: str, rev: int)->Entry:
-        if self.keep_all_rev:
-            return self._ledger.get_one(f"{idx}_{rev}", builder=self._build_entry)
-        else:
-            return self._ledger.get_one(idx, builder=self._build_entry)
-    
+        return self._get_entries([self._record_idx(idx, rev)]).get(self._record_idx(idx, rev))
+
     def _contains(self, idx: str, rev: int)->bool:
-        if self.keep_all_rev:
-            return self._ledger.contains(f"{idx}_{rev}")
-        else:
-            return self._ledger.contains(idx)
+        return self._record_idx(idx, rev) in self._get_cached_revs()
 
     def _serialize_entry(self,entry:Entry)->Dict[str, Any]:
         record = asdict(entry)
@@ -152,8 +337,12 @@ class CheckPoint(CheckpointOp):
     """
     A no-op checkpoint that saves inputs to the cache, and resumes from the cache.
     """
-    def __init__(self, cache_path: str = None,*, keep_all_rev: bool = True, barrier_level: int = 1):
-        super().__init__(cache_path, keep_all_rev=keep_all_rev, barrier_level=barrier_level)
+    mutates_inputs = False
+    def __init__(self, cache_path: str = None,*, keep_all_rev: bool = True, barrier_level: int = 1,
+                 rev_retention:int|Literal["in_flight"]|None = None, rev_storage:Literal["full","delta"] = "full",
+                 keyframe_every:int = KEYFRAME_EVERY, ledger_profile:str|None = None):
+        super().__init__(cache_path, keep_all_rev=keep_all_rev, barrier_level=barrier_level, rev_retention=rev_retention,
+                         rev_storage=rev_storage, keyframe_every=keyframe_every, ledger_profile=ledger_profile)
     def prepare_input(self, entry: Entry) -> None:
         pass
     def process_cached_batch(self, cached_newest_batch: Dict[str, Entry], options: PumpOptions) -> None:
@@ -147,6 +147,7 @@ class RenameField(ApplyOp):
 @show_in_op_list
 class Shuffle(BatchOp):
     """Shuffle the entries in a batch randomly."""
+    mutates_inputs = False
     def __init__(self,*, seed, barrier_level = 1):
         super().__init__(consume_all_batch=True, barrier_level=barrier_level)
         self.seed = seed
@@ -160,6 +161,7 @@ class Shuffle(BatchOp):
 @show_in_op_list
 class TakeFirstN(BatchOp):
     """Takes the first N entries from the batch. discards the rest."""
+    mutates_inputs = False
     def __init__(self, n: int,*, offset=0, barrier_level = 1):
         super().__init__(consume_all_batch=True, barrier_level=barrier_level)
         self.n = n
@@ -170,6 +172,7 @@ class TakeFirstN(BatchOp):
     
 @show_in_op_list
 class SamplePropotion(BatchOp):
+    mutates_inputs = False
     def __init__(self, p:float, *, seed:int, barrier_level = 1):
         super().__init__(consume_all_batch=True, barrier_level=barrier_level)
         self.p = p
@@ -185,6 +188,7 @@ class SamplePropotion(BatchOp):
 @show_in_op_list
 class Sort(BatchOp):
     """Sort the entries in a batch"""
+    mutates_inputs = False
     def __init__(self, *keys, reverse=False, custom_func: Callable[[Dict],Any] = None, barrier_level = 1):
         super().__init__(consume_all_batch=True, barrier_level=barrier_level)
         self.keys = KeysUtil.make_keys(*keys, allow_empty=False) if keys else None
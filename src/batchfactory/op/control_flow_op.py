@@ -14,6 +14,7 @@ if TYPE_CHECKING:
 @show_in_op_list
 class Replicate(SplitOp):
     "Replicate an entry to all output ports."
+    mutates_inputs = False # copies the entry itself
     def __init__(self, n_out_ports:int = 2,*, replica_idx_key:str|None="replica_idx"):
         super().__init__(n_out_ports=n_out_ports)
         self.replica_idx_key = replica_idx_key
@@ -44,6 +45,7 @@ class CollectField(RouterOp):
 
 class BeginIfOp(SplitOp,ABC):
     "Switch to port 1 if criteria is met."
+    mutates_inputs = False
     def __init__(self):
         super().__init__(n_out_ports=2)
     def split(self, entry: Entry) -> Dict[int, Entry]:
@@ -75,6 +77,7 @@ class BeginIf(BeginIfOp):
 
 class EndIf(MergeOp):
     "Join entries from either port 0 or port 1. See `If` function for usage."
+    mutates_inputs = False
     def __init__(self):
         super().__init__(n_in_ports=2, wait_all=False)
     def merge(self, entries: Dict[int, Entry]) -> Entry:
@@ -263,6 +266,7 @@ class ExplodeList(BatchOp):
     Explode an entry to multiple entries based on a list (or lists).
     if keep_others == True, copy all other fields expect the in_lists_keys
     """
+    mutates_inputs = False # spawn entries are built from a copy of the data
     def __init__(self, in_lists_keys="list", out_lists_keys="item",
                  *,
                  master_idx_key="master_idx", list_idx_key="list_idx",
@@ -245,7 +245,15 @@ class WriteJsonl(OutputOp):
         super().__init__()
         self.path = path
         self.output_keys = _to_list_2(output_keys) if output_keys else None
+        self._has_written = False
     def _args_repr(self): return ReprUtil.repr_path(self.path)
+    def reset(self):
+        super().reset()
+        self._has_written = False
+    def state_dict(self):
+        return {"has_written": self._has_written}
+    def load_state_dict(self, state):
+        self._has_written = state.get("has_written", False)
     def output_batch(self,batch:Dict[str,Entry])->None:
         os.makedirs(os.path.dirname(self.path), exist_ok=True)
         output_entries = {}
@@ -254,10 +262,12 @@ class WriteJsonl(OutputOp):
                 print("failed to update entry:", entry.idx, "rev:", entry.rev)
                 continue
             output_entries[entry.idx] = entry
-        with jsonlines.open(self.path, 'w') as writer:
+        # overwrite the file on the first batch of a run, append the later batches (micro-batches in streaming mode)
+        with jsonlines.open(self.path, 'a' if self._has_written else 'w') as writer:
             for entry in output_entries.values():
                 record = self._prepare_output(entry)
                 writer.write(record)
+        self._has_written = True
         print(f"[WriteJsonl]: Output {len(output_entries)} entries to {os.path.abspath(self.path)}")
     def _prepare_output(self,entry:Entry):
         if not self.output_keys:
@@ -630,6 +640,10 @@ class ToList(OutputOp):
             self._output_entries[idx] = record
     def get_output(self) -> List[Dict|Any]:
         return list(self._output_entries.values())
+    def state_dict(self):
+        return {"output_entries": self._output_entries}
+    def load_state_dict(self, state):
+        self._output_entries.update(state.get("output_entries", {}))
     
 @show_in_op_list
 class OutputEntries(OutputOp):
@@ -645,6 +659,11 @@ class OutputEntries(OutputOp):
             self._output_entries[idx] = entry
     def get_output(self) -> List[Entry]:
         return list(self._output_entries.values())
+    def state_dict(self):
+        return {"output_entries": [asdict(entry) for entry in self._output_entries.values()]}
+    def load_state_dict(self, state):
+        for record in state.get("output_entries", []):
+            self._output_entries[record["idx"]] = Entry(**record)
 
 
 @show_in_op_list
@@ -1,6 +1,6 @@
 from ..core.entry import Entry
 from ..core.base_op import ApplyOp, OutputOp
-from ..lib.llm_backend import LLMRequest, LLMMessage, LLMResponse, llm_client_hub
+from ..lib.llm_backend import LLMRequest, LLMMessage, LLMResponse, llm_client_hub, estimate_prompt_tokens
 from ..lib.prompt_maker import PromptMaker
 from ..lib.utils import get_format_keys, hash_texts, ReprUtil
 from ..brokers.llm_broker import LLMBroker
@@ -12,7 +12,7 @@ from ..core.project_folder import ProjectFolder
 from ._registery import show_in_op_list
 from .llm_op import GenerateLLMRequest, CleanupLLMData, ExtractResponseText, CallLLM
 from . import functional as F
-from typing import List, Dict, NamedTuple, Set, Tuple, Any
+from typing import List, Dict, NamedTuple, Set, Tuple, Any, Literal
 from pathlib import Path
 
 
@@ -98,6 +98,7 @@ class TransformCharacterDialogueForLLM(ApplyOp):
             else:
                 output_messages.append(LLMMessage(role=role, content=context))
         llm_request.messages = output_messages
+        llm_request.estimated_prompt_tokens = estimate_prompt_tokens(output_messages)
         entry.data[self.input_key] = llm_request.model_dump()
 
 
@@ -121,6 +122,9 @@ class AICharacter:
             remove_cot:bool=True,
             chat_history_key="chat_history",
             failure_behavior:BrokerFailureBehavior=BrokerFailureBehavior.STAY,
+            rev_retention:int|Literal["in_flight"]|None=None,
+            rev_storage:Literal["full","delta"]="full",
+            ledger_profile:str|None=None,
             ):
         if name is not None and name_key is not None:
             raise ValueError("Only one of character_name or character_name_key should be provided.")
@@ -136,6 +140,9 @@ class AICharacter:
         self.remove_cot = remove_cot
         self.chat_history_key = chat_history_key
         self.failure_behavior = failure_behavior
+        self.rev_retention = rev_retention # of the CallLLM caches, which keep a revision per dialogue round
+        self.rev_storage = rev_storage
+        self.ledger_profile = ledger_profile # of the CallLLM caches
         self._call_count=0
     def __repr__(self):
         return f"AICharacter({self.name or self.name_key})"
@@ -166,6 +173,9 @@ class AICharacter:
             status_key="llm_status",
             job_idx_key="llm_job_idx",
             failure_behavior=self.failure_behavior,
+            rev_retention=self.rev_retention,
+            rev_storage=self.rev_storage,
+            ledger_profile=self.ledger_profile,
         )
         g |= ExtractResponseText(
             input_key="llm_response",
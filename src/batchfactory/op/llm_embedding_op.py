@@ -69,6 +69,9 @@ class CallLLMEmbedding(BrokerOp):
                 keep_all_rev: bool = True,
                 failure_behavior: BrokerFailureBehavior = BrokerFailureBehavior.STAY,
                 barrier_level: int = 1,
+                rev_retention: int|Literal["in_flight"]|None = None,
+                rev_storage: Literal["full","delta"] = "full",
+                ledger_profile: str|None = None,
                 ):
         if broker is None: broker = ProjectFolder.get_current().get_default_broker(LLMEmbeddingBroker)
         if not isinstance(broker, LLMEmbeddingBroker): raise ValueError(f"Expected broker to be of type LLMEmbeddingBroker, got {type(broker)}")
@@ -81,7 +84,10 @@ class CallLLMEmbedding(BrokerOp):
             job_idx_key=job_idx_key,
             keep_all_rev=keep_all_rev,
             failure_behavior=failure_behavior,
-            barrier_level=barrier_level
+            barrier_level=barrier_level,
+            rev_retention=rev_retention,
+            rev_storage=rev_storage,
+            ledger_profile=ledger_profile,
         )
 
     def generate_job_idx(self, entry):
@@ -95,10 +101,10 @@ class CallLLMEmbedding(BrokerOp):
             allowed_status = [BrokerJobStatus.FAILED, BrokerJobStatus.QUEUED]
         else:
             allowed_status = [BrokerJobStatus.QUEUED]
-        requests = self.broker.get_job_requests(allowed_status)
-        if len(requests) == 0:
+        n_jobs = self.broker.count_job_requests(allowed_status)
+        if n_jobs == 0:
             return
-        self.broker.process_jobs(requests, mock=mock)
+        self.broker.process_jobs(self.broker.iter_job_requests(allowed_status), mock=mock, n_jobs=n_jobs)
 
 class CleanupLLMEmbeddingData(RemoveField):
     "Clean up the internal fields for LLM processing, such as `embedding_request`, `embedding_response`, `status`, `job_idx`."
@@ -1,17 +1,18 @@
 from ..core.entry import Entry
 from ..core.base_op import ApplyOp, OutputOp
-from ..lib.llm_backend import LLMRequest, LLMMessage, LLMResponse, llm_client_hub
+from ..lib.llm_backend import LLMRequest, LLMMessage, LLMResponse, llm_client_hub, estimate_prompt_tokens
 from ..lib.prompt_maker import PromptMaker
 from ..lib.utils import get_format_keys, hash_texts, ReprUtil, KeysUtil
 from ..brokers.llm_broker import LLMBroker
-from ..core.broker import BrokerJobStatus
+from ..brokers.llm_batch_broker import LLMBatchBroker
+from ..core.broker import BrokerJobStatus, DeferredBroker
 from .common_op import RemoveField, MapField
 from ..lib.utils import _to_list_2, _pick_field_or_value_strict
 from .broker_op import BrokerOp, BrokerFailureBehavior
 from ..core.project_folder import ProjectFolder
 from ._registery import show_in_op_list
 from . import functional as F
-from typing import List, Dict, NamedTuple, Set, Tuple, Any
+from typing import List, Dict, NamedTuple, Set, Tuple, Any, Literal
 
 class GenerateLLMRequest(ApplyOp):
     "Generate LLM requests from a given prompt, formatting it with the entry data."
@@ -45,7 +46,8 @@ class GenerateLLMRequest(ApplyOp):
             custom_id=self._generate_custom_id(messages, self.model, self.max_completion_tokens),
             messages=messages,
             model=self.model,
-            max_completion_tokens=self.max_completion_tokens
+            max_completion_tokens=self.max_completion_tokens,
+            estimated_prompt_tokens=estimate_prompt_tokens(messages), # charged to the broker's tokens_per_minute
         )
         entry.data[self.output_key] = request_obj.model_dump()
     
@@ -125,11 +127,14 @@ class ExtractResponseText(ApplyOp):
 #             print(f"Total API cost for the output: ${total_cost:.2f} USD")
     
 class CallLLM(BrokerOp):
-    "Dispatch concurrent API calls for LLM — may induce API billing from external providers."
+    """
+    Dispatch concurrent API calls for LLM — may induce API billing from external providers.
+    - with an LLMBatchBroker, the requests are sent to the Batch API instead, and each execution collects the finished batches
+    """
     def __init__(self,
                  *,
                 cache_path: str=None,
-                broker: LLMBroker=None,
+                broker: LLMBroker|LLMBatchBroker=None,
                 input_key="llm_request",
                 output_key="llm_response",
                 status_key="status",
@@ -137,9 +142,12 @@ class CallLLM(BrokerOp):
                 keep_all_rev: bool = True,
                 failure_behavior:BrokerFailureBehavior = BrokerFailureBehavior.STAY,
                 barrier_level: int = 1,
+                rev_retention: int|Literal["in_flight"]|None = None,
+                rev_storage: Literal["full","delta"] = "full",
+                ledger_profile: str|None = None,
     ):
         if broker is None: broker = ProjectFolder.get_current().get_default_broker(LLMBroker)
-        if not isinstance(broker, LLMBroker): raise ValueError(f"Expected broker to be of type LLMBroker, got {type(broker)}")
+        if not isinstance(broker, (LLMBroker, LLMBatchBroker)): raise ValueError(f"Expected broker to be of type LLMBroker or LLMBatchBroker, got {type(broker)}")
         super().__init__(
             cache_path=cache_path,
             broker=broker,
@@ -149,7 +157,10 @@ class CallLLM(BrokerOp):
             status_key=status_key,
             job_idx_key=job_idx_key,
             failure_behavior=failure_behavior,
-            barrier_level=barrier_level
+            barrier_level=barrier_level,
+            rev_retention=rev_retention,
+            rev_storage=rev_storage,
+            ledger_profile=ledger_profile,
         )
 
     def generate_job_idx(self, entry):
@@ -163,10 +174,14 @@ class CallLLM(BrokerOp):
             allowed_status = [BrokerJobStatus.FAILED, BrokerJobStatus.QUEUED]
         else:
             allowed_status = [BrokerJobStatus.QUEUED]
-        requests = self.broker.get_job_requests(allowed_status)
-        if len(requests) == 0:
+        if isinstance(self.broker, DeferredBroker):
+            self.broker.dispatch_jobs(self.broker.iter_job_requests(allowed_status), mock=mock)
+            self.broker.collect_jobs()
             return
-        self.broker.process_jobs(requests, mock=mock)
+        n_jobs = self.broker.count_job_requests(allowed_status)
+        if n_jobs == 0:
+            return
+        self.broker.process_jobs(self.broker.iter_job_requests(allowed_status), mock=mock, n_jobs=n_jobs)
 
 class CleanupLLMData(RemoveField):
     "Clean up internal fields for LLM processing, such as `llm_request`, `llm_response`, `status`, and `job_idx`."
@@ -0,0 +1,208 @@
+"""
+A local stand-in for an OpenAI-compatible API, for testing the brokers offline.
+- POST /v1/chat/completions answers after `latency` seconds
+- more than `capacity` requests in flight are answered 429 with a Retry-After header, like a provider's throttling
+- `fail_next` queues status codes to answer the next chat completion or batch creation requests with, e.g. [500, 400]
+- the Batch API: POST /v1/files, GET /v1/files/{id}/content, DELETE /v1/files/{id}, POST /v1/batches and GET /v1/batches/{id}.
+    a batch is in_progress for `batch_polls` retrievals, then completed with the echo of each request,
+    the custom_ids in `batch_failures` answered 400 in the error file
+
+    with FakeOpenAIServer(capacity=20) as server:
+        register_fake_provider(monkeypatch, server) # model "fake-model@<server.provider>"
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from typing import Dict, List, Set
+import threading
+import json
+import time
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # the default backlog of 5 refuses the connections of a burst of concurrent calls
+
+class FakeOpenAIServer:
+    def __init__(self, *, capacity:int=1000, latency:float=0.02, retry_after:float|None=0.05):
+        self.capacity = capacity
+        self.latency = latency
+        self.retry_after = retry_after
+        self.fail_next:List[int] = []
+        self.in_flight = 0
+        self.max_in_flight = 0 # of the requests accepted
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.batch_polls = 1
+        self.batch_failures:Set[str] = set()
+        self.files:Dict[str,bytes] = {}
+        self.n_files = 0 # ids are not reused once a file is deleted
+        self.batches:Dict[str,dict] = {}
+        self.lock = threading.Lock()
+        self.httpd = _HTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self.thread = None
+    @property
+    def port(self)->int:
+        return self.httpd.server_address[1]
+    @property
+    def base_url(self)->str:
+        return f"http://127.0.0.1:{self.port}/v1"
+    @property
+    def provider(self)->str:
+        return f"fake{self.port}"
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+    def handle_chat_completion(self, body:dict):
+        "(status, headers, response body) of a chat completion request"
+        with self.lock:
+            self.n_requests += 1
+            if self.fail_next:
+                status = self.fail_next.pop(0)
+                return status, {}, {"error": {"message": f"injected {status}", "type": "injected", "code": status}}
+            if self.in_flight >= self.capacity:
+                self.n_throttled += 1
+                headers = {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+                return 429, headers, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        return 200, {}, self.make_completion(body)
+    def make_completion(self, body:dict)->dict:
+        prompt = " ".join(message["content"] for message in body["messages"])
+        return {
+            "id": f"chatcmpl-{self.n_requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": f"Echo: {prompt}"}}],
+            "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(prompt.split()) + 1,
+                      "total_tokens": 2 * len(prompt.split()) + 1},
+        }
+
+    def create_file(self, filename:str, content:bytes, purpose:str):
+        with self.lock:
+            file_id = f"file-{self.n_files}"
+            self.n_files += 1
+            self.files[file_id] = content
+        return 200, {}, {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                         "filename": filename, "purpose": purpose, "status": "processed"}
+    def get_file_content(self, file_id:str):
+        if file_id not in self.files:
+            return 404, {}, {"error": {"message": f"No such file {file_id}"}}
+        return 200, {}, self.files[file_id]
+    def delete_file(self, file_id:str):
+        with self.lock:
+            if self.files.pop(file_id, None) is None:
+                return 404, {}, {"error": {"message": f"No such file {file_id}"}}
+        return 200, {}, {"id": file_id, "object": "file", "deleted": True}
+    def create_batch(self, body:dict):
+        with self.lock:
+            if self.fail_next:
+                status = self.fail_next.pop(0)
+                return status, {}, {"error": {"message": f"injected {status}", "type": "injected", "code": status}}
+        if body.get("input_file_id") not in self.files:
+            return 400, {}, {"error": {"message": f"No such file {body.get('input_file_id')}"}}
+        with self.lock:
+            batch_id = f"batch_{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"], "created_at": int(time.time()), "status": "validating",
+                "output_file_id": None, "error_file_id": None, "errors": None, "n_polls": 0,
+            }
+        return 200, {}, self._batch_object(batch_id)
+    def get_batch(self, batch_id:str):
+        if batch_id not in self.batches:
+            return 404, {}, {"error": {"message": f"No such batch {batch_id}"}}
+        batch = self.batches[batch_id]
+        batch["n_polls"] += 1
+        if batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+            batch["status"] = "in_progress" if batch["n_polls"] <= self.batch_polls else self._run_batch(batch)
+        return 200, {}, self._batch_object(batch_id)
+    def _run_batch(self, batch:dict)->str:
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]].decode().splitlines():
+            request = json.loads(line)
+            if request["custom_id"] in self.batch_failures:
+                errors.append({"id": f"req-{len(errors)}", "custom_id": request["custom_id"], "error": None, "response": {
+                    "status_code": 400, "body": {"error": {"message": "Invalid request", "type": "invalid_request_error"}}}})
+            else:
+                outputs.append({"id": f"req-{len(outputs)}", "custom_id": request["custom_id"], "error": None, "response": {
+                    "status_code": 200, "body": self.make_completion(request["body"])}})
+        for key, results in [("output_file_id", outputs), ("error_file_id", errors)]:
+            if results:
+                _, _, file = self.create_file(f"{batch['id']}_{key}.jsonl", "".join(json.dumps(result) + "\n" for result in results).encode(), "batch_output")
+                batch[key] = file["id"]
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+        return "completed"
+    def _batch_object(self, batch_id:str)->dict:
+        batch = {key: value for key, value in self.batches[batch_id].items() if key != "n_polls"}
+        batch.setdefault("request_counts", {"total": 0, "completed": 0, "failed": 0})
+        return batch
+
+def _make_handler(server:FakeOpenAIServer):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            path = self.path.rstrip("/")
+            if path == "/v1/files": # multipart/form-data with the fields file and purpose
+                form = BytesParser(policy=default_policy).parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + raw)
+                fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+                status, headers, response = server.create_file(fields["file"].get_filename(), fields["file"].get_payload(decode=True),
+                                                               fields["purpose"].get_content().strip())
+            elif path == "/v1/chat/completions":
+                status, headers, response = server.handle_chat_completion(json.loads(raw or b"{}"))
+            elif path == "/v1/batches":
+                status, headers, response = server.create_batch(json.loads(raw or b"{}"))
+            else:
+                status, headers, response = 404, {}, {"error": {"message": f"Unknown path {self.path}"}}
+            self._send_json(status, headers, response)
+        def do_GET(self):
+            parts = self.path.rstrip("/").split("/")
+            if len(parts) == 5 and parts[2] == "files" and parts[4] == "content":
+                status, headers, response = server.get_file_content(parts[3])
+            elif len(parts) == 4 and parts[2] == "batches":
+                status, headers, response = server.get_batch(parts[3])
+            else:
+                status, headers, response = 404, {}, {"error": {"message": f"Unknown path {self.path}"}}
+            self._send_json(status, headers, response)
+        def do_DELETE(self):
+            parts = self.path.rstrip("/").split("/")
+            if len(parts) == 4 and parts[2] == "files":
+                status, headers, response = server.delete_file(parts[3])
+            else:
+                status, headers, response = 404, {}, {"error": {"message": f"Unknown path {self.path}"}}
+            self._send_json(status, headers, response)
+        def _send_json(self, status, headers, response):
+            is_bytes = isinstance(response, bytes) # file content
+            payload = response if is_bytes else json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream" if is_bytes else "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+        def log_message(self, *args):
+            pass
+    return Handler
+
+def register_fake_provider(monkeypatch, server:FakeOpenAIServer, max_retries:int=0):
+    "make the model fake-model@<server.provider> call the server, the client not retrying by itself"
+    from batchfactory.lib import model_list
+    monkeypatch.setenv("FAKE_OPENAI_API_KEY", "sk-fake")
+    monkeypatch.setitem(model_list.client_desc, server.provider,
+                        {"api_key_environ": "FAKE_OPENAI_API_KEY", "base_url": server.base_url, "max_retries": max_retries})
+    monkeypatch.setitem(model_list.model_desc, f"fake-model@{server.provider}",
+                        {"price_per_input_token_M": 1.0, "price_per_output_token_M": 2.0, "batch_price_discount": 0.5,
+                         "chat_completions": True})
+    return f"fake-model@{server.provider}"
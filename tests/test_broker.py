@@ -0,0 +1,216 @@
+from batchfactory.brokers.concurrent_api_call_broker import ConcurrentAPICallBroker
+from batchfactory.core.broker import BrokerJobRequest, BrokerJobResponse, BrokerJobStatus
+from pydantic import BaseModel
+from fake_openai_server import FakeOpenAIServer, register_fake_provider
+import asyncio
+import time
+
+class EchoRequest(BaseModel):
+    text: str
+
+class EchoBroker(ConcurrentAPICallBroker):
+    def __init__(self, cache_path, **kwargs):
+        super().__init__(cache_path, request_cls=EchoRequest, response_cls=EchoRequest,
+                         concurrency_limit=kwargs.pop("concurrency_limit", 8), rate_limit=kwargs.pop("rate_limit", 100000), **kwargs)
+        self.n_calls = 0
+    async def _call_api_async(self, request, mock):
+        self.n_calls += 1
+        await asyncio.sleep(0)
+        return BrokerJobResponse(job_idx=request.job_idx, status=BrokerJobStatus.DONE, response_object=request.request_object)
+    async def _update_statistics(self, pbar, request, response):
+        if pbar is not None: pbar.update(1)
+    async def _output_and_reset_statistics(self):
+        pass
+
+def _enqueue(broker, n):
+    broker.enqueue({str(i): BrokerJobRequest(job_idx=str(i), status=BrokerJobStatus.QUEUED, request_object=EchoRequest(text=str(i)))
+                    for i in range(n)})
+
+def test_broker_consumes_requests_lazily(tmp_path):
+    broker = EchoBroker(tmp_path / "broker.sqlite")
+    _enqueue(broker, 3000)
+    n_jobs = broker.count_job_requests(BrokerJobStatus.QUEUED)
+    assert n_jobs == 3000
+    max_ahead = 0
+    def requests():
+        nonlocal max_ahead
+        for n_read, request in enumerate(broker.iter_job_requests(BrokerJobStatus.QUEUED)):
+            max_ahead = max(max_ahead, n_read - broker.n_calls)
+            yield request
+    broker.process_jobs(requests(), n_jobs=n_jobs)
+    assert broker.n_calls == 3000
+    assert max_ahead <= broker.concurrency_limit # only requests being processed are held in memory
+    responses = broker.get_job_responses()
+    assert len(responses) == 3000 and responses["7"].response_object.text == "7"
+    assert broker.count_job_requests(BrokerJobStatus.QUEUED) == 0
+
+def test_broker_processes_batches(tmp_path):
+    broker = EchoBroker(tmp_path / "broker.sqlite", max_number_per_batch=100)
+    _enqueue(broker, 350)
+    broker.process_jobs(broker.iter_job_requests(BrokerJobStatus.QUEUED), n_jobs=350)
+    assert broker.n_calls == 350 # every job, in 4 batches
+
+    progress = []
+    def on_batch_end(n_batches, n_done):
+        n_committed = sum(response.status == BrokerJobStatus.DONE for response in broker.get_job_responses().values())
+        progress.append((n_batches, n_done, n_committed))
+        return n_batches < 2
+    broker = EchoBroker(tmp_path / "broker2.sqlite", max_number_per_batch=100, on_batch_end=on_batch_end)
+    _enqueue(broker, 350)
+    broker.process_jobs(broker.iter_job_requests(BrokerJobStatus.QUEUED), n_jobs=350)
+    assert progress == [(1, 100, 100), (2, 200, 200)] # the batch is committed when on_batch_end is called
+    assert broker.count_job_requests(BrokerJobStatus.QUEUED) == 150
+
+    broker.on_batch_end = None
+    broker.max_batches_per_run = 1
+    broker.process_jobs(broker.iter_job_requests(BrokerJobStatus.QUEUED), n_jobs=150)
+    assert broker.count_job_requests(BrokerJobStatus.QUEUED) == 50
+
+def _enqueue_llm_requests(broker, model, n, max_completion_tokens=16):
+    from batchfactory.lib.llm_backend import LLMRequest, LLMMessage
+    broker.enqueue({str(i): BrokerJobRequest(job_idx=str(i), status=BrokerJobStatus.QUEUED, request_object=LLMRequest(
+        custom_id=str(i), model=model, messages=[LLMMessage(role="user", content=f"hello {i}")], max_completion_tokens=max_completion_tokens))
+        for i in range(n)})
+
+def test_llm_broker_adapts_concurrency_to_throttling(tmp_path, monkeypatch):
+    from batchfactory.brokers import LLMBroker
+    n_failed = {}
+    with FakeOpenAIServer(capacity=16, latency=0.02) as server:
+        model = register_fake_provider(monkeypatch, server)
+        for adaptive in [False, True]:
+            broker = LLMBroker(tmp_path / f"llm_{adaptive}.sqlite", concurrency_limit=100, rate_limit=100000, adaptive_concurrency=adaptive,
+                               max_retries=0) # count the throttled calls, not hidden by retries
+            _enqueue_llm_requests(broker, model, 400)
+            broker.process_jobs(broker.get_job_requests(BrokerJobStatus.QUEUED))
+            responses = broker.get_job_responses()
+            assert len(responses) == 400
+            n_failed[adaptive] = sum(response.status == BrokerJobStatus.FAILED for response in responses.values())
+        metrics = broker.get_metrics()
+        assert metrics["n_throttled"] > 0 and metrics["concurrency_limit"] < 50 # backed off from 100 towards the capacity
+        assert responses["7"].response_object.message.content == "Echo: hello 7"
+    assert n_failed[True] * 4 < n_failed[False]
+
+def test_token_bucket_waits_and_settles():
+    from batchfactory.brokers.flow_control import TokenBucket
+    async def main():
+        bucket = TokenBucket(6000, burst=100) # 100 tokens per second
+        time_start = time.monotonic()
+        await bucket.acquire(100)
+        await bucket.acquire(30)
+        waited = time.monotonic() - time_start
+        bucket.settle(30, 0) # the call was refunded
+        time_start = time.monotonic()
+        await bucket.acquire(30)
+        return waited, time.monotonic() - time_start
+    waited, waited_after_refund = asyncio.run(main())
+    assert 0.25 <= waited < 1
+    assert waited_after_refund < 0.05
+
+def test_llm_broker_limits_tokens_per_minute(tmp_path, monkeypatch):
+    from batchfactory.brokers import LLMBroker
+    with FakeOpenAIServer(latency=0.02) as server:
+        model = register_fake_provider(monkeypatch, server)
+        # each request is charged ~1010 tokens, so ~5 fit in the budget, and refunded ~1000 when it completes
+        broker = LLMBroker(tmp_path / "llm.sqlite", rate_limit=100000, tokens_per_minute={model: 6000})
+        _enqueue_llm_requests(broker, model, 40, max_completion_tokens=1000)
+        time_start = time.monotonic()
+        broker.process_jobs(broker.get_job_requests(BrokerJobStatus.QUEUED))
+        elapsed = time.monotonic() - time_start
+        assert server.max_in_flight <= 5
+    responses = broker.get_job_responses()
+    assert all(response.status == BrokerJobStatus.DONE for response in responses.values())
+    assert elapsed < 5 # without settling against the usage, the last 35 requests would wait minutes
+    metrics = broker.get_metrics()
+    assert metrics["n_token_waits"] > 0
+
+def test_llm_broker_retries_transient_errors(tmp_path, monkeypatch):
+    from batchfactory.brokers import LLMBroker
+    from batchfactory.lib.llm_backend import LLMRequest, LLMMessage
+    with FakeOpenAIServer(latency=0.01) as server:
+        model = register_fake_provider(monkeypatch, server)
+        broker = LLMBroker(tmp_path / "llm.sqlite", concurrency_limit=1, rate_limit=100000, max_retries=2, backoff_base=0.01)
+        def run(job_idx, fail_next):
+            server.fail_next = list(fail_next)
+            broker.enqueue({job_idx: BrokerJobRequest(job_idx=job_idx, status=BrokerJobStatus.QUEUED, request_object=LLMRequest(
+                custom_id=job_idx, model=model, messages=[LLMMessage(role="user", content=job_idx)], max_completion_tokens=16))})
+            broker.process_jobs(broker.get_job_requests(BrokerJobStatus.QUEUED))
+            return broker.get_job_responses()[job_idx]
+        response = run("recovers", [500, 429])
+        assert response.status == BrokerJobStatus.DONE
+        assert response.meta["attempts"] == 3 and response.meta["last_error_kind"] == "throttle"
+        response = run("gives_up", [503, 503, 503])
+        assert response.status == BrokerJobStatus.FAILED
+        assert response.meta["attempts"] == 3 and "503" in response.meta["error"]
+        response = run("invalid", [400, 500])
+        assert response.status == BrokerJobStatus.FAILED
+        assert response.meta["attempts"] == 1 and response.meta["last_error_kind"] == "client" # not retried
+        assert server.fail_next == [500]
+
+def test_llm_broker_caps_retry_budget(tmp_path, monkeypatch):
+    from batchfactory.brokers import LLMBroker
+    from batchfactory.brokers.flow_control import MIN_RETRY_BUDGET
+    with FakeOpenAIServer(latency=0.01) as server:
+        model = register_fake_provider(monkeypatch, server)
+        server.fail_next = [500] * 1000 # an outage
+        broker = LLMBroker(tmp_path / "llm.sqlite", rate_limit=100000, max_retries=4, retry_budget=0.1, backoff_base=0.01)
+        _enqueue_llm_requests(broker, model, 40)
+        broker.process_jobs(broker.get_job_requests(BrokerJobStatus.QUEUED))
+        assert server.n_requests <= 40 + MIN_RETRY_BUDGET + 4
+    assert broker.get_metrics()["retry_budget_exhausted"]
+    assert all(response.status == BrokerJobStatus.FAILED for response in broker.get_job_responses().values())
+
+def test_llm_batch_broker_submits_polls_and_collects(tmp_path, monkeypatch):
+    from batchfactory.brokers import LLMBatchBroker
+    from batchfactory.lib.llm_backend import compute_llm_cost
+    with FakeOpenAIServer() as server:
+        model = register_fake_provider(monkeypatch, server)
+        server.batch_failures = {"3"}
+        broker = LLMBatchBroker(tmp_path / "batch.sqlite", max_requests_per_batch=20)
+        _enqueue_llm_requests(broker, model, 30)
+        broker.dispatch_jobs(broker.iter_job_requests(BrokerJobStatus.QUEUED))
+        assert len(server.batches) == 2 # 20 + 10 requests
+        assert broker.count_job_requests(BrokerJobStatus.WAITING) == 30
+        broker.collect_jobs() # in progress
+        assert broker.count_job_requests(BrokerJobStatus.WAITING) == 30 and broker.get_job_responses() == {}
+        assert broker.wait_for_jobs(poll_interval=0.01, timeout=5)
+    responses = broker.get_job_responses()
+    assert len(responses) == 30
+    assert responses["3"].status == BrokerJobStatus.FAILED and "400" in responses["3"].meta["error"]
+    response = responses["7"]
+    assert response.status == BrokerJobStatus.DONE and response.meta["batch_id"] in server.batches
+    assert response.response_object.message.content == "Echo: hello 7"
+    llm_response = response.response_object
+    assert llm_response.cost == compute_llm_cost(llm_response.prompt_tokens, llm_response.completion_tokens, model, is_batch=True)
+    assert llm_response.cost == 0.5 * compute_llm_cost(llm_response.prompt_tokens, llm_response.completion_tokens, model)
+
+def test_llm_batch_broker_deletes_input_file_of_failed_batch(tmp_path, monkeypatch):
+    from batchfactory.brokers import LLMBatchBroker
+    with FakeOpenAIServer() as server:
+        model = register_fake_provider(monkeypatch, server)
+        broker = LLMBatchBroker(tmp_path / "batch.sqlite")
+        _enqueue_llm_requests(broker, model, 5)
+        server.fail_next = [500]
+        broker.dispatch_jobs(broker.iter_job_requests(BrokerJobStatus.QUEUED))
+        assert server.files == {} and server.batches == {} # the uploaded input file is deleted
+        assert broker.count_job_requests(BrokerJobStatus.QUEUED) == 5
+        broker.dispatch_jobs(broker.iter_job_requests(BrokerJobStatus.QUEUED))
+        assert len(server.files) == len(server.batches) == 1
+        assert broker.count_job_requests(BrokerJobStatus.WAITING) == 5
+
+def test_call_llm_with_batch_broker(tmp_path, monkeypatch):
+    import batchfactory as bf
+    from batchfactory.op import FromList, GenerateLLMRequest, CallLLM, ExtractResponseText, OutputEntries
+    from batchfactory.brokers import LLMBatchBroker
+    with FakeOpenAIServer() as server:
+        model = register_fake_provider(monkeypatch, server)
+        with bf.ProjectFolder("test_batch", 1, 0, 0, data_dir=tmp_path) as project:
+            g = bf.Graph()
+            g |= FromList([{"keyword": f"k{i}"} for i in range(5)])
+            g |= GenerateLLMRequest("Say {keyword}", model=model, max_completion_tokens=16)
+            g |= CallLLM(broker=LLMBatchBroker(project["broker_cache"] / "batch"))
+            g |= ExtractResponseText()
+            g |= OutputEntries()
+        assert g.execute(dispatch_brokers=True) == [] # submitted, in progress
+        assert len(server.batches) == 1
+        results = g.execute(dispatch_brokers=True) # collected
+    assert sorted(entry.data["text"] for entry in results) == [f"Echo: Say k{i}" for i in range(5)]
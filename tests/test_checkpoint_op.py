@@ -0,0 +1,112 @@
+import pytest
+import msgpack
+from batchfactory.op import CheckPoint
+from batchfactory.core.entry import Entry
+from batchfactory.core.base_op import PumpOptions
+
+def _pump(op, entries):
+    return op.pump({0: {entry.idx: entry for entry in entries}}, PumpOptions())
+
+def test_checkpoint_pump_uses_bulk_queries(tmp_path):
+    n = 2000
+    op = CheckPoint(tmp_path / "checkpoint.sqlite", keep_all_rev=False)
+    statements = []
+    op._ledger.engine.conn.set_trace_callback(statements.append)
+    output = _pump(op, [Entry(idx=str(i), rev=1, data={"x": i}) for i in range(n)])
+    assert len(output.outputs[0]) == n
+    assert sum(statement.startswith("SELECT") for statement in statements) < 20 # not one per entry
+    assert statements.count("COMMIT") == 1
+    op._ledger.engine.conn.set_trace_callback(None)
+
+def test_checkpoint_keeps_newest_rev(tmp_path):
+    path = tmp_path / "checkpoint.sqlite"
+    op = CheckPoint(path, keep_all_rev=False)
+    _pump(op, [Entry(idx="a", rev=2, data={"x": "new"})])
+    op.reset()
+    output = _pump(op, [Entry(idx="a", rev=1, data={"x": "old"})])
+    assert output.outputs[0]["a"].data == {"x": "new"} # the cache holds a newer rev
+    op.update_batch({"a": Entry(idx="a", rev=2, data={"x": "updated"})}) # same rev is accepted by update_batch
+    resumed = CheckPoint(path, keep_all_rev=False) # loads the rev index from the cache
+    output = _pump(resumed, [Entry(idx="a", rev=2, data={"x": "input"})])
+    assert output.outputs[0]["a"].data == {"x": "updated"}
+
+def test_checkpoint_rev_retention(tmp_path):
+    history = "x" * 2000
+    for rev_retention, n_kept in [(2, 2), ("in_flight", 1)]:
+        op = CheckPoint(tmp_path / f"checkpoint_{rev_retention}.sqlite", rev_retention=rev_retention)
+        for rev in range(10): # a loop storing a growing chat history every round
+            _pump(op, [Entry(idx=str(i), rev=rev, data={"history": history * rev}) for i in range(20)])
+        size_before = op._ledger.disk_size()
+        freed = op.vacuum()
+        assert freed > 0 and op._ledger.disk_size() == size_before - freed
+        assert len(op._ledger.get_all()) == 20 * n_kept
+        assert op._ledger.get_revs("3") == list(range(10 - n_kept, 10))
+        op.reset()
+        output = _pump(op, [Entry(idx="3", rev=9, data={})]) # the newest revision is still cached
+        assert output.outputs[0]["3"].data == {"history": history * 9}
+        n_vacuums = []
+        op._ledger.vacuum = lambda: n_vacuums.append(1) or 0
+        op.compact() # nothing to prune, so the file is not rewritten on every run
+        assert n_vacuums == []
+    op = CheckPoint(tmp_path / "checkpoint_all.sqlite")
+    for rev in range(3):
+        _pump(op, [Entry(idx="a", rev=rev, data={})])
+    op.compact()
+    assert op._ledger.get_revs("a") == [0, 1, 2] # kept by default
+    with pytest.raises(ValueError):
+        CheckPoint(tmp_path / "checkpoint_bad.sqlite", keep_all_rev=False, rev_retention=1)
+
+def test_checkpoint_delta_revisions(tmp_path):
+    def dialogue(rev):
+        return {"chat_history": [{"role": "user", "content": f"message {i} " + "x" * 1000} for i in range(rev + 1)], "rounds": rev}
+    sizes = {}
+    for rev_storage in ["full", "delta"]:
+        op = CheckPoint(tmp_path / f"checkpoint_{rev_storage}.sqlite", rev_storage=rev_storage)
+        for rev in range(20):
+            _pump(op, [Entry(idx=str(i), rev=rev, data=dialogue(rev)) for i in range(10)])
+        sizes[rev_storage] = sum(len(msgpack.packb(record)) for record in op._ledger.get_all().values())
+    assert sizes["delta"] * 8 < sizes["full"]
+    resumed = CheckPoint(tmp_path / "checkpoint_delta.sqlite") # rebuilt whatever rev_storage is
+    assert all(resumed._get_entry("3", rev).data == dialogue(rev) for rev in range(20))
+    entries = resumed._get_entries(["3_4", "3_5", "3_6"]) # rebuilt from one another, but not sharing values
+    entries["3_5"].data["chat_history"][0]["content"] = "changed"
+    assert entries["3_6"].data == dialogue(6)
+    op.update_batch({"3": Entry(idx="3", rev=12, data={"rounds": -1})}) # rev 13 was stored as a patch against it
+    assert op._get_entry("3", 12).data == {"rounds": -1}
+    assert op._get_entry("3", 13).data == dialogue(13)
+    op.rev_retention = 3
+    op.vacuum()
+    assert op._ledger.get_revs("5") == [17, 18, 19]
+    assert CheckPoint(tmp_path / "checkpoint_delta.sqlite")._get_entry("5", 17).data == dialogue(17)
+
+def test_checkpoint_delta_bases_bounded(tmp_path, monkeypatch):
+    import batchfactory.op.checkpoint_op as checkpoint_op
+    monkeypatch.setattr(checkpoint_op, "DELTA_BASES_MAX_IDXS", 4)
+    op = CheckPoint(tmp_path / "checkpoint_bounded.sqlite", rev_storage="delta")
+    for rev in range(3):
+        _pump(op, [Entry(idx=str(i), rev=rev, data={"rounds": [rev] * (rev + 1)}) for i in range(10)])
+        assert len(op._delta_bases) <= 4
+    assert all(op._get_entry(str(i), rev).data == {"rounds": [rev] * (rev + 1)} for i in range(10) for rev in range(3))
+    op.reset()
+    assert op._delta_bases == {}
+
+def test_delta_patch_keeps_types():
+    from batchfactory.lib.utils import _diff_json, _patch_json
+    old = {"x": 1, "y": [1, 2], "z": {"flag": 0}, "w": 1.0, "same": True}
+    new = {"x": True, "y": [1.0, 2, 3], "z": {"flag": False}, "w": 1, "same": True}
+    patched = _patch_json(old, _diff_json(old, new))
+    assert patched == new
+    assert [type(patched[key]) for key in ["x", "w", "same"]] == [bool, int, bool]
+    assert [type(value) for value in patched["y"]] == [float, int, int] and type(patched["z"]["flag"]) is bool
+    assert _diff_json(new, new) == {}
+
+def test_checkpoint_delta_revisions_keep_types(tmp_path):
+    op = CheckPoint(tmp_path / "checkpoint.sqlite", rev_storage="delta")
+    revisions = [{"score": 1, "scores": [1]}, {"score": True, "scores": [1.0]}, {"score": 1.0, "scores": [True, 2]}]
+    for rev, data in enumerate(revisions):
+        _pump(op, [Entry(idx="a", rev=rev, data=data)])
+    resumed = CheckPoint(tmp_path / "checkpoint.sqlite")
+    for rev, data in enumerate(revisions):
+        rebuilt = resumed._get_entry("a", rev).data
+        assert rebuilt == data and type(rebuilt["score"]) is type(data["score"])
+        assert [type(value) for value in rebuilt["scores"]] == [type(value) for value in data["scores"]]
@@ -0,0 +1,232 @@
+import batchfactory as bf
+from batchfactory.op import *
+
+import nest_asyncio; nest_asyncio.apply()  # For Jupyter and pytest compatibility
+
+def _make_chain_with_loop(n_tail_nodes, rounds):
+    g = bf.Graph()
+    g |= FromList([{"n": i} for i in range(10)])
+    g |= SetField("acc", 0)
+    g |= Repeat(MapField(lambda acc, r: acc + r, ["acc", "rounds"], ["acc"]), rounds)
+    for _ in range(n_tail_nodes):
+        g |= MapField(lambda x: x + 1, "acc")
+    g |= Sort("n")
+    g |= ToList("acc")
+    return g
+
+def test_scheduler_only_pumps_dirty_nodes():
+    rounds, n_tail_nodes = 20, 40
+    g = _make_chain_with_loop(n_tail_nodes, rounds)
+    results = g.execute(dispatch_brokers=False, mock=True)
+    expected = sum(range(1, rounds + 1)) + n_tail_nodes
+    assert results == [expected] * 10, f"Expected {expected}, got {results}"
+    # every loop round only touches the loop node and its body, the tail is pumped once when the entries exit the loop
+    n_nodes = len(g.nodes)
+    assert g.executor.n_node_pumps < 2 * n_nodes + 3 * rounds, f"Too many pumps: {g.executor.n_node_pumps}"
+
+def test_scheduler_repumps_waiting_node_on_barrier(tmp_path):
+    project = bf.ProjectFolder("test_scheduler_barrier", 1, 0, 0, data_dir=tmp_path)
+    g = bf.Graph()
+    g |= FromList([3, 1, 2], output_key="n")
+    g |= CheckPoint(project["cache/checkpoint"], barrier_level=1)
+    g |= Sort("n", barrier_level=2)
+    g |= OutputEntries()
+    results = g.execute(dispatch_brokers=False, mock=True)
+    assert [entry.data["n"] for entry in results] == [1, 2, 3]
+    # resume from the cache
+    results = g.execute(dispatch_brokers=False, mock=True)
+    assert [entry.data["n"] for entry in results] == [1, 2, 3]
+
+def test_read_only_ops_do_not_copy_entries():
+    entries = [bf.Entry(idx=str(i), data={"n": i, "history": [i]}) for i in range(5)]
+    g = bf.Graph()
+    g |= FromList(entries)
+    g |= Filter(lambda data: data["n"] % 2 == 0)
+    g |= Sort("n")
+    g |= OutputEntries()
+    results = g.execute(dispatch_brokers=False, mock=True)
+    assert [entry.data["n"] for entry in results] == [0, 2, 4]
+    for entry in results:
+        assert entry is entries[int(entry.idx)], "read-only ops should hand over the cached entry"
+
+def test_mutating_ops_copy_entries():
+    entries = [bf.Entry(idx=str(i), data={"n": i, "history": [i]}) for i in range(3)]
+    g = bf.Graph()
+    g |= FromList(entries)
+    g |= Apply(lambda data: data["history"].append(-1))
+    g |= OutputEntries()
+    results = g.execute(dispatch_brokers=False, mock=True)
+    for entry in results:
+        assert entry.data["history"] == [int(entry.idx), -1]
+        assert entry is not entries[int(entry.idx)]
+    assert [entry.data["history"] for entry in entries] == [[0], [1], [2]], "source entries should not be modified"
+
+def _time_partial_consumption(backlog_size, n_pumps=200, n_consumed=5):
+    import time
+    source, sink = FromList([]), Filter(lambda data: True)
+    g = source | sink
+    executor = g.get_executor()
+    for i in range(backlog_size):
+        executor._update_node_output(source, 0, str(i), bf.Entry(idx=str(i)))
+    time_start = time.perf_counter()
+    for pump_idx in range(n_pumps):
+        consumed = {str(pump_idx * n_consumed + k) for k in range(n_consumed)}
+        executor._consume_node_inputs(sink, {0: consumed})
+    elapsed = time.perf_counter() - time_start
+    assert len(executor.get_node_output(source, 0)) == backlog_size - n_pumps * n_consumed
+    return elapsed
+
+def test_partial_consumption_does_not_scale_with_backlog():
+    # micro-benchmark: consuming a few entries must not rebuild the whole port buffer
+    small = min(_time_partial_consumption(2_000) for _ in range(3))
+    large = min(_time_partial_consumption(100_000) for _ in range(2))
+    assert large < 10 * small + 0.01, f"consumption cost grows with backlog: {small:.4f}s vs {large:.4f}s"
+
+def _make_streaming_graph(project, n):
+    g = bf.Graph()
+    g |= FromList([{"n": i} for i in range(n)])
+    g |= MapField(lambda x: x * 2, "n", "m")
+    g |= CheckPoint(project["cache/checkpoint"], barrier_level=1)
+    g |= WriteJsonl(project["out/stream.jsonl"])
+    return g
+
+def test_streaming_bounds_inflight_entries(tmp_path):
+    import jsonlines
+    project = bf.ProjectFolder("test_streaming", 1, 0, 0, data_dir=tmp_path)
+    n, max_inflight = 1000, 50
+    g = _make_streaming_graph(project, n)
+    g.execute(dispatch_brokers=False, mock=True, stream=True, max_inflight=max_inflight)
+    assert g.executor.peak_inflight <= max_inflight, f"peak inflight {g.executor.peak_inflight} > {max_inflight}"
+    with jsonlines.open(project["out/stream.jsonl"]) as reader:
+        records = list(reader)
+    assert sorted(record["m"] for record in records) == [2 * i for i in range(n)]
+    # resume through the checkpoint ledger
+    g = _make_streaming_graph(project, n)
+    g.execute(dispatch_brokers=False, mock=True, stream=True, max_inflight=max_inflight)
+    with jsonlines.open(project["out/stream.jsonl"]) as reader:
+        assert len(list(reader)) == n
+
+def _make_branching_graph(on_branch=lambda: None):
+    def even_branch(n):
+        on_branch()
+        return n * 10
+    def odd_branch(n):
+        on_branch()
+        return -n
+    g = bf.Graph()
+    g |= FromList([{"n": i} for i in range(20)])
+    true_chain = MapField(even_branch, "n", "m") | MapField(lambda m: m + 1, "m")
+    false_chain = MapField(odd_branch, "n", "m") | MapField(lambda m: m - 1, "m")
+    g |= If(lambda data: data["n"] % 2 == 0, true_chain, false_chain)
+    g |= Sort("n")
+    g |= ToList("m")
+    return g
+
+def test_parallel_pumping_matches_sequential():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    expected = _make_branching_graph().execute(dispatch_brokers=False, mock=True)
+    # both branches must be pumped at the same time to pass the barrier
+    barrier, waited, lock = threading.Barrier(2, timeout=10), set(), threading.Lock()
+    def on_branch():
+        with lock:
+            thread = threading.get_ident()
+            if thread in waited: return
+            waited.add(thread)
+        barrier.wait()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = _make_branching_graph(on_branch).execute(dispatch_brokers=False, mock=True, pool=pool)
+    assert results == expected
+    assert expected == [n * 10 + 1 if n % 2 == 0 else -n - 1 for n in range(20)]
+
+def test_profile_records_node_stats(tmp_path):
+    import json
+    g = bf.Graph()
+    g |= FromList([{"n": i} for i in range(10)])
+    g |= Filter(lambda data: data["n"] < 5)
+    g |= MapField(lambda n: n + 1, "n")
+    g |= ToList("n")
+    g.execute(dispatch_brokers=False, mock=True, profile=bf.ExecutorProfile(measure_bytes=True))
+    profile = g.executor.profile
+    filter_stats = profile.nodes[profile.names[g.nodes[1]]]
+    assert filter_stats.entries_in == 10 and filter_stats.entries_out == 5 and filter_stats.entries_consumed == 5
+    assert filter_stats.bytes_copied == 0, "read-only ops do not copy their inputs"
+    map_stats = profile.nodes[profile.names[g.nodes[2]]]
+    assert map_stats.n_pumps >= 1 and map_stats.pump_time > 0 and map_stats.bytes_copied > 0
+    trace = profile.to_chrome_trace(str(tmp_path / "trace.json"))
+    assert all(event["ph"] == "X" for event in trace["traceEvents"])
+    assert {event["cat"] for event in trace["traceEvents"]} >= {"collect", "pump", "update", "consume"}
+    assert json.loads(profile.to_json())["nodes"][1]["entries_out"] == 5
+
+def _make_fusable_chain():
+    g = bf.Graph()
+    g |= FromList([{"n": i} for i in range(10)])
+    g |= Filter(lambda data: data["n"] % 3 != 0, consume_rejected=False)
+    g |= MapField(lambda n: n * 2, "n", "m")
+    g |= Filter(lambda data: data["m"] < 15, consume_rejected=True)
+    g |= SetField("tag", "x")
+    g |= Sort("n")
+    g |= ToList("m")
+    return g
+
+def test_fused_chain_matches_unfused():
+    expected = _make_fusable_chain().execute(dispatch_brokers=False, mock=True)
+    g = _make_fusable_chain()
+    results = g.execute(dispatch_brokers=False, mock=True, fuse_ops=True)
+    assert results == expected
+    plan = g.executor.plan
+    assert len(plan.fused_ops) == 1 and len(plan.fused_ops[0].steps) == 4
+    assert len(plan.nodes) == len(g.nodes) - 3
+    # per-op stats are still reported
+    profile = g.executor.profile
+    map_stats = profile.nodes[profile.names[g.nodes[2]]]
+    assert map_stats.entries_in == 6 and map_stats.entries_out == 6
+    # the output of the chain is available under its last op
+    assert len(g.get_output(g.nodes[4], 0)) == 0 # consumed by Sort
+
+def test_port_buffers_spill_above_memory_budget(tmp_path):
+    def make_graph():
+        g = bf.Graph()
+        g |= FromList([{"n": i, "text": "x" * 100} for i in range(2000)])
+        g |= MapField(lambda n: n * 2, "n", "m")
+        g |= Sort("n", barrier_level=1)
+        g |= ToList("m")
+        return g
+    expected = make_graph().execute(dispatch_brokers=False, mock=True)
+    g = make_graph()
+    results = g.execute(dispatch_brokers=False, mock=True, memory_budget=20000, spill_dir=str(tmp_path))
+    assert results == expected
+    profile = g.executor.profile
+    assert sum(stats.bytes_spilled for stats in profile.nodes.values()) > 0
+    assert sum(stats.entries_unspilled for stats in profile.nodes.values()) > 0
+    g.executor.reset()
+    assert not any(tmp_path.iterdir()), "spill files are deleted with the buffers"
+
+def test_snapshot_resumes_without_replaying_upstream_ops(tmp_path):
+    import os, pytest
+    project = bf.ProjectFolder("test_snapshot", 1, 0, 0, data_dir=tmp_path)
+    snapshot_path = str(tmp_path / "executor.snapshot")
+    calls, crash = [], [True]
+    def upstream(n):
+        calls.append(n)
+        return n * 2
+    def downstream(m):
+        if crash[0]: raise RuntimeError("simulated crash")
+        return m + 1
+    def make_graph():
+        g = bf.Graph()
+        g |= FromList([{"n": i} for i in range(5)])
+        g |= MapField(upstream, "n", "m")
+        g |= CheckPoint(project["cache/checkpoint"], barrier_level=1)
+        g |= MapField(downstream, "m")
+        g |= Sort("n", barrier_level=2)
+        g |= ToList("m")
+        return g
+    with pytest.raises(RuntimeError):
+        make_graph().execute(dispatch_brokers=False, mock=True, snapshot_path=snapshot_path, snapshot_interval=0)
+    assert os.path.exists(snapshot_path) and len(calls) == 5
+    crash[0] = False
+    results = make_graph().execute(dispatch_brokers=False, mock=True, snapshot_path=snapshot_path, snapshot_interval=0)
+    assert results == [n * 2 + 1 for n in range(5)]
+    assert len(calls) == 5, "upstream ops are not replayed after resuming from the snapshot"
+    assert not os.path.exists(snapshot_path), "the snapshot is deleted when the run finishes"
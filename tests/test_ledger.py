@@ -1,6 +1,7 @@
 from batchfactory.core.ledger import Ledger
 import os
 import asyncio
+import msgpack
 
 def test_ledger(tmp_path):
     cache_path = tmp_path / "test_ledger_cache.sqlite"
@@ -49,4 +50,139 @@ def test_ledger(tmp_path):
     all_records = ledger.get_all()
     ledger.remove_many(set(all_records.keys()))
     ledger.compact()
-    del ledger
\ No newline at end of file
+    del ledger
+
+def test_ledger_get_many(tmp_path):
+    ledger = Ledger(tmp_path / "test_ledger_get_many.sqlite")
+    n = 1234 # more than one chunk of IN (...) parameters
+    ledger.update_many_sync({str(i): {"idx": str(i), "data": i} for i in range(n)})
+    records = ledger.get_many([str(i) for i in range(0, n, 2)] + ["missing"])
+    assert len(records) == (n + 1) // 2
+    assert records["10"] == {"idx": "10", "data": 10}
+    assert "missing" not in records
+    built = ledger.get_many(["1", "3"], builder=lambda record: record["data"])
+    assert built == {"1": 1, "3": 3}
+    ledger.remove_many({str(i) for i in range(n)})
+    assert ledger.get_all() == {}
+
+def test_ledger_indexed_columns(tmp_path):
+    ledger = Ledger(tmp_path / "test_ledger_columns.sqlite", keyed_by_rev=True)
+    ledger.update_many_sync({
+        "a_0": {"idx": "a_0", "rev": 0, "status": "queued"},
+        "a_2": {"idx": "a_2", "rev": 2, "status": "done"},
+        "b_1": {"idx": "b_1", "rev": 1, "status": "failed"},
+    })
+    assert set(ledger.filter_by_status("queued")) == {"a_0"}
+    assert set(ledger.filter_by_status(["done", "failed"])) == {"a_2", "b_1"}
+    assert ledger.count_by_status() == {"queued": 1, "done": 1, "failed": 1}
+    assert ledger.get_latest_rev("a") == 2
+    assert ledger.get_revs("a") == [0, 2]
+    assert ledger.get_latest("a")["idx"] == "a_2"
+    assert ledger.get_latest_rev("missing") is None
+
+def test_ledger_migrates_old_schema(tmp_path):
+    import sqlite3, msgpack
+    path = tmp_path / "test_ledger_old_schema.sqlite"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE entries (idx TEXT PRIMARY KEY, data BLOB)")
+    for i, status in enumerate(["queued", "done", "done"]):
+        record = {"idx": str(i), "status": status}
+        conn.execute("INSERT INTO entries (idx, data) VALUES (?, ?)", (str(i), msgpack.packb(record, use_bin_type=True)))
+    conn.commit(); conn.close()
+    ledger = Ledger(path)
+    assert set(ledger.filter_by_status("done")) == {"1", "2"}
+    ledger.update_many_sync({"3": {"idx": "3", "status": "queued"}})
+    assert set(ledger.filter_by_status("queued")) == {"0", "3"}
+    assert ledger.engine.conn.execute("PRAGMA user_version").fetchone()[0] >= 1
+
+def test_ledger_write_behind(tmp_path):
+    import sqlite3, time
+    path = tmp_path / "test_ledger_write_behind.sqlite"
+    ledger = Ledger(path)
+    ledger.enable_write_behind(flush_every=1000, flush_interval_ms=20)
+    async def respond(n):
+        await asyncio.gather(*[ledger.update_one_async({"idx": str(i), "status": "done"}) for i in range(n)])
+    asyncio.run(respond(300))
+    assert ledger.count_by_status() == {"done": 300} # reads write out the queue first
+    asyncio.run(ledger.update_one_async({"idx": "0", "status": "failed"}))
+    deadline = time.time() + 5
+    while ledger.n_pending and time.time() < deadline: # the writer thread commits it within the window
+        time.sleep(0.01)
+    assert ledger.n_pending == 0
+    asyncio.run(respond(10))
+    ledger.close() # flushes
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 300
+    assert conn.execute("SELECT status FROM entries WHERE idx = '0'").fetchone()[0] == "done"
+    conn.close()
+
+def test_ledger_compression(tmp_path):
+    path = tmp_path / "test_ledger_compression.sqlite"
+    ledger = Ledger(path)
+    ledger.update_many_sync({"old": {"idx": "old", "text": "plain " * 100}})
+    ledger.close()
+    ledger = Ledger(path, compression="zlib")
+    ledger.update_many_sync({"big": {"idx": "big", "text": "repeated " * 100}, "small": {"idx": "small"}})
+    assert ledger.engine.get_one("big")[:1] == b"\xc1"
+    assert ledger.engine.get_one("small")[:1] != b"\xc1" # below the threshold
+    ledger.close()
+    ledger = Ledger(path) # compressed and uncompressed records stay readable without compression
+    assert ledger.get_one("big")["text"] == "repeated " * 100
+    assert ledger.get_one("old")["text"] == "plain " * 100
+    ledger.close()
+
+def test_ledger_trained_dictionary(tmp_path):
+    path = tmp_path / "test_ledger_zdict.sqlite"
+    records = {str(i): {"idx": str(i), "status": "done", "response": {"role": "assistant", "content": f"The answer to question {i} is {i * 7}."}}
+               for i in range(1000)}
+    ledger = Ledger(path, compression="zlib_dict", compress_threshold=64)
+    ledger.update_many_sync(records)
+    assert ledger.codec.zdict_path.exists()
+    blob = ledger.engine.get_one("999")
+    assert blob[:2] == b"\xc1\x02"
+    assert len(blob) < len(msgpack.packb(records["999"], use_bin_type=True)) * 0.7
+    ledger.close()
+    assert Ledger(path).get_all() == records
+
+def test_ledger_profiles(tmp_path):
+    from batchfactory.core.project_folder import ProjectFolder
+    import pytest
+    ledger = Ledger(tmp_path / "test_ledger_durable.sqlite", profile="durable")
+    assert ledger.engine.conn.execute("PRAGMA synchronous").fetchone()[0] == 2 # FULL
+    ledger.close()
+    with ProjectFolder("test", data_dir=tmp_path, ledger_profile="throughput"):
+        ledger = Ledger(tmp_path / "test_ledger_throughput.sqlite")
+    assert ledger.profile == "throughput" and ledger.engine.conn.execute("PRAGMA synchronous").fetchone()[0] == 0 # OFF
+    ledger.update_many_sync({"1": {"idx": "1"}})
+    ledger.close()
+    path = tmp_path / "test_ledger_balanced.sqlite"
+    ledger = Ledger(path)
+    assert ledger.profile == "balanced" and ledger.engine.conn.execute("PRAGMA synchronous").fetchone()[0] == 1 # NORMAL
+    ledger.update_many_sync({"1": {"idx": "1"}})
+    reader = Ledger(path) # opened while the WAL is not checkpointed yet
+    assert reader.get_one("1") == {"idx": "1"}
+    assert os.path.getsize(f"{path}-wal") > 0 # not compacted on open
+    with pytest.raises(ValueError):
+        Ledger(tmp_path / "test_ledger_bad.sqlite", profile="fast")
+    from batchfactory.op import CallLLM
+    with ProjectFolder("test", data_dir=tmp_path):
+        op = CallLLM(cache_path=tmp_path / "call_llm.sqlite", ledger_profile="durable") # forwarded to its checkpoint cache
+    assert op._ledger.profile == "durable"
+
+def test_ledger_pages_with_two_writers(tmp_path):
+    path = tmp_path / "shared.sqlite"
+    first, second = Ledger(path), Ledger(path) # e.g. a graph rebuilt while the old ops are still alive
+    for i in range(3):
+        first.update_many_sync({f"a{i}": {"idx": f"a{i}", "status": "done"}})
+        second.update_many_sync({f"b{i}": {"idx": f"b{i}", "status": "done"}})
+    expected = sorted(f"{prefix}{i}" for prefix in "ab" for i in range(3))
+    for page_size in [1, 2, 3, 5]:
+        assert sorted(idx for idx, _ in first.iter_all(page_size=page_size)) == expected
+        assert sorted(idx for idx, _ in second.iter_by_status("done", page_size=page_size)) == expected
+    # files written before seqs were allocated in the write transaction may have tied seqs
+    first.engine.conn.execute("UPDATE entries SET seq = 1")
+    first.engine.conn.commit()
+    for page_size in [1, 2, 4]:
+        assert sorted(idx for idx, _ in first.iter_all(page_size=page_size)) == expected
+        assert sorted(idx for idx, _ in first.iter_by_status("done", page_size=page_size)) == expected
+    first.close(); second.close()
@@ -0,0 +1,95 @@
+from batchfactory.core.ledger import Ledger
+from batchfactory.core.ledger_engine import SegmentLogEngine
+import pytest
+import asyncio
+import os
+
+ENGINES = ["sqlite", "segment_log"]
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_engine_conformance(tmp_path, engine):
+    path = tmp_path / "ledger"
+    ledger = Ledger(path, keyed_by_rev=True, engine=engine)
+    ledger.update_many_sync({f"{i}_0": {"idx": f"{i}_0", "rev": 0, "status": "queued", "data": i} for i in range(1000)})
+    ledger.update_many_sync({"7_2": {"idx": "7_2", "rev": 2, "status": "done", "data": "x" * 1000}})
+    asyncio.run(ledger.update_one_async({"idx": "800_0", "rev": 0, "status": "failed", "data": 800}))
+    assert ledger.contains("7_2") and not ledger.contains("missing")
+    assert ledger.get_one("5_0") == {"idx": "5_0", "rev": 0, "status": "queued", "data": 5}
+    assert ledger.get_one("missing", default=1) == 1
+    assert set(ledger.get_many(["1_0", "2_0", "missing"])) == {"1_0", "2_0"}
+    assert len(ledger.get_all()) == 1001
+    assert set(ledger.filter_many(lambda record: record["data"] == 3)) == {"3_0"}
+    assert set(ledger.filter_by_status(["done", "failed"])) == {"7_2", "800_0"}
+    assert ledger.count_by_status() == {"queued": 999, "done": 1, "failed": 1}
+    assert ledger.get_revs("7") == [0, 2] and ledger.get_latest_rev("7") == 2
+    assert ledger.get_latest("7")["data"] == "x" * 1000
+    assert ledger.get_rev_index()["7_2"] == 2
+    ledger.remove_many({f"{i}_0" for i in range(500)})
+    assert len(ledger.get_all()) == 501 and not ledger.contains("1_0")
+    with pytest.raises(AssertionError): # a failed batch stores nothing
+        ledger.update_many_sync({"a": {"idx": "a"}, "b": {"idx": "not b"}})
+    assert not ledger.contains("a")
+    ledger.compact()
+    ledger.close()
+    ledger = Ledger(path, keyed_by_rev=True, engine=engine)
+    assert len(ledger.get_all()) == 501
+    assert ledger.get_one("800_0")["status"] == "failed"
+    assert ledger.get_latest_rev("7") == 2
+    ledger.update_many_sync({"new": {"idx": "new"}})
+    assert ledger.count_by_status()[None] == 1
+    ledger.close(delete=True)
+    assert not os.path.exists(ledger.path)
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_engine_iterates_pages(tmp_path, engine):
+    ledger = Ledger(tmp_path / "ledger", engine=engine)
+    ledger.update_many_sync({str(i): {"idx": str(i), "status": "queued" if i % 3 else "done"} for i in range(2500)})
+    seen = []
+    for idx, record in ledger.iter_by_status(["queued", "failed"], page_size=100):
+        seen.append(idx)
+        ledger.update_many_sync({idx: {"idx": idx, "status": "failed"}}) # updated records are not yielded again
+    assert len(seen) == len(set(seen)) == sum(1 for i in range(2500) if i % 3)
+    assert ledger.count_by_status() == {"failed": len(seen), "done": 2500 - len(seen)}
+    assert len(dict(ledger.iter_all(page_size=7))) == 2500
+    assert [idx for idx, _ in ledger.iter_filter(lambda record: record["idx"] in ("5", "6"), page_size=2)] == ["6", "5"] # in order of the last write
+    ledger.close(delete=True)
+
+def test_engine_is_picked_by_suffix(tmp_path):
+    ledger = Ledger(tmp_path / "ledger.seglog")
+    assert isinstance(ledger.engine, SegmentLogEngine)
+    with pytest.raises(ValueError):
+        Ledger(tmp_path / "other", engine="nope")
+
+def test_segment_log_truncates_torn_write(tmp_path):
+    ledger = Ledger(tmp_path / "ledger.seglog")
+    ledger.update_many_sync({"a": {"idx": "a", "data": 1}})
+    segment = ledger.path / ledger.engine._segments[-1]
+    size = os.path.getsize(segment)
+    ledger.update_many_sync({"b": {"idx": "b", "data": 2}})
+    ledger.close()
+    os.truncate(segment, os.path.getsize(segment) - 3) # crash in the middle of the second write
+    os.remove(ledger.path / "index.hint")
+    ledger = Ledger(tmp_path / "ledger.seglog")
+    assert ledger.get_all() == {"a": {"idx": "a", "data": 1}}
+    assert os.path.getsize(segment) == size
+    ledger.update_many_sync({"c": {"idx": "c", "data": 3}})
+    ledger.close()
+    assert set(Ledger(tmp_path / "ledger.seglog").get_all()) == {"a", "c"}
+
+def test_segment_log_merges_dead_segments(tmp_path):
+    ledger = Ledger(tmp_path / "ledger.seglog")
+    ledger.engine.close()
+    engine = ledger.engine = SegmentLogEngine(ledger.path, segment_size=50_000, merge_min_bytes=0)
+    for round in range(10): # every round replaces all records
+        ledger.update_many_sync({str(i): {"idx": str(i), "round": round, "text": "x" * 100} for i in range(200)})
+    engine.wait_merge()
+    ledger.compact()
+    engine.wait_merge()
+    log_size = sum(os.path.getsize(engine.path / segment) for segment in engine._segments)
+    assert log_size < 3 * 200 * 150 # about one live copy, rather than ten
+    assert all(record["round"] == 9 for record in ledger.get_all().values())
+    assert len(engine._order) <= 2 * len(engine._index) # keys of replaced rows are dropped, not kept for every round
+    ledger.close()
+    assert sorted(name for name in os.listdir(tmp_path / "ledger.seglog") if name.endswith(".seg")) == sorted(engine._segments)
+    ledger = Ledger(tmp_path / "ledger.seglog")
+    assert [idx for idx, _ in ledger.iter_all(page_size=7)] == [str(i) for i in range(200)] # in seq order after a merge
@@ -46,4 +46,32 @@ def test_get_llm_embedding_async():
         assert response.dtype == llm_embedding_request.dtype
         
     asyncio.run(main(dummy=True))
-    # asyncio.run(main(dummy=False))
\ No newline at end of file
+    # asyncio.run(main(dummy=False))
+
+def test_estimate_prompt_tokens():
+    from batchfactory.lib.llm_backend import estimate_tokens, estimate_prompt_tokens
+    assert estimate_tokens("") == 0
+    assert 8 <= estimate_tokens("The quick brown fox jumps over the lazy dog.") <= 12 # 10 by tiktoken
+    assert estimate_tokens("你好，世界") == 5
+    messages = [LLMMessage(role="system", content="Be brief."), {"role": "user", "content": "Hello, how are you?"}]
+    assert estimate_prompt_tokens(messages) == 3 + 2 * 4 + estimate_tokens("Be brief.") + estimate_tokens("Hello, how are you?")
+
+def test_client_hub_closes_clients_of_old_loops(monkeypatch):
+    import asyncio
+    from batchfactory.lib.llm_backend import LLMClientHub
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    hub = LLMClientHub()
+    def run_in_new_loop(coroutine): # not asyncio.run, which nest_asyncio makes reuse the current loop
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+    first = run_in_new_loop(hub.get_client_async("openai"))
+    second = run_in_new_loop(hub.get_client_async("openai")) # e.g. the next process_jobs, with its own loop
+    assert first is not second and first.is_closed() and not second.is_closed()
+    async def run():
+        client = await hub.get_client_async("openai")
+        await hub.close_async_clients()
+        return client
+    assert run_in_new_loop(run()).is_closed() and not hub.clients
@@ -0,0 +1,51 @@
+import batchfactory as bf
+from batchfactory.op import *
+import pytest
+
+def test_port_availability():
+    a, b, c = SetField("a", 1), SetField("b", 2), SetField("c", 3)
+    g = a | b
+    assert not g.is_out_port_abaliable(a, 0)
+    assert not g.is_in_port_abaliable(b, 0)
+    assert g.is_out_port_abaliable(b, 0)
+    assert g.incoming_edge(b, 0).source is a
+    assert g.outgoing_edge(b, 0) is None
+    with pytest.raises(ValueError):
+        g.wire(a, c, 0, 0)
+    g.wire(b, c.to_graph())
+    assert g.outgoing_edge(b, 0).target is c
+    assert g.is_chain()
+
+def test_plan_topological_order():
+    begin_true, begin_false = SetField("x", 1), SetField("x", 2)
+    g = bf.Graph()
+    g |= FromList([{"n": 1}])
+    g |= If(lambda data: data["n"] > 0, begin_true, begin_false)
+    g |= ToList("x")
+    plan = g.compile()
+    end_if = next(node for node in g.nodes if isinstance(node, EndIf))
+    # the true branch is wired after EndIf was added, but must be pumped before it
+    assert plan.order[begin_true] < plan.order[end_if]
+    assert plan.order[begin_false] < plan.order[end_if]
+    assert plan.barrier_levels == [0, 1]
+
+def test_plan_loop_order():
+    body = MapField(lambda x: x + 1, "x")
+    g = bf.Graph()
+    g |= FromList([{"x": 0}])
+    g |= Repeat(body, 3)
+    g |= ToList("x")
+    plan = g.compile()
+    loop = next(node for node in g.nodes if isinstance(node, RepeatNode))
+    assert plan.order[loop] < plan.order[body]
+    assert g.execute(dispatch_brokers=False, mock=True) == [3]
+
+def test_plan_is_recompiled_after_modification():
+    g = bf.Graph()
+    g |= FromList([{"x": 0}])
+    executor = g.get_executor()
+    version = executor.plan.version
+    g |= ToList("x")
+    assert g.get_executor() is executor
+    assert executor.plan.version != version
+    assert g.execute(dispatch_brokers=False, mock=True) == [0]